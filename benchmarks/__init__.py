@@ -0,0 +1,4 @@
+"""
+Benchmarks for the Email Cleanse Package. Run each module with
+`python -m benchmarks.<name>`.
+"""
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic multi-charset corpus generator. The same seed always produces
+the same corpus so benchmark runs can be compared.
+
+    python -m benchmarks.corpus OUTPUT.mbox [--messages N] [--seed S]
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import base64
+import random
+import sys
+from email.header import Header
+
+
+# Text in several scripts and the legacy charset commonly used for it.
+SAMPLES = (
+    ('Grüße aus Köln, schöne Tage in der Straße.', 'iso-8859-1'),
+    ('Earn your degree — on your time and terms “today”.', 'cp1252'),
+    ('Быстровыполнимо и малозатратно для всех.', 'koi8-r'),
+    ('本日は晴天なり、桃太郎さん。', 'iso-2022-jp'),
+    ('Wegfall der Vorläufigkeit für Seemanns.', 'utf-8'),
+    ('Přeji vám hezký den a úspěšný týden.', 'iso-8859-2'),
+)
+
+# Kinds of message in the corpus and their relative frequency.
+KINDS = (
+    ('plain', 40),
+    ('mislabelled', 20),
+    ('unseparated', 15),
+    ('huge_header', 5),
+    ('many_attachments', 15),
+    ('large_attachment', 5),
+)
+
+
+def generate_corpus(count, seed=0, large_size=4 * 1024 * 1024):
+    """Generate raw messages.
+
+    Args:
+        count (int): Number of messages to generate.
+        seed (int): Random seed.
+        large_size (int): Size in bytes of the very large attachments.
+
+    Returns:
+        (generator) Raw RFC-5322 messages.
+    """
+    rand = random.Random(seed)
+    kinds = [kind for kind, weight in KINDS for _ in range(weight)]
+    for number in range(count):
+        kind = rand.choice(kinds)
+        yield globals()['_make_' + kind](rand, number, large_size)
+
+def write_mbox(fp, messages):
+    """Write raw messages to `fp` in mbox format.
+
+    Returns:
+        (int) The number of bytes written.
+    """
+    size = 0
+    for raw in messages:
+        for data in (b'From corpus@example.com Thu Jan  1 00:00:00 2015\n',
+                raw, b'\n'):
+            fp.write(data)
+            size += len(data)
+    return size
+
+def _headers(rand, number, subject, extra=b''):
+    text, charset = rand.choice(SAMPLES)
+    sender = Header(text.split(',')[0][:20], charset).encode()
+    return (b'From: ' + sender + b' <user' + str(rand.randint(1, 500)) +
+            b'@example.com>\n'
+            b'To: list@example.com\n'
+            b'Date: Thu, 1 Jan 2015 00:00:00 +0000\n'
+            b'Message-Id: <' + str(number) +
+            b'@corpus.example.com>\n'
+            b'List-Id: <list' + str(rand.randint(1, 10)) +
+            b'.example.com>\n'
+            b'Received: from mx.example.com by mx.example.org\n'
+            b'Subject: ' + subject + b'\n' + extra +
+            b'MIME-Version: 1.0\n')
+
+def _encoded_subject(rand):
+    text, charset = rand.choice(SAMPLES)
+    return Header(text, charset).encode()
+
+def _text_body(rand, charset, label=None):
+    if charset == 'utf-8':
+        text = ' '.join(rand.choice(SAMPLES)[0] for _ in range(20))
+    else:
+        text = ' '.join([sample for sample, sample_charset in SAMPLES
+                if sample_charset == charset][0] for _ in range(20))
+    return (b'Content-Type: text/plain; charset=' +
+            (label or charset).encode('ascii') + b'\n'
+            b'Content-Transfer-Encoding: 8bit\n\n' +
+            text.encode(charset) + b'\n')
+
+def _make_plain(rand, number, large_size):
+    text, charset = rand.choice(SAMPLES)
+    return _headers(rand, number, _encoded_subject(rand)) + \
+            _text_body(rand, charset)
+
+def _make_mislabelled(rand, number, large_size):
+    charset = rand.choice(['cp1252', 'koi8-r', 'iso-8859-2', 'utf-8'])
+    return _headers(rand, number, _encoded_subject(rand)) + \
+            _text_body(rand, charset, rand.choice(['us-ascii', 'x-unknown']))
+
+def _make_unseparated(rand, number, large_size):
+    # Encoded words jammed against plain text without white-space.
+    subject = b'[list ' + str(number) + b']Re:' + \
+            _encoded_subject(rand) + b'text' + _encoded_subject(rand)
+    text, charset = rand.choice(SAMPLES)
+    return _headers(rand, number, subject) + _text_body(rand, charset)
+
+def _make_huge_header(rand, number, large_size):
+    recipients = b',\n '.join(
+            _encoded_subject(rand) + b' <r' + str(index) +
+            b'@example.com>' for index in range(300))
+    text, charset = rand.choice(SAMPLES)
+    return _headers(rand, number, _encoded_subject(rand),
+            b'Cc: ' + recipients + b'\n') + _text_body(rand, charset)
+
+def _make_many_attachments(rand, number, large_size):
+    return _multipart(rand, number, [
+            bytes(bytearray(rand.getrandbits(8) for _ in range(1024)))
+            for _ in range(20)])
+
+def _make_large_attachment(rand, number, large_size):
+    block = bytes(bytearray(rand.getrandbits(8) for _ in range(4096)))
+    return _multipart(rand, number, [block * (large_size // len(block))])
+
+def _multipart(rand, number, attachments):
+    text, charset = rand.choice(SAMPLES)
+    parts = [b'--boundary\n' + _text_body(rand, charset)]
+    for index, content in enumerate(attachments):
+        parts.append(b'--boundary\n'
+                b'Content-Type: application/octet-stream\n'
+                b'Content-Disposition: attachment; filename="file' +
+                str(index) + b'.bin"\n'
+                b'Content-Transfer-Encoding: base64\n\n' +
+                base64.encodestring(content))
+    return _headers(rand, number, _encoded_subject(rand),
+            b'Content-Type: multipart/mixed; boundary="boundary"\n') + \
+            b'\n' + b''.join(parts) + b'--boundary--\n'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('output', help='mbox file to write')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--large-size', type=int, default=4 * 1024 * 1024,
+            help='size in bytes of the very large attachments')
+    args = parser.parse_args(argv)
+    with open(args.output, 'wb') as fp:
+        size = write_mbox(fp, generate_corpus(args.messages, args.seed,
+                args.large_size))
+    print('wrote {0} messages, {1} bytes'.format(args.messages, size))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Header extraction benchmark. Compares pulling a few decoded headers out
+of raw messages with `scan_headers` against building a full email Message
+for each one and decoding its headers.
+
+    python -m benchmarks.headers [--messages N] [--headers NAME ...]
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import email
+import sys
+import time
+
+from benchmarks.corpus import generate_corpus
+from email_cleanse import encoding
+from email_cleanse.reader import scan_headers
+
+
+# Headers extracted by default.
+HEADER_NAMES = ('From', 'Subject', 'Message-Id', 'List-Id')
+
+
+def run(messages, header_names=HEADER_NAMES, seed=0,
+        large_size=1024 * 1024, repeat=3):
+    """Extract headers from the corpus both ways, keeping the fastest of
+    `repeat` runs of each.
+
+    Args:
+        messages (int): Number of messages in the corpus.
+        header_names (iterable): Names of the headers to extract.
+        seed (int): Corpus random seed.
+        large_size (int): Size in bytes of the very large attachments.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        (dict) Messages per second for each route and the speed up.
+    """
+    corpus = list(generate_corpus(messages, seed, large_size))
+    results = {}
+    for route, extract in (('full_parse', _full_parse),
+            ('scan', scan_headers)):
+        best = None
+        for _ in range(repeat):
+            encoding.charset_cache.clear()
+            start = time.time()
+            for raw in corpus:
+                extract(raw, header_names)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results[route + '_messages_per_sec'] = messages / best
+    results['speed_up'] = results['scan_messages_per_sec'] / \
+            results['full_parse_messages_per_sec']
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--headers', nargs='+', default=HEADER_NAMES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--large-size', type=int, default=1024 * 1024,
+            help='size in bytes of the very large attachments')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+    results = run(args.messages, args.headers, args.seed, args.large_size,
+            args.repeat)
+    for name in sorted(results):
+        print('{0:32} {1:12.3f}'.format(name, results[name]))
+    return 0
+
+def _full_parse(raw, header_names):
+    """Extract headers the way it was done before `scan_headers`."""
+    header_names = frozenset(name.lower() for name in header_names)
+    return [(encoding.decode_string_to_unicode(name),
+            encoding.get_decoded_email_header(value))
+            for name, value in email.message_from_string(raw).items()
+            if name.lower() in header_names]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
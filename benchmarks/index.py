@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Search index benchmark. Indexes a normalized synthetic corpus, reporting
+build throughput and index size, then times a mix of word, boolean and
+phrase queries against it.
+
+    python -m benchmarks.index [--messages N] [--flush-size N]
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import generate_corpus
+from email_cleanse.index import SearchIndex
+from email_cleanse.reader import message_from_string
+
+
+# Queries timed against the built index.
+QUERIES = (
+    'köln',
+    'subject:грюсе OR subject:köln',
+    'from:example -straße',
+    '"aus köln"',
+    'body:"schöne tage in der straße"',
+    '(vám OR für) AND NOT day',
+)
+
+
+def run(messages, seed=0, large_size=64 * 1024, flush_size=1000,
+        repeat=20):
+    """Build an index over the corpus and time queries against it.
+
+    Args:
+        messages (int): Number of messages in the corpus.
+        seed (int): Corpus random seed.
+        large_size (int): Size in bytes of the very large attachments.
+        flush_size (int): Messages buffered before a segment is written.
+        repeat (int): Number of times each query is run.
+
+    Returns:
+        (dict) Build throughput, index size and, keyed by the position of
+        the query in `QUERIES`, the mean latency of each query in
+        milliseconds and its number of hits.
+    """
+    corpus = [message_from_string(raw)
+            for raw in generate_corpus(messages, seed, large_size)]
+    path = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        index = SearchIndex(os.path.join(path, 'index'), flush_size)
+        for message in corpus:
+            index.add(message)
+        index.flush()
+        elapsed = time.time() - start
+        results = {
+            'build_messages_per_sec': messages / elapsed,
+            'index_bytes': sum(os.path.getsize(os.path.join(path, 'index',
+                name)) for name in os.listdir(os.path.join(path, 'index'))),
+            'segments': len(index._segments),
+        }
+        for number, query in enumerate(QUERIES):
+            start = time.time()
+            for _ in range(repeat):
+                matches = index.search(query)
+            results['query{0}_ms'.format(number)] = \
+                    (time.time() - start) * 1000 / repeat
+            results['query{0}_hits'.format(number)] = len(matches)
+        index.close()
+    finally:
+        shutil.rmtree(path)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--large-size', type=int, default=64 * 1024,
+            help='size in bytes of the very large attachments')
+    parser.add_argument('--flush-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+    results = run(args.messages, args.seed, args.large_size,
+            args.flush_size, args.repeat)
+    for name in sorted(results):
+        print('{0:32} {1:12.3f}'.format(name, results[name]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
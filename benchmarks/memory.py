@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark. Compares the per-message overhead of UnicodeMessage
+against the original layout, which gave every object a `__dict__` and
+created every container up front, on a synthetic corpus.
+
+    python -m benchmarks.memory [--messages N]
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import sys
+from collections import deque
+
+from email_cleanse.message import UnicodeMessage
+
+
+HEADER_NAMES = ('Received', 'Received', 'Received', 'Date', 'From', 'To',
+        'Subject', 'Message-Id', 'List-Id', 'MIME-Version', 'Content-Type')
+
+
+class LegacyMessage(object):
+
+    """
+    The original UnicodeMessage layout, kept here as the baseline.
+    """
+
+    def __init__(self):
+        self.headers = list()
+        self.alternatives = list()
+        self.attachments = deque()
+        self.message_parts = list()
+
+    def add_header(self, name, value):
+        self.headers.append((name, value))
+
+    def add_alternative(self, message_body, content_type='text/plain'):
+        self.alternatives.append((content_type, message_body))
+
+
+def make_corpus(message_class, count):
+    """Build `count` messages of `message_class` with typical headers and
+    a single text alternative. Header names are decoded afresh for every
+    message, as they are when read from a file."""
+    messages = []
+    for number in range(count):
+        message = message_class()
+        for header_number, name in enumerate(HEADER_NAMES):
+            message.add_header(name.encode('ascii').decode('ascii'),
+                    '{0} value {1}'.format(header_number, number))
+        message.add_alternative('Body of message {0}'.format(number))
+        messages.append(message)
+    return messages
+
+def deep_sizeof(root, seen=None):
+    """Get the size in bytes of `root` and everything it references,
+    counting shared objects once."""
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, deque, set)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return total
+
+def measure(message_class, count):
+    """Get the average number of bytes per message."""
+    return deep_sizeof(make_corpus(message_class, count)) / float(count)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=10000)
+    args = parser.parse_args(argv)
+    before = measure(LegacyMessage, args.messages)
+    after = measure(UnicodeMessage, args.messages)
+    print('messages:              {0}'.format(args.messages))
+    print('bytes/message before:  {0:.0f}'.format(before))
+    print('bytes/message after:   {0:.0f}'.format(after))
+    print('saving:                {0:.1%}'.format(1 - after / before))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
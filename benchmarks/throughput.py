@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Normalization throughput benchmark. Normalizes a synthetic corpus and
+reports messages/sec, MB/sec, peak RSS, how often a strict decode failed
+and how often charset detection had to fall back to chardet. Results can
+be saved as a baseline and later runs compared against it.
+
+    python -m benchmarks.throughput [--messages N] [--save FILE]
+            [--compare FILE]
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import json
+import resource
+import sys
+import time
+
+from benchmarks.corpus import generate_corpus
+from email_cleanse import encoding
+from email_cleanse.reader import message_from_string
+
+
+# Metrics where a larger value is better. Used when comparing runs.
+HIGHER_IS_BETTER = ('messages_per_sec', 'mb_per_sec')
+
+
+def run(messages, seed=0, large_size=4 * 1024 * 1024, repeat=3):
+    """Normalize the corpus `repeat` times keeping the fastest run. The
+    corpus is generated as it is normalized, so that it does not count
+    towards the peak RSS, and only normalization is timed.
+
+    Args:
+        messages (int): Number of messages in the corpus.
+        seed (int): Corpus random seed.
+        large_size (int): Size in bytes of the very large attachments.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        (dict) The benchmark results.
+    """
+    best = None
+    for _ in range(repeat):
+        encoding.charset_cache.clear()
+        size = 0
+        elapsed = 0
+        for raw in generate_corpus(messages, seed, large_size):
+            size += len(raw)
+            start = time.time()
+            message_from_string(raw)
+            elapsed += time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    # Count fallbacks in a separate, untimed run so that collecting the
+    # statistics does not affect the timings.
+    encoding.charset_cache.clear()
+    encoding.enable_stats()
+    try:
+        for raw in generate_corpus(messages, seed, large_size):
+            message_from_string(raw)
+        stats = encoding.get_stats()
+    finally:
+        encoding.disable_stats()
+    return {
+        'messages': messages,
+        'bytes': size,
+        'seconds': best,
+        'messages_per_sec': messages / best,
+        'mb_per_sec': size / best / (1024 * 1024),
+        'peak_rss_mb': _peak_rss_mb(),
+        'strict_failures_per_message':
+            sum(stats['strict_failures'].values()) / float(messages),
+        'chardet_fallbacks_per_message':
+            stats['chardet_calls'] / float(messages),
+    }
+
+def compare(results, baseline):
+    """Get the percentage change of each metric from `baseline`, signed so
+    that a positive change is an improvement."""
+    changes = {}
+    for name, value in results.items():
+        if name in ('messages', 'bytes') or not baseline.get(name):
+            continue
+        change = (value - baseline[name]) / float(baseline[name]) * 100
+        changes[name] = change if name in HIGHER_IS_BETTER else -change
+    return changes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--large-size', type=int, default=4 * 1024 * 1024,
+            help='size in bytes of the very large attachments')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='save the results as a baseline')
+    parser.add_argument('--compare', help='compare against a saved baseline')
+    args = parser.parse_args(argv)
+    results = run(args.messages, args.seed, args.large_size, args.repeat)
+    changes = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            changes = compare(results, json.load(fp))
+    for name in sorted(results):
+        line = '{0:32} {1:12.3f}'.format(name, results[name])
+        if name in changes:
+            line += '  {0:+.1f}%'.format(changes[name])
+        print(line)
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return 0
+
+def _peak_rss_mb():
+    """Get the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and bytes on OS X.
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024)
+    return peak / 1024.0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Batch normalization. Spread the normalization of large archives across a
+pool of worker processes.
+"""
+from __future__ import unicode_literals
+
+import argparse
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from collections import deque
+from itertools import islice
+
+from email_cleanse.reader import message_from_string, iter_mbox_raw, \
+        iter_mbox_entries, iter_maildir_raw
+
+
+# Number of raw messages handed to a worker at a time.
+DEFAULT_CHUNK_SIZE = 64
+
+# Number of messages processed between checkpoint saves.
+CHECKPOINT_INTERVAL = 1000
+
+# Number of bytes at the start of an mbox file fingerprinted to detect
+# that it has been rewritten.
+CHECKPOINT_HEAD_SIZE = 64 * 1024
+
+
+class Checkpoint(object):
+
+    """
+    Progress through an append-only mbox file, saved to a JSON file. Holds
+    the offset to resume from along with fingerprints of the start of the
+    mbox and of the last message processed, which are used to tell if the
+    mbox has been truncated or rewritten since.
+    """
+
+    def __init__(self, path):
+        """Initialize instance of Checkpoint, loading any saved state.
+
+        Args:
+            path (string): The checkpoint file.
+        """
+        self.path = path
+        self.state = None
+        self.full_rescan = False
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.state = json.load(fp)
+
+    def resume_offset(self, mbox_path):
+        """Get the offset to resume processing `mbox_path` from. Sets
+        `full_rescan` if the checkpoint no longer matches the mbox and
+        processing must start again from the beginning.
+
+        Args:
+            mbox_path (string): The mbox file.
+
+        Returns:
+            (int) The byte offset of the first unprocessed message.
+        """
+        self.full_rescan = not self._matches(mbox_path)
+        if self.full_rescan:
+            self.state = None
+            return 0
+        return self.state['offset']
+
+    def advance(self, start, end):
+        """Record that the message at `start`:`end` has been processed.
+
+        Args:
+            start (int): Offset of the message's `From ` line.
+            end (int): Offset just past the message.
+        """
+        if self.state is None:
+            self.state = {'messages': 0}
+        self.state['last_offset'] = start
+        self.state['offset'] = end
+        self.state['messages'] += 1
+        self.state['last'] = None
+
+    def save(self, mbox_path):
+        """Fingerprint the processed part of `mbox_path` and write the
+        checkpoint file, replacing it atomically.
+
+        Args:
+            mbox_path (string): The mbox file.
+        """
+        if self.state is None:
+            return
+        with open(mbox_path, 'rb') as fp:
+            self.state['path'] = os.path.abspath(mbox_path)
+            self.state['head_size'] = min(CHECKPOINT_HEAD_SIZE,
+                    self.state['offset'])
+            self.state['head'] = _fingerprint(fp, 0, self.state['head_size'])
+            self.state['last'] = _fingerprint(fp, self.state['last_offset'],
+                    self.state['offset'])
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False,
+                prefix='.checkpoint') as fp:
+            json.dump(self.state, fp, sort_keys=True)
+        os.rename(fp.name, self.path)
+
+    def _matches(self, mbox_path):
+        """Return whether or not the processed part of `mbox_path` is
+        unchanged since the checkpoint was saved."""
+        state = self.state
+        if not state or not state.get('last') \
+                or state.get('path') != os.path.abspath(mbox_path) \
+                or os.path.getsize(mbox_path) < state['offset']:
+            return False
+        with open(mbox_path, 'rb') as fp:
+            return _fingerprint(fp, 0, state['head_size']) == state['head'] \
+                    and _fingerprint(fp, state['last_offset'],
+                        state['offset']) == state['last']
+
+
+def normalize_batch(raw_messages, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Normalize raw messages using a pool of worker processes.
+
+    Messages are sent to the workers in chunks of `chunk_size` and at most
+    two chunks per worker are in flight at once, so memory use does not
+    grow with the size of the input. Results are yielded in input order.
+
+    Args:
+        raw_messages (iterable): Raw RFC-5322 messages.
+        workers (int): Number of worker processes. Defaults to the number
+            of CPUs. A value of 1 normalizes in the calling process.
+        chunk_size (int): Number of messages sent to a worker at a time.
+
+    Returns:
+        (generator) `UnicodeMessage.as_dict()` records in input order.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    chunks = _iter_chunks(raw_messages, chunk_size)
+    if workers == 1:
+        for chunk in chunks:
+            for record in _normalize_chunk(chunk):
+                yield record
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_normalize_chunk, (chunk,)))
+            if len(pending) >= workers * 2:
+                for record in pending.popleft().get():
+                    yield record
+        while pending:
+            for record in pending.popleft().get():
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def normalize_archive(path, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+        checkpoint=None):
+    """Normalize every message in an mbox file or Maildir tree using a pool
+    of worker processes.
+
+    With a checkpoint file only messages appended to an mbox file since
+    the last run are normalized. Progress is saved every
+    `CHECKPOINT_INTERVAL` messages and when processing stops. A message
+    only counts as processed once the caller asks for the next record, so
+    a run that crashes while handling a record yields it again. If the
+    mbox has been truncated or rewritten it is normalized from the
+    beginning.
+
+    Args:
+        path (string): Path to an mbox file or the root of a Maildir tree.
+        workers (int): Number of worker processes. Defaults to the number
+            of CPUs.
+        chunk_size (int): Number of messages sent to a worker at a time.
+        checkpoint (string|Checkpoint): Checkpoint, or the path of its
+            file, to resume an mbox file from.
+
+    Returns:
+        (generator) `UnicodeMessage.as_dict()` records in archive order.
+
+    Raises:
+        ValueError: If a checkpoint is given for a Maildir tree.
+    """
+    if os.path.isdir(path):
+        if checkpoint is not None:
+            raise ValueError('Checkpoints are only supported for mbox files')
+        return normalize_batch(iter_maildir_raw(path), workers, chunk_size)
+    if checkpoint is None:
+        raw_messages = (raw for _, raw in iter_mbox_raw(path))
+        return normalize_batch(raw_messages, workers, chunk_size)
+    if not isinstance(checkpoint, Checkpoint):
+        checkpoint = Checkpoint(checkpoint)
+    return _normalize_mbox_from_checkpoint(path, workers, chunk_size,
+            checkpoint)
+
+def main(argv=None):
+    """Command line entry point. Normalizes an archive and writes one JSON
+    record per message. Attachment content is base64 encoded.
+
+    Args:
+        argv (list): Command line arguments. Defaults to `sys.argv[1:]`.
+
+    Returns:
+        (int) The exit status.
+    """
+    parser = argparse.ArgumentParser(
+            description='Normalize an mbox file or Maildir tree.')
+    parser.add_argument('archive', help='mbox file or Maildir directory')
+    parser.add_argument('-o', '--output', default='-',
+            help='output file, defaults to stdout')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+            help='number of worker processes, defaults to the CPU count')
+    parser.add_argument('-c', '--chunk-size', type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='messages sent to a worker at a time')
+    parser.add_argument('--checkpoint',
+            help='checkpoint file used to only process new mbox messages')
+    args = parser.parse_args(argv)
+    if args.output == '-':
+        output = sys.stdout
+    else:
+        output = open(args.output, 'wb')
+    try:
+        for record in normalize_archive(args.archive, args.workers,
+                args.chunk_size, args.checkpoint):
+            for attachment in record['attachments']:
+                attachment['content'] = base64.b64encode(
+                        attachment['content'])
+            output.write(json.dumps(record))
+            output.write(b'\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+def _normalize_mbox_from_checkpoint(path, workers, chunk_size, checkpoint):
+    """Normalize the messages of `path` after the checkpoint, advancing it
+    as each record is consumed."""
+    ranges = deque()
+    def raw_messages():
+        previous = None
+        for entry in iter_mbox_entries(path, checkpoint.resume_offset(path)):
+            if previous is not None:
+                ranges.append(previous[:2])
+                yield previous[2]
+            previous = entry
+        # The last message may still be being appended. Leave it for the
+        # next run unless it ends with the blank line separating messages.
+        if previous is not None \
+                and previous[2].endswith((b'\n\n', b'\r\n\r\n')):
+            ranges.append(previous[:2])
+            yield previous[2]
+    unsaved = 0
+    try:
+        for record in normalize_batch(raw_messages(), workers, chunk_size):
+            start, end = ranges.popleft()
+            yield record
+            checkpoint.advance(start, end)
+            unsaved += 1
+            if unsaved >= CHECKPOINT_INTERVAL:
+                checkpoint.save(path)
+                unsaved = 0
+    finally:
+        if unsaved:
+            checkpoint.save(path)
+
+def _fingerprint(fp, start, end):
+    """Get the SHA-1 hex digest of the bytes `start`:`end` of `fp`."""
+    sha = hashlib.sha1()
+    fp.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = fp.read(min(remaining, 64 * 1024))
+        if not data:
+            break
+        sha.update(data)
+        remaining -= len(data)
+    return sha.hexdigest()
+
+def _normalize_chunk(raw_messages):
+    """Normalize a list of raw messages. Runs in the worker processes."""
+    return [message_from_string(raw).as_dict() for raw in raw_messages]
+
+def _iter_chunks(iterable, size):
+    """Yield lists of up to `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+if __name__ == '__main__':
+    sys.exit(main())
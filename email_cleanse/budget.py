@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Process wide memory budget. Tracks the bytes held in memory by attachment
+content and decoded bodies of every live message. Once the budget is
+exceeded the largest in-memory attachments are spilled to temporary files
+and callers taking in new mail can wait for usage to drop.
+"""
+from __future__ import unicode_literals
+
+import sys
+import threading
+import time
+import weakref
+
+
+# Default number of bytes attachment content and decoded bodies may hold.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+class MemoryBudget(object):
+
+    """
+    Accountant for the bytes held by attachment content and decoded
+    bodies. Buffers are tracked through weak references so they stop
+    counting as soon as they are freed. Safe to share between threads.
+    """
+
+    def __init__(self, limit=DEFAULT_MEMORY_BUDGET):
+        """Initialize instance of MemoryBudget.
+
+        Args:
+            limit (int): Number of bytes which may be held before
+                attachments are spilled and intake is throttled.
+        """
+        self.limit = limit
+        self.usage = 0
+        self.peak = 0
+        self.spills = 0
+        self.spilled_bytes = 0
+        self.throttled = 0
+        # Buffers freed by the garbage collector can be released on any
+        # thread, including one already holding the lock.
+        self._condition = threading.Condition(threading.RLock())
+        self._contents = dict()
+        self._bodies = dict()
+
+    def track_content(self, content, size):
+        """Count attachment content held in memory, spilling the largest
+        buffers if the budget is exceeded.
+
+        Args:
+            content (SpooledContent): The in-memory content. Spilled by
+                calling its `rollover`.
+            size (int): Number of bytes held.
+        """
+        key = id(content)
+        reference = weakref.ref(content,
+                lambda reference: self._release(self._contents, key))
+        with self._condition:
+            self._contents[key] = (reference, size)
+            self._add(size)
+            self._spill()
+
+    def track_body(self, message, body):
+        """Count a decoded body held by `message` until the message is
+        freed.
+
+        Args:
+            message (UnicodeMessage): The message holding the body.
+            body (unicode): The decoded body.
+        """
+        key = id(message)
+        size = sys.getsizeof(body)
+        with self._condition:
+            entry = self._bodies.get(key)
+            if entry is None:
+                reference = weakref.ref(message,
+                        lambda reference: self._release(self._bodies, key))
+                self._bodies[key] = (reference, size)
+            else:
+                self._bodies[key] = (entry[0], entry[1] + size)
+            self._add(size)
+            self._spill()
+
+    def wait_for_room(self, timeout=None):
+        """Block while usage is over the budget. Call before taking in
+        more mail to throttle intake.
+
+        Args:
+            timeout (float): Seconds to wait. Defaults to waiting forever.
+
+        Returns:
+            (bool) Whether or not usage is within the budget.
+        """
+        with self._condition:
+            if self.usage <= self.limit:
+                return True
+            self.throttled += 1
+            # Any buffer being freed wakes the waiters, so keep waiting
+            # out the time remaining while usage is still over.
+            deadline = None if timeout is None else time.time() + timeout
+            while self.usage > self.limit:
+                remaining = None if deadline is None \
+                        else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self.usage <= self.limit
+
+    def stats(self):
+        """Get the current usage and spill counts for monitoring.
+
+        Returns:
+            (dict) The limit, usage, peak usage, number of tracked
+            buffers, spills, bytes spilled and times intake was throttled.
+        """
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'usage': self.usage,
+                'peak': self.peak,
+                'buffers': len(self._contents) + len(self._bodies),
+                'spills': self.spills,
+                'spilled_bytes': self.spilled_bytes,
+                'throttled': self.throttled,
+            }
+
+    def _add(self, size):
+        """Add `size` bytes to the usage."""
+        self.usage += size
+        if self.usage > self.peak:
+            self.peak = self.usage
+
+    def _release(self, entries, key):
+        """Stop counting the freed buffer `key` of `entries`."""
+        with self._condition:
+            entry = entries.pop(key, None)
+            if entry is not None:
+                self.usage -= entry[1]
+                self._condition.notify_all()
+
+    def _spill(self):
+        """Move the largest in-memory attachments to temporary files until
+        usage is within the budget or nothing is left to spill."""
+        while self.usage > self.limit and self._contents:
+            key = max(self._contents, key=lambda key: self._contents[key][1])
+            reference, size = self._contents.pop(key)
+            content = reference()
+            if content is not None and not content.closed:
+                content.rollover()
+                self.spills += 1
+                self.spilled_bytes += size
+            self.usage -= size
+        self._condition.notify_all()
+
+
+# The active MemoryBudget, or `None` when memory is not being budgeted.
+_budget = None
+
+
+def enable_budget(limit=DEFAULT_MEMORY_BUDGET):
+    """Start budgeting memory. Only content and bodies created from now on
+    are tracked.
+
+    Args:
+        limit (int): Number of bytes which may be held before attachments
+            are spilled and intake is throttled.
+
+    Returns:
+        (MemoryBudget) The budget.
+    """
+    global _budget
+    _budget = MemoryBudget(limit)
+    return _budget
+
+def disable_budget():
+    """Stop budgeting memory."""
+    global _budget
+    _budget = None
+
+def get_budget():
+    """Get the active budget.
+
+    Returns:
+        (MemoryBudget) The budget or `None` if memory is not budgeted.
+    """
+    return _budget
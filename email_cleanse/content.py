@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Attachment content backends.
+"""
+from __future__ import unicode_literals
+
+import binascii
+import mmap
+import os
+import tempfile
+from io import BytesIO
+
+
+# Number of encoded bytes read from the source at a time.
+READ_BLOCK_SIZE = 64 * 1024
+
+# Number of bytes copied at a time when content is moved to disk.
+ROLLOVER_CHUNK_SIZE = 64 * 1024
+
+
+class EncodedContent(object):
+
+    """
+    Read-only file-like view of a transfer encoded byte range of a larger
+    file or mmap, such as one MIME part of a message in an mbox file.
+    Nothing is read or decoded until the content is first read, and it is
+    then decoded a block at a time.
+    """
+
+    def __init__(self, source, offset, length, transfer_encoding=None):
+        """Initialize instance of EncodedContent.
+
+        Args:
+            source (mmap|file): The mmap or file holding the encoded bytes.
+            offset (int): Position of the first encoded byte in `source`.
+            length (int): Number of encoded bytes.
+            transfer_encoding (unicode): The Content-Transfer-Encoding of
+                the bytes. Unknown encodings are read as is.
+        """
+        self.source = source
+        self.offset = offset
+        self.encoded_length = length
+        self.transfer_encoding = (transfer_encoding or '7bit').strip().lower()
+        self.closed = False
+        self._reset()
+
+    def read(self, size=-1):
+        """Read up to `size` decoded bytes, or everything if `size` is
+        negative.
+
+        Args:
+            size (int): Maximum number of bytes to read.
+
+        Returns:
+            (string) The decoded bytes. Empty once the content is exhausted.
+        """
+        while (size < 0 or len(self._buffer) < size) \
+                and self._encoded_position < self.encoded_length:
+            self._decode_block()
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self._position += len(data)
+        return data
+
+    def seek(self, position, whence=os.SEEK_SET):
+        """Move to a decoded position. Moving backwards restarts decoding
+        from the beginning of the range.
+
+        Args:
+            position (int): The position, relative to `whence`.
+            whence (int): `os.SEEK_SET` or `os.SEEK_CUR`.
+        """
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence != os.SEEK_SET:
+            raise IOError('EncodedContent can only seek from the start or '
+                    'current position')
+        if position < self._position:
+            self._reset()
+        while self._position < position:
+            if not self.read(min(position - self._position, READ_BLOCK_SIZE)):
+                break
+
+    def tell(self):
+        """Return the current decoded position."""
+        return self._position
+
+    def close(self):
+        """Release the decoding buffer. The source is left open."""
+        self._buffer = b''
+        self.closed = True
+
+    def _reset(self):
+        """Restart decoding from the beginning of the range."""
+        self._encoded_position = 0
+        self._position = 0
+        self._buffer = b''
+        self._pending = b''
+
+    def _decode_block(self):
+        """Read and decode the next block of encoded bytes."""
+        size = min(READ_BLOCK_SIZE,
+                self.encoded_length - self._encoded_position)
+        start = self.offset + self._encoded_position
+        if isinstance(self.source, mmap.mmap):
+            block = self.source[start:start + size]
+        else:
+            self.source.seek(start)
+            block = self.source.read(size)
+        self._encoded_position += size
+        final = self._encoded_position >= self.encoded_length or not block
+        if not block:
+            self._encoded_position = self.encoded_length
+        if self.transfer_encoding == 'base64':
+            self._buffer += self._decode_base64(block, final)
+        elif self.transfer_encoding == 'quoted-printable':
+            self._buffer += self._decode_quoted_printable(block, final)
+        else:
+            self._buffer += block
+
+    def _decode_base64(self, block, final):
+        """Decode whole groups of four base64 characters carrying the rest
+        over to the next block. Like `email.message.Message.get_payload`,
+        data which is not valid base64 is returned undecoded rather than
+        lost."""
+        data = self._pending + b''.join(block.split())
+        if final:
+            self._pending = b''
+            padded = data + b'=' * (-len(data) % 4)
+        else:
+            whole = len(data) - len(data) % 4
+            data, self._pending = data[:whole], data[whole:]
+            padded = data
+        try:
+            return binascii.a2b_base64(padded)
+        except binascii.Error:
+            return data
+
+    def _decode_quoted_printable(self, block, final):
+        """Decode complete lines carrying the last partial line over to
+        the next block."""
+        data = self._pending + block
+        if final:
+            self._pending = b''
+        else:
+            end = data.rfind(b'\n') + 1
+            data, self._pending = data[:end], data[end:]
+        return binascii.a2b_qp(data)
+
+
+class SpooledContent(object):
+
+    """
+    File-like content held in memory until it grows larger than `max_size`
+    bytes or `rollover` is called, when it is moved to a temporary file.
+    Like `tempfile.SpooledTemporaryFile`, but whether the content has been
+    moved is public and moving it copies a chunk at a time rather than
+    duplicating the whole buffer.
+    """
+
+    def __init__(self, max_size=0, dir=None):
+        """Initialize instance of SpooledContent.
+
+        Args:
+            max_size (int): Number of bytes held in memory before the
+                content is moved to disk. Zero holds it in memory until
+                `rollover` is called.
+            dir (string): Directory of the temporary file. Defaults to the
+                system default.
+        """
+        self.max_size = max_size
+        self.dir = dir
+        self.rolled = False
+        self._file = BytesIO()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def read(self, size=-1):
+        """Read up to `size` bytes, or everything if `size` is negative."""
+        return self._file.read(size)
+
+    def write(self, data):
+        """Write `data`, moving the content to disk if it grows too large."""
+        self._file.write(data)
+        if not self.rolled and self.max_size \
+                and self._file.tell() > self.max_size:
+            self.rollover()
+
+    def seek(self, position, whence=os.SEEK_SET):
+        """Move to `position` relative to `whence`."""
+        self._file.seek(position, whence)
+
+    def tell(self):
+        """Return the current position."""
+        return self._file.tell()
+
+    def flush(self):
+        """Flush the temporary file, if the content is on disk."""
+        self._file.flush()
+
+    def fileno(self):
+        """Move the content to disk and return the file descriptor."""
+        self.rollover()
+        return self._file.fileno()
+
+    def close(self):
+        """Release the content."""
+        self._file.close()
+
+    def rollover(self):
+        """Move the content to a temporary file, keeping the position."""
+        if self.rolled:
+            return
+        memory = self._file
+        position = memory.tell()
+        self._file = tempfile.TemporaryFile(dir=self.dir)
+        memory.seek(0)
+        while True:
+            chunk = memory.read(ROLLOVER_CHUNK_SIZE)
+            if not chunk:
+                break
+            self._file.write(chunk)
+        memory.close()
+        self._file.seek(position)
+        self.rolled = True
@@ -4,9 +4,279 @@ Email encoding.
 """
 from __future__ import unicode_literals
 
+import codecs
+import hashlib
 import re
-import chardet
+import threading
+from collections import OrderedDict, defaultdict
 from email.header import decode_header
+from itertools import islice
+from timeit import default_timer
+
+import chardet
+from chardet.universaldetector import UniversalDetector
+
+
+# Number of charset detection results remembered by `charset_cache`.
+DEFAULT_CHARSET_CACHE_SIZE = 1024
+
+# Byte order marks and the codec which decodes them. UTF-32 is listed
+# before UTF-16 as the UTF-32-LE mark begins with the UTF-16-LE one.
+BYTE_ORDER_MARKS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# Charsets tried in order, with a strict decode, before falling back to
+# chardet. Single byte charsets such as cp1252 or iso-8859-15 decode
+# almost any input so only list those known to be common in your mail.
+LEGACY_CHARSETS = []
+
+# Number of decoded headers remembered by `header_cache`. Disabled by
+# default; set with `header_cache.resize`. Headers longer than
+# `HEADER_CACHE_MAX_LENGTH` are never cached.
+DEFAULT_HEADER_CACHE_SIZE = 0
+HEADER_CACHE_MAX_LENGTH = 1024
+
+# Number of headers decoded together by `iter_decoded_headers`.
+DEFAULT_HEADER_BATCH_SIZE = 10000
+
+# Number of bytes read from a body at a time by `iter_decoded_chunks`.
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# An RFC-2047 encoded word which is immediately followed by something
+# other than white-space. Each part only matches up to the next `?` so
+# the scan is linear in the length of the header.
+_UNSEPARATED_ENCODED_WORD_RE = re.compile(
+        r"=\?[^?\s]+\?[BbQq]\?[^?\r\n]*\?=(?=\S)")
+
+# Maximum number of bytes fed to chardet when guessing a charset and the
+# size of each block fed to it.
+DETECTION_BYTE_BUDGET = 64 * 1024
+DETECTION_BLOCK_SIZE = 4096
+
+_MISSING = object()
+
+
+class LRUCache(object):
+
+    """
+    Bounded mapping which discards the least recently used entry once it
+    is full. Safe to share between threads. A `maxsize` of 0 disables
+    caching altogether.
+    """
+
+    def __init__(self, maxsize):
+        """Initialize instance of LRUCache.
+
+        Args:
+            maxsize (int): Maximum number of entries held.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the value cached for `key` marking it as recently used.
+
+        Args:
+            key (hashable): The cache key.
+            default (object): Returned when `key` is not cached.
+
+        Returns:
+            (object) The cached value or `default`.
+        """
+        with self._lock:
+            value = self._entries.pop(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache `value` for `key` evicting the least recently used entry
+        if the cache is full.
+
+        Args:
+            key (hashable): The cache key.
+            value (object): The value to cache.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            self._evict()
+
+    def resize(self, maxsize):
+        """Change the size bound evicting entries if necessary.
+
+        Args:
+            maxsize (int): Maximum number of entries held.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Get hit/miss statistics for sizing the cache.
+
+        Returns:
+            (dict) The hits, misses, evictions, size and maxsize.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+    def _evict(self):
+        """Drop the oldest entries until the cache is within its bound."""
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+# Charset detection results keyed on a digest of the bytes examined.
+charset_cache = LRUCache(DEFAULT_CHARSET_CACHE_SIZE)
+
+# Decoded header values keyed on the raw header text.
+header_cache = LRUCache(DEFAULT_HEADER_CACHE_SIZE)
+
+
+class DecodingStats(object):
+
+    """
+    Counters for the decoding hot path. Counts calls, time spent and bytes
+    processed per function, how often a strict decode failed by declared
+    charset, which charsets were then detected and how often chardet
+    itself ran. Safe to share between threads.
+    """
+
+    def __init__(self, callback=None):
+        """Initialize instance of DecodingStats.
+
+        Args:
+            callback (callable): Called as `callback(metric, value, tags)`
+                for every count or timing recorded, where tags is a dict.
+                Use it to feed an external metrics system.
+        """
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Zero all of the counters."""
+        with self._lock:
+            self.calls = dict()
+            self.seconds = dict()
+            self.bytes = dict()
+            self.strict_failures = dict()
+            self.detections = dict()
+            self.chardet_calls = 0
+
+    def record_call(self, function, seconds, size):
+        """Record a call to one of the instrumented functions."""
+        with self._lock:
+            self.calls[function] = self.calls.get(function, 0) + 1
+            self.seconds[function] = self.seconds.get(function, 0) + seconds
+            self.bytes[function] = self.bytes.get(function, 0) + size
+        if self.callback is not None:
+            tags = {'function': function}
+            self.callback('calls', 1, tags)
+            self.callback('seconds', seconds, tags)
+            self.callback('bytes', size, tags)
+
+    def record_detection(self, declared, detected):
+        """Record a failed strict decode and the charset detected."""
+        declared = unicode(declared or 'ascii').lower()
+        detected = unicode(detected or 'unknown').lower()
+        with self._lock:
+            self.strict_failures[declared] = \
+                    self.strict_failures.get(declared, 0) + 1
+            key = (declared, detected)
+            self.detections[key] = self.detections.get(key, 0) + 1
+        if self.callback is not None:
+            self.callback('strict_failures', 1, {'declared': declared})
+            self.callback('detections', 1,
+                    {'declared': declared, 'detected': detected})
+
+    def record_chardet(self):
+        """Record a run of chardet."""
+        with self._lock:
+            self.chardet_calls += 1
+        if self.callback is not None:
+            self.callback('chardet_calls', 1, {})
+
+    def as_dict(self):
+        """Get the counters as a plain dictionary. Detections are keyed
+        `declared -> detected`."""
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'seconds': dict(self.seconds),
+                'bytes': dict(self.bytes),
+                'strict_failures': dict(self.strict_failures),
+                'detections': dict(('{0} -> {1}'.format(*key), count) \
+                        for key, count in self.detections.items()),
+                'chardet_calls': self.chardet_calls,
+            }
+
+
+# The active DecodingStats, or `None` when instrumentation is disabled.
+_stats = None
+
+
+def enable_stats(callback=None):
+    """Start collecting decoding statistics. Any previously collected
+    statistics are discarded.
+
+    Args:
+        callback (callable): Called as `callback(metric, value, tags)` for
+            every count or timing recorded.
+
+    Returns:
+        (DecodingStats) The statistics being collected.
+    """
+    global _stats
+    _stats = DecodingStats(callback)
+    return _stats
+
+def disable_stats():
+    """Stop collecting decoding statistics."""
+    global _stats
+    _stats = None
+
+def get_stats():
+    """Get the decoding statistics collected so far.
+
+    Returns:
+        (dict) The statistics or `None` if they are not being collected.
+    """
+    stats = _stats
+    if stats is None:
+        return None
+    return stats.as_dict()
 
 
 def get_decoded_email_header(text):
@@ -18,15 +288,129 @@ def get_decoded_email_header(text):
     Returns:
         (unicode) The UTF-8 unicode representation for the header.
     """
+    stats = _stats
+    if stats is None:
+        return _get_decoded_email_header(text)
+    start = default_timer()
+    try:
+        return _get_decoded_email_header(text)
+    finally:
+        stats.record_call('get_decoded_email_header',
+                default_timer() - start, len(text))
+
+def _get_decoded_email_header(text):
+    """Implement `get_decoded_email_header`."""
+    cacheable = header_cache.maxsize > 0 \
+            and len(text) <= HEADER_CACHE_MAX_LENGTH
+    if cacheable:
+        decoded = header_cache.get(text)
+        if decoded is not None:
+            return decoded
     # Some email generation code creates invalid RFC-2047 headers
-    # which do not include the required white-space separator. Attempt
-    # to fix these using a simple regex substitution.
-    text = re.sub(r"(=\?.*\?[BbQq]\?.*\?=)(?!$)", r"\1 ", text)
-    parts = decode_header(text)
+    # which do not include the required white-space separator after an
+    # encoded word. Add the separator wherever it is missing.
+    parts = decode_header(_UNSEPARATED_ENCODED_WORD_RE.sub(r"\g<0> ", text))
     decoded_parts = []
     for part, charset in parts:
         decoded_parts.append(decode_string_to_unicode(part, charset))
-    return "".join(decoded_parts)
+    decoded = "".join(decoded_parts)
+    if cacheable:
+        header_cache.put(text, decoded)
+    return decoded
+
+def decode_headers_batch(texts):
+    """Decode many email headers at once. Each distinct header is decoded
+    only once and the encoded words of all of them are decoded grouped by
+    charset, so each codec is looked up once per batch. The results are
+    the same as calling `get_decoded_email_header` on each header.
+
+    Args:
+        texts (iterable): RFC-2047 encoded header texts.
+
+    Returns:
+        (list) The decoded unicode values in the same order as `texts`.
+    """
+    texts = list(texts)
+    stats = _stats
+    if stats is None:
+        return _decode_headers_batch(texts)
+    start = default_timer()
+    try:
+        return _decode_headers_batch(texts)
+    finally:
+        stats.record_call('decode_headers_batch', default_timer() - start,
+                sum(len(text) for text in texts))
+
+def iter_decoded_headers(texts, batch_size=DEFAULT_HEADER_BATCH_SIZE):
+    """Decode an unbounded stream of email headers with
+    `decode_headers_batch`, `batch_size` headers at a time.
+
+    Args:
+        texts (iterable): RFC-2047 encoded header texts.
+        batch_size (int): Number of headers decoded together. Duplicates
+            are only found within a batch.
+
+    Returns:
+        (generator) The decoded unicode values in the same order as
+        `texts`.
+    """
+    iterator = iter(texts)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        for decoded in decode_headers_batch(batch):
+            yield decoded
+
+def _decode_headers_batch(texts):
+    """Implement `decode_headers_batch`."""
+    cacheable = header_cache.maxsize > 0
+    decoded = dict()
+    # The parts of each distinct header not already cached, and where
+    # each encoded word is found keyed on its charset.
+    parts = OrderedDict()
+    groups = defaultdict(list)
+    for text in texts:
+        if text in decoded or text in parts:
+            continue
+        if cacheable and len(text) <= HEADER_CACHE_MAX_LENGTH:
+            value = header_cache.get(text)
+            if value is not None:
+                decoded[text] = value
+                continue
+        text_parts = decode_header(
+                _UNSEPARATED_ENCODED_WORD_RE.sub(r"\g<0> ", text))
+        parts[text] = text_parts
+        for index, (part, charset) in enumerate(text_parts):
+            groups[charset].append((text_parts, index))
+    for charset, words in groups.items():
+        _decode_charset_group(charset, words)
+    for text, text_parts in parts.items():
+        value = "".join(text_parts)
+        decoded[text] = value
+        if cacheable and len(text) <= HEADER_CACHE_MAX_LENGTH:
+            header_cache.put(text, value)
+    return [decoded[text] for text in texts]
+
+def _decode_charset_group(charset, words):
+    """Decode, in place, every encoded word in `words`, given as (parts,
+    index) pairs, which is declared as `charset`."""
+    try:
+        decode = codecs.getdecoder(charset or 'ascii')
+    except LookupError:
+        decode = None
+    for text_parts, index in words:
+        part = text_parts[index][0]
+        if isinstance(part, unicode):
+            text_parts[index] = part
+            continue
+        if decode is not None:
+            try:
+                text_parts[index] = decode(part, 'strict')[0]
+                continue
+            except UnicodeError:
+                pass
+        text_parts[index] = decode_string_to_unicode(part, charset)
 
 def decode_string_to_unicode(text, charset=None):
     """Get the unicode value of text using provided charset. If the charset
@@ -39,13 +423,295 @@ def decode_string_to_unicode(text, charset=None):
     Returns:
         (unicode) The decoded unicode value.
     """
+    return decode_with_charset(text, charset)[0]
+
+def decode_with_charset(text, charset=None, prior=None):
+    """Decode text as `decode_string_to_unicode` does, also reporting which
+    charset decoded it. If the declared charset fails `prior`, a charset
+    expected from experience, is tried with a strict decode before falling
+    back to detection.
+
+    Args:
+        text (string): The string we want to decode.
+        charset (string): The charset we think this is. Defaults to ascii.
+        prior (string): Charset to try before detection.
+
+    Returns:
+        (tuple) The decoded unicode value and the charset which decoded it
+        strictly, or `None` if invalid input had to be replaced or `text`
+        was already unicode.
+    """
+    stats = _stats
+    if stats is None:
+        return _decode_with_charset(text, charset, prior)
+    start = default_timer()
     try:
-        if isinstance(text, unicode):
-            return text
-        return text.decode(charset or 'ascii', 'strict')
+        return _decode_with_charset(text, charset, prior)
+    finally:
+        stats.record_call('decode_string_to_unicode',
+                default_timer() - start, len(text))
+
+def _decode_with_charset(text, charset, prior):
+    """Implement `decode_with_charset`."""
+    if isinstance(text, unicode):
+        return text, None
+    try:
+        return text.decode(charset or 'ascii', 'strict'), charset or 'ascii'
+    except (UnicodeError, LookupError):
+        pass
+    if prior and prior != charset:
+        try:
+            decoded = text.decode(prior, 'strict')
+        except (UnicodeError, LookupError):
+            pass
+        else:
+            stats = _stats
+            if stats is not None:
+                stats.record_detection(charset, prior)
+            return decoded, prior
+    detected = detect_charset(text)
+    stats = _stats
+    if stats is not None:
+        stats.record_detection(charset, detected)
+    try:
+        return text.decode(detected or 'ascii', 'strict'), detected
     except (UnicodeError, LookupError):
-        charset = chardet.detect(text)
-        return text.decode(charset['encoding'], 'replace')
+        return text.decode(detected or 'ascii', 'replace'), None
+
+def iter_decoded_chunks(source, charset=None, chunk_size=DECODE_CHUNK_SIZE):
+    """Decode the bytes read from `source` a chunk at a time with an
+    incremental decoder, so a large body is never held whole as bytes.
+
+    The body is decoded strictly as `charset` until that fails. Whatever
+    was decoded up to that point is kept and the charset of the rest is
+    detected from the bytes that follow, which are then decoded as the
+    detected charset without reading the body again. Once a charset is
+    detected a second time invalid input is replaced rather than
+    switching again.
+
+    Args:
+        source (file): File-like object to read the bytes from.
+        charset (string): The declared charset. Defaults to ascii.
+        chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+        (generator) Unicode chunks of the body.
+    """
+    tried = set([_get_codec_name(charset)])
+    decoder = _get_incremental_decoder(charset, 'strict')
+    invalid = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if decoder is None:
+            decoder, charset, chunk = _get_fallback_decoder(charset, chunk,
+                    source, tried, invalid)
+        done = not chunk
+        try:
+            text = decoder.decode(chunk, done)
+        except UnicodeDecodeError as error:
+            text = _decode_before_error(decoder, error, chunk)
+            # Decode what is left of the chunk with the next decoder on
+            # the following pass.
+            decoder = None
+            source = _PrefixedReader(error.object[error.start:], source)
+            invalid = error.end - error.start
+            done = False
+        except UnicodeError:
+            # Some decoders fail without a position, such as utf-16 on a
+            # stream without a byte order mark, so the bytes not decoded
+            # yet are decoded afresh. A replacing decoder failing like
+            # this gives way to ascii rather than detecting again.
+            pending = getattr(decoder, 'buffer', b'') + chunk
+            if decoder.errors == 'strict':
+                decoder = None
+            else:
+                decoder = _get_incremental_decoder('ascii', 'replace')
+            source = _PrefixedReader(pending, source)
+            invalid = 0
+            text = ''
+            done = False
+        if text:
+            yield text
+        if done:
+            return
+
+def decode_stream(source, charset=None, chunk_size=DECODE_CHUNK_SIZE):
+    """Decode the bytes read from `source` with `iter_decoded_chunks`.
+
+    Args:
+        source (file): File-like object to read the bytes from.
+        charset (string): The declared charset. Defaults to ascii.
+        chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+        (unicode) The decoded body.
+    """
+    return "".join(iter_decoded_chunks(source, charset, chunk_size))
+
+def transcode_to_utf8(source, output, charset=None,
+        chunk_size=DECODE_CHUNK_SIZE):
+    """Transcode the bytes read from `source` to UTF-8 written to `output`
+    a chunk at a time, without building the whole unicode body.
+
+    Args:
+        source (file): File-like object to read the bytes from.
+        output (file): File-like object to write the UTF-8 bytes to.
+        charset (string): The declared charset. Defaults to ascii.
+        chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+        (int) The number of bytes written.
+    """
+    size = 0
+    for text in iter_decoded_chunks(source, charset, chunk_size):
+        data = text.encode('utf-8')
+        output.write(data)
+        size += len(data)
+    return size
+
+def _get_incremental_decoder(charset, errors):
+    """Get an incremental decoder for `charset` or `None` if the charset
+    is unknown."""
+    try:
+        return codecs.getincrementaldecoder(charset or 'ascii')(errors)
+    except LookupError:
+        return None
+
+def _get_codec_name(charset):
+    """Get the canonical name of `charset`, or `charset` if unknown."""
+    try:
+        return codecs.lookup(charset or 'ascii').name
+    except LookupError:
+        return charset
+
+def _get_fallback_decoder(declared, data, source, tried, invalid=0):
+    """Detect the charset of `data`, reading ahead from `source` to give
+    the detector up to `DETECTION_BYTE_BUDGET` bytes. If everything after
+    the first `invalid` bytes, which `declared` rejected, is valid
+    `declared` those bytes are taken to be stray and `declared` is kept.
+    The decoder is strict unless the charset is in `tried`, which it is
+    added to.
+
+    Returns:
+        (tuple) The decoder, the detected charset and the bytes to decode,
+        including those read ahead.
+    """
+    if len(data) < DETECTION_BYTE_BUDGET:
+        data += source.read(DETECTION_BYTE_BUDGET - len(data))
+    if invalid and _is_valid_prefix(declared, data[invalid:]):
+        detected = declared
+    else:
+        detected = detect_charset(data)
+    stats = _stats
+    if stats is not None:
+        stats.record_detection(declared, detected)
+    name = _get_codec_name(detected)
+    errors = 'replace' if name in tried else 'strict'
+    tried.add(name)
+    decoder = _get_incremental_decoder(detected, errors) \
+            or _get_incremental_decoder('ascii', 'replace')
+    return decoder, detected, data
+
+def _is_valid_prefix(charset, data):
+    """Return whether or not `data` is valid `charset`, allowing it to end
+    part way through a character."""
+    decoder = _get_incremental_decoder(charset, 'strict')
+    try:
+        decoder.decode(data)
+    except UnicodeError:
+        return False
+    return True
+
+def _decode_before_error(decoder, error, chunk):
+    """Decode the bytes of `chunk` before the position `decoder` failed
+    at. Buffered decoders keep their pending bytes after an error, and the
+    error's position includes them, while the multibyte CJK decoders drop
+    them but include them in the error's input."""
+    if isinstance(decoder, codecs.BufferedIncrementalDecoder):
+        data = chunk[:max(0, error.start - len(decoder.buffer))]
+    else:
+        data = error.object[:error.start]
+    try:
+        return decoder.decode(data)
+    except UnicodeDecodeError:
+        return ""
+
+
+class _PrefixedReader(object):
+
+    """
+    File-like reader returning `prefix` before the rest of `source`.
+    """
+
+    def __init__(self, prefix, source):
+        self.prefix = prefix
+        self.source = source
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.source.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.source.read(), b''
+        elif size <= len(self.prefix):
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        else:
+            data, self.prefix = self.prefix + \
+                    self.source.read(size - len(self.prefix)), b''
+        return data
+
+
+def detect_charset(text):
+    """Guess the charset of `text`.
+
+    Cheap checks are tried first: a byte order mark, pure ASCII, strict
+    UTF-8 and then each of `LEGACY_CHARSETS`. Only when all of those fail
+    is chardet consulted, and then only on the first
+    `DETECTION_BYTE_BUDGET` bytes. chardet results are remembered in
+    `charset_cache` so repeated strings are only examined once.
+
+    Args:
+        text (string): The bytes to examine.
+
+    Returns:
+        (unicode) The name of the charset or `None` if it is unknown.
+    """
+    charset = _detect_charset_fast(text)
+    if charset is not None:
+        return charset
+    key = hashlib.sha1(text).digest()
+    charset = charset_cache.get(key, _MISSING)
+    if charset is _MISSING:
+        charset = _detect_charset_chardet(text)
+        charset_cache.put(key, charset)
+    return charset
+
+def _detect_charset_fast(text):
+    """Try the cheap charset checks returning `None` if all fail."""
+    for bom, charset in BYTE_ORDER_MARKS:
+        if text.startswith(bom):
+            return charset
+    for charset in ['ascii', 'utf-8'] + LEGACY_CHARSETS:
+        try:
+            text.decode(charset, 'strict')
+        except (UnicodeError, LookupError):
+            continue
+        return charset
+    return None
+
+def _detect_charset_chardet(text):
+    """Feed chardet a block at a time stopping once it is confident or
+    the byte budget is spent."""
+    stats = _stats
+    if stats is not None:
+        stats.record_chardet()
+    detector = UniversalDetector()
+    end = min(len(text), DETECTION_BYTE_BUDGET)
+    for start in xrange(0, end, DETECTION_BLOCK_SIZE):
+        detector.feed(text[start:min(start + DETECTION_BLOCK_SIZE, end)])
+        if detector.done:
+            break
+    detector.close()
+    return detector.result['encoding']
 
 def get_charset(message):
     """Get the charset defined for the message.
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Export normalized messages. Messages are written one record at a time
+either as JSON lines or in a compact length-prefixed binary format, and
+read back one record at a time. Records match `UnicodeMessage.as_dict()`
+except that attachment content is read back as a file handle, spooled to
+disk once it is large, rather than a string.
+"""
+from __future__ import unicode_literals
+
+import base64
+import json
+import struct
+
+import email_cleanse.message
+from email_cleanse.content import SpooledContent
+
+
+# Size of the chunks of attachment content copied to the output. A
+# multiple of three so full chunks base64 encode without carrying bytes
+# over to the next chunk.
+EXPORT_CHUNK_SIZE = 48 * 1024
+
+# Marks the start of a file in the binary format.
+BINARY_MAGIC = b'ECMSG\x01'
+
+_UINT32 = struct.Struct(b'>I')
+
+
+def write_jsonl(messages, fp):
+    """Write messages to `fp` as JSON lines. Attachment content is base64
+    encoded and copied from its file handle a chunk at a time.
+
+    Args:
+        messages (iterable): UnicodeMessage objects.
+        fp (file): The file handle to write to.
+
+    Returns:
+        (int) The number of messages written.
+    """
+    count = 0
+    for message in messages:
+        fp.write(b'{"headers": ')
+        fp.write(json.dumps(list(message.headers)))
+        fp.write(b', "alternatives": ')
+        fp.write(json.dumps(list(message.alternatives)))
+        fp.write(b', "attachments": [')
+        for number, attachment in enumerate(message.attachments):
+            if number:
+                fp.write(b', ')
+            fp.write(b'{"headers": ')
+            fp.write(json.dumps(list(attachment.headers)))
+            fp.write(b', "content": "')
+            # Only whole groups of three bytes are encoded until the end,
+            # as content may be read in chunks of any size.
+            remainder = b''
+            for chunk in attachment.iter_content(EXPORT_CHUNK_SIZE):
+                chunk = remainder + chunk
+                whole = len(chunk) - len(chunk) % 3
+                fp.write(base64.b64encode(chunk[:whole]))
+                remainder = chunk[whole:]
+            fp.write(base64.b64encode(remainder))
+            fp.write(b'"}')
+        fp.write(b']}\n')
+        count += 1
+    return count
+
+def iter_jsonl(fp):
+    """Read records written by `write_jsonl` one line at a time.
+    Attachment content is decoded a chunk at a time into a spooled file.
+
+    Args:
+        fp (file): The file handle to read from.
+
+    Returns:
+        (generator) Dictionaries in the form of `UnicodeMessage.as_dict()`.
+    """
+    for line in fp:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        yield {
+            'headers': [tuple(header) for header in record['headers']],
+            'alternatives': [tuple(alternative) \
+                    for alternative in record['alternatives']],
+            'attachments': [{
+                    'headers': [tuple(header) \
+                            for header in attachment['headers']],
+                    'content': _spool(_iter_base64(attachment['content'])),
+                } for attachment in record['attachments']],
+        }
+
+def write_binary(messages, fp):
+    """Write messages to `fp` in the binary format.
+
+    Each record holds counted lists of headers, alternatives and
+    attachments. Strings are UTF-8 encoded with a 32-bit length prefix.
+    Attachment content is copied from its file handle as a series of
+    length-prefixed chunks ended by an empty chunk, so its size need not
+    be known up front.
+
+    Args:
+        messages (iterable): UnicodeMessage objects.
+        fp (file): The file handle to write to.
+
+    Returns:
+        (int) The number of messages written.
+    """
+    fp.write(BINARY_MAGIC)
+    count = 0
+    for message in messages:
+        _write_pairs(fp, list(message.headers))
+        _write_pairs(fp, list(message.alternatives))
+        attachments = list(message.attachments)
+        fp.write(_UINT32.pack(len(attachments)))
+        for attachment in attachments:
+            _write_pairs(fp, list(attachment.headers))
+            for chunk in attachment.iter_content(EXPORT_CHUNK_SIZE):
+                fp.write(_UINT32.pack(len(chunk)))
+                fp.write(chunk)
+            fp.write(_UINT32.pack(0))
+        count += 1
+    return count
+
+def iter_binary(fp):
+    """Read records written by `write_binary` one at a time.
+    Attachment content is copied a chunk at a time into a spooled file.
+
+    Args:
+        fp (file): The file handle to read from.
+
+    Returns:
+        (generator) Dictionaries in the form of `UnicodeMessage.as_dict()`.
+
+    Raises:
+        ValueError: If the file is not in the binary format or is truncated.
+    """
+    if fp.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError('Not an email_cleanse binary export')
+    while True:
+        prefix = fp.read(_UINT32.size)
+        if not prefix:
+            return
+        headers = _read_pairs(fp, _unpack(prefix))
+        alternatives = _read_pairs(fp, _read_uint32(fp))
+        attachments = []
+        for _ in xrange(_read_uint32(fp)):
+            attachment_headers = _read_pairs(fp, _read_uint32(fp))
+            attachments.append({
+                'headers': attachment_headers,
+                'content': _spool(_iter_binary_chunks(fp)),
+            })
+        yield {
+            'headers': headers,
+            'alternatives': alternatives,
+            'attachments': attachments,
+        }
+
+def _iter_base64(encoded):
+    """Decode base64 content in chunks of whole groups of four."""
+    step = EXPORT_CHUNK_SIZE // 3 * 4
+    for offset in xrange(0, len(encoded), step):
+        yield base64.b64decode(encoded[offset:offset + step])
+
+def _iter_binary_chunks(fp):
+    """Read length-prefixed chunks of content up to the empty chunk."""
+    size = _read_uint32(fp)
+    while size:
+        yield _read_exactly(fp, size)
+        size = _read_uint32(fp)
+
+def _spool(chunks):
+    """Copy chunks of attachment content to a spooled file."""
+    content = SpooledContent(email_cleanse.message.SPOOL_MAX_SIZE,
+            email_cleanse.message.SPOOL_DIR)
+    for chunk in chunks:
+        content.write(chunk)
+    content.seek(0)
+    return content
+
+def _write_pairs(fp, pairs):
+    """Write a counted list of unicode pairs."""
+    fp.write(_UINT32.pack(len(pairs)))
+    for first, second in pairs:
+        for text in (first, second):
+            data = text.encode('utf-8')
+            fp.write(_UINT32.pack(len(data)))
+            fp.write(data)
+
+def _read_pairs(fp, count):
+    """Read `count` unicode pairs."""
+    pairs = []
+    for _ in xrange(count):
+        first = _read_exactly(fp, _read_uint32(fp)).decode('utf-8')
+        second = _read_exactly(fp, _read_uint32(fp)).decode('utf-8')
+        pairs.append((first, second))
+    return pairs
+
+def _read_uint32(fp):
+    """Read a 32-bit length."""
+    return _unpack(_read_exactly(fp, _UINT32.size))
+
+def _unpack(data):
+    """Unpack a 32-bit length."""
+    if len(data) != _UINT32.size:
+        raise ValueError('Truncated email_cleanse binary export')
+    return _UINT32.unpack(data)[0]
+
+def _read_exactly(fp, size):
+    """Read exactly `size` bytes."""
+    data = fp.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated email_cleanse binary export')
+    return data
@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search index. An on-disk inverted index over the subject, sender
+and text bodies of normalized messages. Messages are appended in segments:
+each flush writes a new immutable segment of compact posting lists and
+segments are merged as they accumulate.
+
+Queries are words, "quoted phrases" and `field:` prefixed terms combined
+with AND (implied between terms), OR, NOT or a leading `-`, and grouped
+with parentheses::
+
+    subject:"annual report" AND (from:bob OR from:alice) -draft
+"""
+from __future__ import unicode_literals
+
+import json
+import mmap
+import os
+import re
+import tempfile
+import threading
+from collections import defaultdict
+
+
+# Fields indexed for each message.
+FIELDS = ('subject', 'from', 'body')
+
+# Number of messages buffered in memory before they are written out as a
+# segment.
+DEFAULT_FLUSH_SIZE = 10000
+
+# Number of segments which may accumulate before they are merged into one.
+MAX_SEGMENTS = 16
+
+# Name of the file listing the segments of an index.
+MANIFEST_NAME = 'segments.json'
+
+# Matches the words which are indexed.
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Matches an HTML tag, stripped from HTML bodies before indexing.
+_TAG_RE = re.compile(r'<[^>]*>')
+
+# Matches the tokens of a query: parentheses, quoted phrases and anything
+# else up to white-space.
+_QUERY_TOKEN_RE = re.compile(r'\(|\)|"[^"]*"?|[^\s()"]+(?:"[^"]*"?)?',
+        re.UNICODE)
+
+
+class SearchIndex(object):
+
+    """
+    Inverted index stored in the directory `path`. Messages are searchable
+    once they have been flushed, which `add` does every `flush_size`
+    messages and `close` does for the rest. Safe to share between threads.
+    """
+
+    def __init__(self, path, flush_size=DEFAULT_FLUSH_SIZE):
+        """Initialize instance of SearchIndex, opening the index in `path`
+        or creating an empty one.
+
+        Args:
+            path (string): Directory holding the index.
+            flush_size (int): Number of messages buffered before a segment
+                is written.
+        """
+        self.path = path
+        self.flush_size = flush_size
+        self._lock = threading.RLock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        manifest = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as fp:
+                self._manifest = json.load(fp)
+        else:
+            self._manifest = {'next_doc': 0, 'next_segment': 0,
+                    'segments': []}
+        self._segments = [_Segment(path, name)
+                for name in self._manifest['segments']]
+        self._reset_pending()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._manifest['next_doc'] + len(self._pending_docs)
+
+    def add(self, message, key=None):
+        """Index a message. It becomes searchable once flushed.
+
+        Args:
+            message (UnicodeMessage): The normalized message.
+            key (unicode): Stored with the message to identify it in
+                results. Defaults to its Message-Id.
+
+        Returns:
+            (int) The document number of the message.
+        """
+        subject = message.get_header('Subject', '')
+        sender = message.get_header('From', '')
+        fields = (('subject', [subject]), ('from', [sender]),
+                ('body', _iter_bodies(message)))
+        with self._lock:
+            doc = self._manifest['next_doc'] + len(self._pending_docs)
+            for field, values in fields:
+                position = 0
+                for value in values:
+                    for word in _tokenize(value):
+                        self._pending[field + ':' + word][doc].append(
+                                position)
+                        position += 1
+                    # Leave a gap so phrases do not match across values.
+                    position += 1
+            self._pending_docs.append([
+                    key if key is not None
+                    else message.get_header('Message-Id', ''),
+                    subject, sender])
+            if len(self._pending_docs) >= self.flush_size:
+                self.flush()
+            return doc
+
+    def flush(self):
+        """Write the buffered messages out as a new segment, merging the
+        segments if too many have accumulated."""
+        with self._lock:
+            if not self._pending_docs:
+                return
+            first = self._manifest['next_doc']
+            postings = ((term, sorted(docs.items()))
+                    for term, docs in self._pending.items())
+            name = self._write_segment(first, self._pending_docs, postings)
+            self._segments.append(_Segment(self.path, name))
+            self._manifest['next_doc'] = first + len(self._pending_docs)
+            self._reset_pending()
+            if len(self._segments) > MAX_SEGMENTS:
+                self.merge()
+            else:
+                self._save_manifest()
+
+    def merge(self):
+        """Merge every segment into one, which speeds up queries."""
+        with self._lock:
+            if len(self._segments) < 2:
+                return
+            old = self._segments
+            terms = sorted(set(term for segment in old
+                    for term in segment.terms))
+            docs = [entry for segment in old for entry in segment.docs]
+            postings = ((term, [posting for segment in old
+                    for posting in segment.postings(term)])
+                    for term in terms)
+            name = self._write_segment(old[0].first, docs, postings)
+            self._segments = [_Segment(self.path, name)]
+            self._save_manifest()
+            for segment in old:
+                segment.close()
+                segment.remove()
+
+    def search(self, query, limit=None):
+        """Find the flushed messages matching a query.
+
+        Args:
+            query (unicode): The query.
+            limit (int): Maximum number of results. Defaults to all.
+
+        Returns:
+            (list) Document numbers of the matching messages, oldest
+            first.
+
+        Raises:
+            ValueError: If the query is malformed.
+        """
+        node = _QueryParser(query).parse()
+        results = []
+        with self._lock:
+            for segment in self._segments:
+                results.extend(sorted(segment.evaluate(node)))
+                if limit is not None and len(results) >= limit:
+                    return results[:limit]
+        return results
+
+    def document(self, doc):
+        """Get the fields stored for a flushed message.
+
+        Args:
+            doc (int): The document number.
+
+        Returns:
+            (dict) The key, subject and from of the message.
+
+        Raises:
+            KeyError: If there is no such flushed message.
+        """
+        with self._lock:
+            for segment in self._segments:
+                if segment.first <= doc < segment.first + len(segment.docs):
+                    key, subject, sender = segment.docs[doc - segment.first]
+                    return {'key': key, 'subject': subject, 'from': sender}
+        raise KeyError(doc)
+
+    def close(self):
+        """Flush the buffered messages and close the segments."""
+        with self._lock:
+            self.flush()
+            for segment in self._segments:
+                segment.close()
+
+    def _reset_pending(self):
+        """Empty the buffer of messages not yet flushed."""
+        self._pending = defaultdict(lambda: defaultdict(list))
+        self._pending_docs = []
+
+    def _write_segment(self, first, docs, postings):
+        """Write a segment holding `docs`, numbered from `first`, and the
+        `(term, [(doc, positions), ...])` pairs of `postings`.
+
+        Returns:
+            (unicode) The name of the segment.
+        """
+        name = 'segment{0:06d}'.format(self._manifest['next_segment'])
+        self._manifest['next_segment'] += 1
+        terms = {}
+        base = os.path.join(self.path, name)
+        with open(base + '.postings', 'wb') as fp:
+            offset = 0
+            for term, entries in postings:
+                data = _encode_postings(entries)
+                fp.write(data)
+                terms[term] = [offset, len(data), len(entries)]
+                offset += len(data)
+        with open(base + '.terms', 'w') as fp:
+            json.dump(terms, fp, separators=(',', ':'))
+        with open(base + '.docs', 'w') as fp:
+            json.dump({'first': first, 'docs': docs}, fp,
+                    separators=(',', ':'))
+        return name
+
+    def _save_manifest(self):
+        """Replace the manifest atomically, making the current segments
+        the index."""
+        self._manifest['segments'] = [segment.name
+                for segment in self._segments]
+        with tempfile.NamedTemporaryFile('w', dir=self.path, delete=False,
+                prefix='.segments') as fp:
+            json.dump(self._manifest, fp)
+        os.rename(fp.name, os.path.join(self.path, MANIFEST_NAME))
+
+
+class _Segment(object):
+
+    """
+    Immutable part of an index: a term dictionary, the posting lists it
+    points into, mapped into memory, and the stored fields of its
+    messages.
+    """
+
+    def __init__(self, path, name):
+        self.name = name
+        self._base = os.path.join(path, name)
+        with open(self._base + '.terms', 'r') as fp:
+            self.terms = json.load(fp)
+        with open(self._base + '.docs', 'r') as fp:
+            stored = json.load(fp)
+        self.first = stored['first']
+        self.docs = stored['docs']
+        self._fp = open(self._base + '.postings', 'rb')
+        if os.path.getsize(self._base + '.postings'):
+            self._postings = mmap.mmap(self._fp.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        else:
+            self._postings = b''
+
+    def postings(self, term, positions=True):
+        """Get the `(doc, positions)` pairs of a term, in document order.
+        Positions are `None` unless asked for."""
+        entry = self.terms.get(term)
+        if entry is None:
+            return []
+        offset, length, _ = entry
+        return _decode_postings(self._postings[offset:offset + length],
+                positions)
+
+    def evaluate(self, node):
+        """Get the set of document numbers in this segment matching a
+        parsed query."""
+        kind = node[0]
+        if kind == 'and':
+            matches = self.evaluate(node[1])
+            return matches & self.evaluate(node[2]) if matches else matches
+        if kind == 'or':
+            return self.evaluate(node[1]) | self.evaluate(node[2])
+        if kind == 'not':
+            return set(range(self.first, self.first + len(self.docs))) - \
+                    self.evaluate(node[1])
+        fields, words = node[1], node[2]
+        matches = set()
+        for field in fields:
+            if len(words) == 1:
+                matches.update(doc for doc, _ in
+                        self.postings(field + ':' + words[0], False))
+            elif words:
+                matches.update(self._match_phrase(field, words))
+        return matches
+
+    def close(self):
+        """Release the mapped posting lists."""
+        if isinstance(self._postings, mmap.mmap):
+            self._postings.close()
+        self._fp.close()
+
+    def remove(self):
+        """Delete the files of the segment."""
+        for extension in ('.postings', '.terms', '.docs'):
+            os.remove(self._base + extension)
+
+    def _match_phrase(self, field, words):
+        """Yield the documents where `words` appear consecutively in
+        `field`."""
+        # Start from the rarest word to keep the candidates few.
+        order = sorted(range(len(words)), key=lambda index:
+                self.terms.get(field + ':' + words[index], (0, 0, 0))[2])
+        postings = [None] * len(words)
+        candidates = None
+        for index in order:
+            postings[index] = dict(self.postings(field + ':' + words[index]))
+            if candidates is None:
+                candidates = set(postings[index])
+            else:
+                candidates &= set(postings[index])
+            if not candidates:
+                return
+        for doc in candidates:
+            following = [set(positions[doc]) for positions in postings[1:]]
+            for start in postings[0][doc]:
+                if all(start + index + 1 in positions
+                        for index, positions in enumerate(following)):
+                    yield doc
+                    break
+
+
+class _QueryParser(object):
+
+    """
+    Recursive descent parser turning a query into nested tuples:
+    `('and'|'or', left, right)`, `('not', node)` and
+    `('term', fields, words)`, a phrase when there is more than one word.
+    """
+
+    def __init__(self, query):
+        self.tokens = _QUERY_TOKEN_RE.findall(query)
+        self.index = 0
+
+    def parse(self):
+        """Parse the whole query."""
+        if not self.tokens:
+            raise ValueError('Empty query')
+        node = self._or()
+        if self.index < len(self.tokens):
+            raise ValueError('Unexpected {0!r} in query'.format(
+                    self.tokens[self.index]))
+        return node
+
+    def _peek(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError('Unexpected end of query')
+        self.index += 1
+        return token
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == 'OR':
+            self.index += 1
+            node = ('or', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peek() not in (None, 'OR', ')'):
+            if self._peek() == 'AND':
+                self.index += 1
+            node = ('and', node, self._not())
+        return node
+
+    def _not(self):
+        token = self._peek()
+        if token == 'NOT':
+            self.index += 1
+            return ('not', self._not())
+        if token is not None and len(token) > 1 and token.startswith('-'):
+            self.tokens[self.index] = token[1:]
+            return ('not', self._not())
+        return self._atom()
+
+    def _atom(self):
+        token = self._next()
+        if token == '(':
+            node = self._or()
+            if self._next() != ')':
+                raise ValueError('Unbalanced parentheses in query')
+            return node
+        if token == ')':
+            raise ValueError('Unbalanced parentheses in query')
+        fields = FIELDS
+        name, separator, rest = token.partition(':')
+        if separator and name.lower() in FIELDS:
+            fields = (name.lower(),)
+            token = rest or self._next()
+        return ('term', fields, tuple(_tokenize(token.strip('"'))))
+
+
+def _tokenize(text):
+    """Split text into the lower case words which are indexed."""
+    return [word.lower() for word in _WORD_RE.findall(text or '')]
+
+def _iter_bodies(message):
+    """Yield the text of the plain alternatives of `message`, or of its
+    HTML alternatives with tags stripped if it has no plain text."""
+    alternatives = message.alternatives
+    plain = [body for content_type, body in alternatives
+            if content_type == 'text/plain']
+    if plain:
+        for body in plain:
+            yield body
+        return
+    for content_type, body in alternatives:
+        yield _TAG_RE.sub(' ', body) if content_type == 'text/html' \
+                else body
+
+def _encode_varint(value, output):
+    """Append `value` to the bytearray `output` 7 bits per byte, low bits
+    first, with the high bit set on all but the last byte."""
+    while value > 0x7f:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+
+def _encode_postings(entries):
+    """Encode `(doc, positions)` pairs, in document order, as varint
+    deltas: the document, the number of positions and each position."""
+    output = bytearray()
+    previous = 0
+    for doc, positions in entries:
+        _encode_varint(doc - previous, output)
+        previous = doc
+        _encode_varint(len(positions), output)
+        last = 0
+        for position in positions:
+            _encode_varint(position - last, output)
+            last = position
+    return bytes(output)
+
+def _decode_postings(data, positions=True):
+    """Decode posting lists written by `_encode_postings`.
+
+    Returns:
+        (list) `(doc, positions)` pairs. Positions are `None` unless
+        `positions` is true.
+    """
+    data = bytearray(data)
+    entries = []
+    index = 0
+    doc = 0
+    while index < len(data):
+        delta, index = _decode_varint(data, index)
+        count, index = _decode_varint(data, index)
+        doc += delta
+        if not positions:
+            # Skip over the positions counting their last bytes.
+            while count:
+                if data[index] < 0x80:
+                    count -= 1
+                index += 1
+            entries.append((doc, None))
+            continue
+        decoded = []
+        position = 0
+        for _ in range(count):
+            delta, index = _decode_varint(data, index)
+            position += delta
+            decoded.append(position)
+        entries.append((doc, decoded))
+    return entries
+
+def _decode_varint(data, index):
+    """Decode the varint starting at `index` of the bytearray `data`.
+
+    Returns:
+        (tuple) The value and the index following it.
+    """
+    value = shift = 0
+    while True:
+        byte = data[index]
+        index += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, index
+        shift += 7
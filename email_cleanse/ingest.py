@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Normalize mail as it arrives. `Normalizer` runs normalization on a pool
+so callers never block on chardet or header decoding, and `LMTPServer` is
+a small LMTP (RFC-2033) front end to put behind an MTA.
+"""
+from __future__ import unicode_literals
+
+import socket
+import SocketServer
+import threading
+from multiprocessing.pool import ThreadPool
+
+from email_cleanse.budget import get_budget
+from email_cleanse.reader import message_from_string
+
+
+# Number of threads used by a Normalizer created without a pool.
+DEFAULT_WORKERS = 4
+
+# Maximum number of LMTP connections served at once. Further connections
+# are refused with a temporary error.
+DEFAULT_MAX_CONNECTIONS = 32
+
+# Maximum number of messages being normalized at once. Once their DATA has
+# been read clients wait for a slot, which pushes back on the MTA.
+DEFAULT_MAX_PENDING = 64
+
+# Largest message accepted, in bytes.
+DEFAULT_MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# Seconds a message waits for the memory budget to have room before it is
+# refused.
+DEFAULT_INTAKE_TIMEOUT = 30
+
+
+class IntakeThrottled(Exception):
+
+    """
+    Raised by `Normalizer.submit` when the memory budget stays exceeded
+    for longer than the intake timeout.
+    """
+
+
+class Normalizer(object):
+
+    """
+    Normalize raw messages on a pool of workers. Submitting a message
+    returns at once with a result to wait on or a callback to be called.
+    """
+
+    def __init__(self, pool=None, workers=DEFAULT_WORKERS,
+            intake_timeout=DEFAULT_INTAKE_TIMEOUT):
+        """Initialize instance of Normalizer.
+
+        Args:
+            pool (Pool): A `multiprocessing.pool.ThreadPool`, or anything
+                with the same `apply_async`, to normalize on. Defaults to a
+                new ThreadPool.
+            workers (int): Number of threads in the default pool.
+            intake_timeout (float): Seconds a message waits for room in
+                the memory budget before it is refused.
+        """
+        self.intake_timeout = intake_timeout
+        self._owns_pool = pool is None
+        self.pool = ThreadPool(workers) if pool is None else pool
+
+    def submit(self, raw, callback=None):
+        """Normalize a raw message on the pool. If a memory budget is
+        enabled and exceeded this waits up to `intake_timeout` seconds for
+        usage to drop first.
+
+        Args:
+            raw (string): The raw RFC-5322 message.
+            callback (callable): Called with the UnicodeMessage once it is
+                ready.
+
+        Returns:
+            (AsyncResult) Result whose `get` returns the UnicodeMessage or
+            raises the error raised while normalizing.
+
+        Raises:
+            IntakeThrottled: If the memory budget stays exceeded.
+        """
+        budget = get_budget()
+        if budget is not None \
+                and not budget.wait_for_room(self.intake_timeout):
+            raise IntakeThrottled('Memory budget exceeded')
+        return self.pool.apply_async(message_from_string, (raw,),
+                callback=callback)
+
+    def normalize(self, raw, timeout=None):
+        """Normalize a raw message on the pool and wait for the result.
+
+        Args:
+            raw (string): The raw RFC-5322 message.
+            timeout (float): Seconds to wait. Defaults to waiting forever.
+
+        Returns:
+            (UnicodeMessage) The normalized message.
+        """
+        return self.submit(raw).get(timeout)
+
+    def close(self):
+        """Shut down the pool if the Normalizer created it."""
+        if self._owns_pool:
+            self.pool.close()
+            self.pool.join()
+
+
+class LMTPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    """
+    LMTP server which normalizes each message it receives and hands the
+    result to a delivery callback. The reply to DATA is only sent once the
+    message has been normalized and delivered, as LMTP requires.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, deliver, normalizer=None,
+            max_connections=DEFAULT_MAX_CONNECTIONS,
+            max_pending=DEFAULT_MAX_PENDING,
+            max_message_size=DEFAULT_MAX_MESSAGE_SIZE, hostname=None):
+        """Initialize instance of LMTPServer.
+
+        Args:
+            address (tuple): The (host, port) to listen on.
+            deliver (callable): Called as `deliver(message, mail_from,
+                recipients)` with each normalized UnicodeMessage. An
+                exception fails delivery with a temporary error.
+            normalizer (Normalizer): Used to normalize messages. Defaults
+                to a new Normalizer.
+            max_connections (int): Connections served at once.
+            max_pending (int): Messages normalized at once.
+            max_message_size (int): Largest message accepted, in bytes.
+            hostname (unicode): Name used in replies. Defaults to the fully
+                qualified domain name of this host.
+        """
+        self.deliver = deliver
+        self.normalizer = normalizer or Normalizer()
+        self.max_message_size = max_message_size
+        self.hostname = hostname or socket.getfqdn()
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.pending_slots = threading.BoundedSemaphore(max_pending)
+        SocketServer.TCPServer.__init__(self, address, LMTPHandler)
+
+    def process_request(self, request, client_address):
+        # Refuse connections once every slot is taken rather than blocking
+        # the serving loop, which would also keep `shutdown` waiting.
+        if not self.connection_slots.acquire(False):
+            try:
+                request.sendall('421 {0} Too many connections\r\n'.format(
+                        self.hostname).encode('utf-8'))
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request,
+                    client_address)
+        except Exception:
+            self.connection_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request,
+                    client_address)
+        finally:
+            self.connection_slots.release()
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.normalizer.close()
+
+
+class LMTPHandler(SocketServer.StreamRequestHandler):
+
+    """
+    Handle one LMTP session.
+    """
+
+    def handle(self):
+        self.reset()
+        self.reply(220, '{0} LMTP ready'.format(self.server.hostname))
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.strip().partition(b' ')
+            method = getattr(self, 'lmtp_' + command.upper().decode('ascii',
+                    'replace'), None)
+            if method is None:
+                self.reply(500, 'Command not recognized')
+            elif method(argument.strip()) is False:
+                return
+
+    def reply(self, code, text, last=True):
+        """Write a reply line."""
+        separator = ' ' if last else '-'
+        self.wfile.write('{0}{1}{2}\r\n'.format(code, separator,
+                text).encode('utf-8'))
+
+    def reset(self):
+        """Forget the current transaction."""
+        self.mail_from = None
+        self.recipients = []
+
+    def lmtp_LHLO(self, argument):
+        if not argument:
+            self.reply(501, 'Syntax: LHLO hostname')
+            return
+        self.reset()
+        self.reply(250, self.server.hostname, last=False)
+        self.reply(250, 'PIPELINING', last=False)
+        self.reply(250, '8BITMIME', last=False)
+        self.reply(250, 'SIZE {0}'.format(self.server.max_message_size))
+
+    def lmtp_MAIL(self, argument):
+        if not argument.upper().startswith(b'FROM:'):
+            self.reply(501, 'Syntax: MAIL FROM:<address>')
+            return
+        self.reset()
+        self.mail_from = _address(argument[5:])
+        self.reply(250, 'OK')
+
+    def lmtp_RCPT(self, argument):
+        if self.mail_from is None:
+            self.reply(503, 'Need MAIL command')
+        elif not argument.upper().startswith(b'TO:'):
+            self.reply(501, 'Syntax: RCPT TO:<address>')
+        else:
+            self.recipients.append(_address(argument[3:]))
+            self.reply(250, 'OK')
+
+    def lmtp_DATA(self, argument):
+        if not self.recipients:
+            self.reply(503, 'Need RCPT command')
+            return
+        self.reply(354, 'End data with <CR><LF>.<CR><LF>')
+        data = self.read_data()
+        if data is None:
+            return False
+        raw, too_large = data
+        if too_large:
+            status = (552, 'Message too large')
+        else:
+            # Only take a slot once the message is read so that slow
+            # clients do not hold slots while sending.
+            with self.server.pending_slots:
+                status = self.process(raw)
+        # LMTP sends one reply per recipient.
+        for _ in self.recipients:
+            self.reply(*status)
+        self.reset()
+
+    def lmtp_RSET(self, argument):
+        self.reset()
+        self.reply(250, 'OK')
+
+    def lmtp_NOOP(self, argument):
+        self.reply(250, 'OK')
+
+    def lmtp_VRFY(self, argument):
+        self.reply(252, 'Cannot VRFY user')
+
+    def lmtp_QUIT(self, argument):
+        self.reply(221, 'Bye')
+        return False
+
+    def read_data(self):
+        """Read the message up to the line holding a single dot, undoing
+        dot-stuffing. Stops storing lines once the message is too large.
+
+        Returns:
+            (tuple) The raw message and whether or not it was too large, or
+            `None` if the client disconnected.
+        """
+        lines = []
+        size = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            if line in (b'.\r\n', b'.\n'):
+                break
+            if line.startswith(b'.'):
+                line = line[1:]
+            size += len(line)
+            if size <= self.server.max_message_size:
+                lines.append(line)
+        if size > self.server.max_message_size:
+            return b'', True
+        return b''.join(lines), False
+
+    def process(self, raw):
+        """Normalize and deliver a message.
+
+        Returns:
+            (tuple) The reply code and text for each recipient.
+        """
+        try:
+            message = self.server.normalizer.normalize(raw)
+            self.server.deliver(message, self.mail_from, self.recipients)
+        except Exception as error:
+            return (451, 'Delivery failed: {0}'.format(_describe(error)))
+        return (250, 'OK')
+
+
+def _address(argument):
+    """Get the address from a MAIL FROM or RCPT TO argument."""
+    address = argument.strip().split(b' ')[0]
+    if address.startswith(b'<') and address.endswith(b'>'):
+        address = address[1:-1]
+    return address.decode('utf-8', 'replace')
+
+def _describe(error):
+    """Describe an exception for a reply, even when its message holds
+    bytes which are not ASCII."""
+    try:
+        return unicode(error)
+    except UnicodeError:
+        return repr(error).decode('ascii')
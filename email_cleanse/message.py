@@ -4,11 +4,182 @@ Email message objects.
 """
 from __future__ import unicode_literals
 
-import copy
-import StringIO
 from collections import deque
 from email.message import Message
 
+from email_cleanse.budget import get_budget
+from email_cleanse.content import EncodedContent, SpooledContent
+from email_cleanse.writer import write_message
+
+
+# Header names are shared between messages rather than each message
+# holding its own copy. The table stops growing at this many names so
+# junk headers cannot grow it without bound.
+MAX_INTERNED_HEADER_NAMES = 4096
+
+_header_names = dict()
+
+# Attachment content larger than this many bytes is moved from memory to
+# a temporary file in `SPOOL_DIR`, which defaults to the system default.
+SPOOL_MAX_SIZE = 1024 * 1024
+SPOOL_DIR = None
+
+# Size of the chunks yielded by `Attachment.iter_content`.
+CONTENT_CHUNK_SIZE = 64 * 1024
+
+
+def intern_header_name(name):
+    """Get the shared copy of a header name.
+
+    Args:
+        name (unicode): The name of the header.
+
+    Returns:
+        (unicode) An equal string shared by all messages.
+    """
+    interned = _header_names.get(name)
+    if interned is None:
+        if len(_header_names) >= MAX_INTERNED_HEADER_NAMES:
+            return name
+        interned = _header_names.setdefault(name, name)
+    return interned
+
+
+class HeaderList(object):
+
+    """
+    Ordered list of (name, value) header pairs. Headers are kept in the
+    order they are added and iterate as pairs like a plain list, but are
+    also indexed by lower case name so lookups, deletes and replaces do not
+    scan the whole list. Header names are matched case-insensitively.
+    """
+
+    __slots__ = ('_items', '_index', '_deleted')
+
+    def __init__(self, headers=None):
+        """Initialize instance of HeaderList.
+
+        Args:
+            headers (list): List of name, value pairs.
+        """
+        # Deleted headers leave a `None` in `_items` until the list is
+        # compacted so the positions held in `_index` stay valid. The
+        # index is only built once a header is looked up by name.
+        self._items = list()
+        self._index = None
+        self._deleted = 0
+        for header in headers or ():
+            self.append(header)
+
+    def __iter__(self):
+        return (item for item in self._items if item is not None)
+
+    def __len__(self):
+        return len(self._items) - self._deleted
+
+    def __getitem__(self, index):
+        if self._deleted:
+            self._compact()
+        return self._items[index]
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, header):
+        """Add a header to the end of the list, like `list.append`.
+
+        Args:
+            header (tuple): The name and value of the header.
+        """
+        name, value = header
+        name = intern_header_name(name)
+        if self._index is not None:
+            self._index.setdefault(intern_header_name(name.lower()),
+                    []).append(len(self._items))
+        self._items.append((name, value))
+
+    def get(self, name, default=None):
+        """Get the value of the first header with the given name.
+
+        Args:
+            name (unicode): The name of the header.
+            default (object): Returned if there is no such header.
+
+        Returns:
+            (unicode) The header value or `default`.
+        """
+        positions = self._get_index().get(name.lower())
+        if not positions:
+            return default
+        return self._items[positions[0]][1]
+
+    def get_all(self, name):
+        """Get the values of all headers with the given name.
+
+        Args:
+            name (unicode): The name of the header.
+
+        Returns:
+            (list) The header values in the order they were added.
+        """
+        return [self._items[position][1] \
+                for position in self._get_index().get(name.lower(), ())]
+
+    def delete(self, name):
+        """Delete all headers with the given name.
+
+        Args:
+            name (unicode): The name of the header.
+        """
+        positions = self._get_index().pop(name.lower(), ())
+        for position in positions:
+            self._items[position] = None
+        self._deleted += len(positions)
+        if self._deleted > len(self._items) // 2:
+            self._compact()
+
+    def replace(self, name, value):
+        """Delete all headers with the given name and add the new value to
+        the end of the list.
+
+        Args:
+            name (unicode): The name of the header.
+            value (unicode): The value for the header.
+        """
+        self.delete(name)
+        self.append((name, value))
+
+    def _get_index(self):
+        """Get the index of positions by lower case name, building it if
+        this is the first lookup."""
+        if self._index is None:
+            self._index = dict()
+            for position, item in enumerate(self._items):
+                if item is not None:
+                    self._index.setdefault(intern_header_name(
+                            item[0].lower()), []).append(position)
+        return self._index
+
+    def _compact(self):
+        """Drop deleted headers and discard the index."""
+        self._items = list(self)
+        self._index = None
+        self._deleted = 0
+
 
 class MessagePart(object):
 
@@ -17,17 +188,29 @@ class MessagePart(object):
     and Attachment classes. Basically handles all of the header handling.
     """
 
+    __slots__ = ('_headers',)
+
     def __init__(self, headers=None):
         """Initialize instance of MessagePart.
 
         Args:
             headers (dict): Headers describing the message part.
         """
-        if headers is None:
-            self.headers = list()
-        else:
+        self._headers = None
+        if headers is not None:
             self.set_all_headers(headers)
 
+    @property
+    def headers(self):
+        """The HeaderList for this part. Created when first used."""
+        if self._headers is None:
+            self._headers = HeaderList()
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = HeaderList(headers)
+
     def set_all_headers(self, headers):
         """Copy specified headers to this class replacing any exsiting
         headers in the process.
@@ -35,7 +218,7 @@ class MessagePart(object):
         Args:
             headers (list): List of key, value pairs.
         """
-        self.headers = copy.copy(headers or list())
+        self._headers = HeaderList(headers)
 
     def get_headers_as_string(self):
         """Get headers as a string. Each header on it's own line in order as
@@ -48,7 +231,7 @@ class MessagePart(object):
             From: jim@example.com\n
         """
         return ''.join("{0}: {1}\n".format(name, value) for name, value in \
-                self.headers)
+                self._headers or ())
 
     def add_header(self, name, value):
         """Add the name, value pair for a header. Headers are stored in the
@@ -60,20 +243,46 @@ class MessagePart(object):
             name (unicode): The name of the header.
             value (unicode): The value for the header.
         """
-        if self.headers is None:
-            self.headers = [(name, value)]
-        else:
-            self.headers.append((name, value))
+        self.headers.append((name, value))
+
+    def get_header(self, name, default=None):
+        """Get the value of the first header with the given name. Names are
+        matched case-insensitively.
+
+        Args:
+            name (unicode): The name of the header.
+            default (object): Returned if there is no such header.
+
+        Returns:
+            (unicode) The header value or `default`.
+        """
+        if self._headers is None:
+            return default
+        return self._headers.get(name, default)
+
+    def get_header_values(self, name):
+        """Get the values of all headers with the given name. Names are
+        matched case-insensitively.
+
+        Args:
+            name (unicode): The name of the header.
+
+        Returns:
+            (list) The header values in the order they were received.
+        """
+        if self._headers is None:
+            return list()
+        return self._headers.get_all(name)
 
     def delete_header(self, name):
-        """Delete all occurrences of the header with the given name.
+        """Delete all occurrences of the header with the given name. Names
+        are matched case-insensitively.
 
         Args:
             name (unicode): The name of the header.
         """
-        if self.headers is not None:
-            self.headers = [(key, value) for (key, value) in self.headers \
-                    if key != name]
+        if self._headers is not None:
+            self._headers.delete(name)
 
     def replace_header(self, name, value):
         """Replace the value for a header. Headers are stored in the order
@@ -85,8 +294,7 @@ class MessagePart(object):
             name (unicode): The name of the header.
             value (unicide): The value of the header.
         """
-        self.delete_header(name)
-        self.add_header(name, value)
+        self.headers.replace(name, value)
 
 
 class Attachment(MessagePart):
@@ -97,6 +305,8 @@ class Attachment(MessagePart):
     content. These headers should include stuff like type and disposition.
     """
 
+    __slots__ = ('content',)
+
     def __init__(self, content=None, headers=None):
         """Initialize instance of Attachment.
 
@@ -112,26 +322,104 @@ class Attachment(MessagePart):
         if self.content:
             self.content.seek(0)
             return {
-                'headers': self.headers,
+                'headers': list(self._headers or ()),
                 'content': self.content.read(),
             }
         else:
             return {
-                'headers': self.headers,
+                'headers': list(self._headers or ()),
                 'content': '',
             }
 
+    def as_streaming_dict(self, chunk_size=CONTENT_CHUNK_SIZE):
+        """Return the message attachment as a dictionary without reading
+        the content into memory. The content is a generator of chunks.
+
+        Args:
+            chunk_size (int): Maximum size of each chunk of content.
+        """
+        return {
+            'headers': list(self._headers or ()),
+            'content': self.iter_content(chunk_size),
+        }
+
+    def iter_content(self, chunk_size=CONTENT_CHUNK_SIZE):
+        """Read the content from the start in chunks.
+
+        Args:
+            chunk_size (int): Maximum size of each chunk.
+
+        Returns:
+            (generator) The content as strings of up to `chunk_size` bytes.
+        """
+        if not self.content:
+            return
+        self.content.seek(0)
+        while True:
+            chunk = self.content.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
     def set_content(self, content):
         """Set the content to `content` if it's a file handle, else if it's
-        a string, assume it's the content itself and wrap it in a StringIO.
+        a string, assume it's the content itself and copy it to a spooled
+        temporary file. The copy stays in memory until it is larger than
+        `SPOOL_MAX_SIZE` bytes, when it is moved to disk. Unicode content
+        is stored UTF-8 encoded. Content kept in memory counts against the
+        memory budget, if one is enabled, and may be moved to disk early.
 
         Args:
             content (string|object): content as a string or as file handle.
         """
         if hasattr(content, 'read'):
             self.content = content
-        else:
-            self.content = StringIO.StringIO(content)
+            return
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        content = content or b''
+        self.content = SpooledContent(SPOOL_MAX_SIZE, SPOOL_DIR)
+        if len(content) > SPOOL_MAX_SIZE:
+            # Go straight to disk rather than copying into memory first.
+            self.content.rollover()
+        for offset in xrange(0, len(content), CONTENT_CHUNK_SIZE):
+            self.content.write(content[offset:offset + CONTENT_CHUNK_SIZE])
+        self.content.seek(0)
+        budget = get_budget()
+        if budget is not None and content and not self.content.rolled:
+            budget.track_content(self.content, len(content))
+
+    def set_encoded_content(self, source, offset, length,
+            transfer_encoding=None):
+        """Set the content to a transfer encoded byte range of `source`.
+        The range is only read and decoded when the content is read.
+
+        Args:
+            source (mmap|file): The mmap or file holding the encoded bytes.
+            offset (int): Position of the first encoded byte in `source`.
+            length (int): Number of encoded bytes.
+            transfer_encoding (unicode): The Content-Transfer-Encoding of
+                the bytes.
+        """
+        self.content = EncodedContent(source, offset, length,
+                transfer_encoding)
+
+    def store_content(self, store):
+        """Move the content into a content addressed blob store. The
+        content is replaced by a reference to the stored blob, which is
+        shared with every other attachment with identical content.
+
+        Args:
+            store (BlobStore): The store to move the content to.
+
+        Returns:
+            (unicode) The digest identifying the stored blob.
+        """
+        digest = store.put(self.content or b'')
+        if hasattr(self.content, 'close'):
+            self.content.close()
+        self.content = store.reference(digest)
+        return digest
 
 
 class UnicodeMessage(MessagePart):
@@ -142,26 +430,78 @@ class UnicodeMessage(MessagePart):
     parts.
     """
 
+    # Most messages have a single alternative and no attachments or
+    # message parts, so each container is only created when first used.
+    # Weak references let the memory budget tell when a message is freed.
+    __slots__ = ('_alternatives', '_attachments', '_message_parts',
+            '__weakref__')
+
     def __init__(self):
         """Initialize instance of UnicodeMessage."""
         super(UnicodeMessage, self).__init__()
-        self.alternatives = list()
-        self.attachments = deque()
-        self.message_parts = list()
+        self._alternatives = None
+        self._attachments = None
+        self._message_parts = None
+
+    @property
+    def alternatives(self):
+        """List of (content type, body) pairs. Created when first used."""
+        if self._alternatives is None:
+            self._alternatives = list()
+        return self._alternatives
+
+    @alternatives.setter
+    def alternatives(self, alternatives):
+        self._alternatives = alternatives
+
+    @property
+    def attachments(self):
+        """Deque of Attachment objects. Created when first used."""
+        if self._attachments is None:
+            self._attachments = deque()
+        return self._attachments
+
+    @attachments.setter
+    def attachments(self, attachments):
+        self._attachments = attachments
+
+    @property
+    def message_parts(self):
+        """List of attached UnicodeMessage objects. Created when first
+        used."""
+        if self._message_parts is None:
+            self._message_parts = list()
+        return self._message_parts
+
+    @message_parts.setter
+    def message_parts(self, message_parts):
+        self._message_parts = message_parts
 
     def as_dict(self):
         """Return the message headers and body as a dictionary."""
         return {
-            'headers': self.headers,
-            'alternatives': self.alternatives,
+            'headers': list(self._headers or ()),
+            'alternatives': list(self._alternatives or ()),
             'attachments': [attachment.as_dict() \
-                    for attachment in self.attachments],
+                    for attachment in self._attachments or ()],
         }
 
     def is_multipart(self):
         """Return whether or not this is a multipart message."""
-        return self.attachments or len(self.alternatives) > 1 \
-                or self.message_parts
+        return bool(self._attachments) \
+                or len(self._alternatives or ()) > 1 \
+                or bool(self._message_parts)
+
+    def write(self, fp, linesep=b'\n'):
+        """Write the message to `fp` as a UTF-8 MIME message. Headers are
+        RFC-2047 encoded only where needed and attachment content is
+        copied from its file handle a chunk at a time.
+
+        Args:
+            fp (file): The file handle to write to.
+            linesep (string): The line ending to write.
+        """
+        write_message(self, fp, linesep)
 
     def add_alternative(self, message_body, content_type='text/plain'):
         """Add a message alternative (The body of the message). Alternatives are
@@ -174,6 +514,9 @@ class UnicodeMessage(MessagePart):
                 Defaults to 'text/plain'.
         """
         self.alternatives.append((content_type, message_body))
+        budget = get_budget()
+        if budget is not None:
+            budget.track_body(self, message_body)
 
     def enqueue_attachment(self, attachment):
         """Add an attachment to the end of the attachment queue.
@@ -191,3 +534,76 @@ class UnicodeMessage(MessagePart):
         """
         return self.attachments.popleft()
 
+
+def _loading_property(base_property):
+    """Wrap a UnicodeMessage container property so the body is loaded
+    before it is used."""
+    def getter(self):
+        self.load()
+        return base_property.fget(self)
+    def setter(self, value):
+        self.load()
+        base_property.fset(self, value)
+    return property(getter, setter, doc=base_property.__doc__)
+
+
+class LazyUnicodeMessage(UnicodeMessage):
+
+    """
+    UnicodeMessage whose headers are decoded up front but whose body is
+    only decoded the first time the alternatives, attachments or message
+    parts are used. Useful when most messages are only indexed by their
+    headers.
+    """
+
+    __slots__ = ('_loader', '_loading')
+
+    def __init__(self, loader):
+        """Initialize instance of LazyUnicodeMessage.
+
+        Args:
+            loader (callable): Called with this message the first time the
+                body is needed. It should add the alternatives, attachments
+                and message parts.
+        """
+        super(LazyUnicodeMessage, self).__init__()
+        self._loader = loader
+        self._loading = False
+
+    alternatives = _loading_property(UnicodeMessage.alternatives)
+    attachments = _loading_property(UnicodeMessage.attachments)
+    message_parts = _loading_property(UnicodeMessage.message_parts)
+
+    @property
+    def is_loaded(self):
+        """Whether or not the body has been loaded."""
+        return self._loader is None
+
+    def load(self):
+        """Load the body if it has not been loaded yet. If the loader
+        fails, whatever it added is dropped and the next use tries again."""
+        if self._loader is None or self._loading:
+            return
+        # The loader fills in the body through the properties which load
+        # it, so they are left alone while it runs.
+        self._loading = True
+        try:
+            self._loader(self)
+        except Exception:
+            self._alternatives = None
+            self._attachments = None
+            self._message_parts = None
+            raise
+        finally:
+            self._loading = False
+        self._loader = None
+
+    def as_dict(self):
+        """Return the message headers and body as a dictionary."""
+        self.load()
+        return super(LazyUnicodeMessage, self).as_dict()
+
+    def is_multipart(self):
+        """Return whether or not this is a multipart message."""
+        self.load()
+        return super(LazyUnicodeMessage, self).is_multipart()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Attachment pipeline. Hands attachments to a pool of consumers, such as a
+virus scanner or a blob upload, while messages are still being normalized
+rather than processing them one after another afterwards.
+"""
+from __future__ import unicode_literals
+
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
+
+
+# Number of consumer threads used by a pipeline created without a pool.
+DEFAULT_WORKERS = 4
+
+# Maximum number of attachments queued or being processed at once.
+# Submitting another blocks until one is done, which pushes back on the
+# normalizer.
+DEFAULT_MAX_PENDING = 16
+
+
+class AttachmentError(Exception):
+
+    """
+    Raised by `AttachmentPipeline.wait` when processing one or more of the
+    attachments of a message failed.
+    """
+
+    def __init__(self, message, errors):
+        """Initialize instance of AttachmentError.
+
+        Args:
+            message (UnicodeMessage): The message owning the attachments.
+            errors (list): (Attachment, exception) pairs.
+        """
+        super(AttachmentError, self).__init__(
+                '{0} attachment(s) failed: {1}'.format(len(errors),
+                    '; '.join(unicode(error) for _, error in errors)))
+        self.message = message
+        self.errors = errors
+
+
+class AttachmentPipeline(object):
+
+    """
+    Process attachments on a pool of consumer threads as they are
+    submitted. At most `max_pending` attachments are queued or being
+    processed at once. Errors are collected for the message owning the
+    attachment and raised by `wait`. A message is only referenced while
+    it has attachments pending, so messages which are never waited on
+    are not kept alive.
+    """
+
+    def __init__(self, process, pool=None, workers=DEFAULT_WORKERS,
+            max_pending=DEFAULT_MAX_PENDING):
+        """Initialize instance of AttachmentPipeline.
+
+        Args:
+            process (callable): Called as `process(message, attachment)`
+                on a consumer thread for each attachment submitted.
+            pool (Pool): A `multiprocessing.pool.ThreadPool`, or anything
+                with the same `apply_async`, to process on. Defaults to a
+                new ThreadPool.
+            workers (int): Number of threads in the default pool.
+            max_pending (int): Attachments queued or processed at once.
+        """
+        self.process = process
+        self._owns_pool = pool is None
+        self.pool = ThreadPool(workers) if pool is None else pool
+        self.pending_slots = threading.BoundedSemaphore(max_pending)
+        # Releasing a message may free it and drop its state from within
+        # a thread already holding the lock.
+        self._lock = threading.RLock()
+        self._messages = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, message, attachment):
+        """Queue an attachment to be processed, blocking while
+        `max_pending` attachments are already queued or being processed.
+
+        Args:
+            message (UnicodeMessage): The message owning the attachment.
+            attachment (Attachment): The attachment.
+        """
+        self.pending_slots.acquire()
+        key = id(message)
+        with self._lock:
+            state = self._messages.get(key)
+            if state is None:
+                state = _MessageState(message,
+                        lambda reference: self._forget(key, state))
+                self._messages[key] = state
+            with state.condition:
+                state.pending += 1
+                state.message = message
+        try:
+            self.pool.apply_async(self._process, (state, attachment))
+        except Exception:
+            self._done(state)
+            raise
+
+    def wait(self, message):
+        """Wait until every attachment submitted for `message`, and for
+        the messages attached to it, has been processed.
+
+        Args:
+            message (UnicodeMessage): The message.
+
+        Raises:
+            AttachmentError: If processing any of the attachments failed.
+        """
+        errors = []
+        for owner in _iter_messages(message):
+            with self._lock:
+                state = self._messages.get(id(owner))
+            if state is None:
+                continue
+            with state.condition:
+                while state.pending:
+                    state.condition.wait()
+            self._forget(id(owner), state)
+            errors.extend(state.errors)
+        if errors:
+            raise AttachmentError(message, errors)
+
+    def close(self):
+        """Wait for queued attachments and shut down the pool if the
+        pipeline created it."""
+        if self._owns_pool:
+            self.pool.close()
+            self.pool.join()
+
+    def _process(self, state, attachment):
+        """Process an attachment on a consumer thread."""
+        try:
+            self.process(state.message, attachment)
+        except Exception as error:
+            with state.condition:
+                state.errors.append((attachment, error))
+        finally:
+            self._done(state)
+
+    def _done(self, state):
+        """Record that an attachment of `state` is no longer pending. Once
+        none are, the message is released and, if nothing failed, so is
+        its state."""
+        with self._lock:
+            with state.condition:
+                state.pending -= 1
+                if not state.pending:
+                    state.message = None
+                    if not state.errors \
+                            and self._messages.get(state.key) is state:
+                        del self._messages[state.key]
+                state.condition.notify_all()
+        self.pending_slots.release()
+
+    def _forget(self, key, state):
+        """Drop `state` if it is still the state held for `key`."""
+        with self._lock:
+            if self._messages.get(key) is state:
+                del self._messages[key]
+
+
+class _MessageState(object):
+
+    """
+    Attachments of one message still pending and the errors raised by
+    those already processed. The message is held while attachments are
+    pending and otherwise only weakly referenced; `forget` is called when
+    it is freed.
+    """
+
+    __slots__ = ('key', 'reference', 'message', 'pending', 'errors',
+            'condition')
+
+    def __init__(self, message, forget):
+        self.key = id(message)
+        self.reference = weakref.ref(message, forget)
+        self.message = None
+        self.pending = 0
+        self.errors = []
+        self.condition = threading.Condition()
+
+
+def _iter_messages(message):
+    """Yield `message` and every message attached to it."""
+    yield message
+    for message_part in message.message_parts:
+        for sub_message in _iter_messages(message_part):
+            yield sub_message
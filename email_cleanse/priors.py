@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Charset priors. Learns which charset actually decodes the bodies sent from
+each sender domain and mailing list, so that mislabeled mail from a known
+source can be decoded without running charset detection.
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from email.utils import parseaddr
+
+from email_cleanse.encoding import decode_string_to_unicode, \
+        decode_with_charset
+
+
+# Maximum number of sender domains and lists remembered. The least
+# recently seen are evicted first.
+DEFAULT_PRIORS_SIZE = 10000
+
+# Factor the scores of a source's charsets are multiplied by each time a
+# body from that source is decoded, so old evidence fades.
+PRIOR_DECAY = 0.8
+
+# Charsets whose score decays below this are forgotten.
+PRIOR_MIN_SCORE = 0.05
+
+# Matches any byte outside of ascii. Bodies without one say nothing about
+# the charset of their source.
+_NON_ASCII_RE = re.compile(br'[\x80-\xff]')
+
+# Matches the identifier of a List-Id header.
+_LIST_ID_RE = re.compile(r'<([^>]+)>')
+
+
+class CharsetPriors(object):
+
+    """
+    Bounded store of the charsets which decoded bodies from each sender
+    domain and mailing list, optionally saved to a JSON file. Safe to share
+    between threads.
+    """
+
+    def __init__(self, path=None, maxsize=DEFAULT_PRIORS_SIZE):
+        """Initialize instance of CharsetPriors, loading `path` if it
+        exists.
+
+        Args:
+            path (string): JSON file the priors are loaded from and saved
+                to. Defaults to keeping them in memory only.
+            maxsize (int): Maximum number of sources remembered.
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as fp:
+                for key, scores in json.load(fp):
+                    self._scores[key] = scores
+            self._evict()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def get(self, keys):
+        """Get the charset most likely to decode a body from the first of
+        `keys` which has been seen before.
+
+        Args:
+            keys (list): Source keys from `get_keys`, most specific first.
+
+        Returns:
+            (string) The charset or `None` if no source is known.
+        """
+        with self._lock:
+            for key in keys:
+                scores = self._scores.get(key)
+                if scores:
+                    return max(scores, key=scores.get)
+        return None
+
+    def record(self, keys, charset):
+        """Record that `charset` decoded a body from the sources `keys`.
+
+        Args:
+            keys (list): Source keys from `get_keys`.
+            charset (string): The charset which decoded the body.
+        """
+        charset = charset.lower()
+        with self._lock:
+            for key in keys:
+                scores = self._scores.pop(key, None) or dict()
+                for name in list(scores):
+                    scores[name] *= PRIOR_DECAY
+                    if scores[name] < PRIOR_MIN_SCORE:
+                        del scores[name]
+                scores[charset] = scores.get(charset, 0) + 1
+                self._scores[key] = scores
+            self._evict()
+
+    def decode(self, text, charset, keys):
+        """Decode a body from the sources `keys`. If the declared charset
+        fails the learned charset is confirmed with a strict decode before
+        falling back to detection. The charset which worked is recorded.
+
+        Args:
+            text (string): The body.
+            charset (string): The declared charset.
+            keys (list): Source keys from `get_keys`.
+
+        Returns:
+            (unicode) The decoded body.
+        """
+        prior = self.get(keys)
+        decoded, used = decode_with_charset(text, charset, prior)
+        if used is None or not _NON_ASCII_RE.search(text):
+            return decoded
+        declared = (charset or 'ascii').lower()
+        if prior is not None and used.lower() != declared:
+            with self._lock:
+                if used == prior:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        self.record(keys, used)
+        return decoded
+
+    def save(self, path=None):
+        """Write the priors to a JSON file, replacing it atomically.
+
+        Args:
+            path (string): The file. Defaults to the one loaded from.
+        """
+        path = path or self.path
+        with self._lock:
+            entries = list(self._scores.items())
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False,
+                prefix='.priors') as fp:
+            json.dump(entries, fp)
+        os.rename(fp.name, path)
+
+    def stats(self):
+        """Get how often the learned charset saved a detection.
+
+        Returns:
+            (dict) The hits, misses, evictions, size and maxsize.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._scores),
+                'maxsize': self.maxsize,
+            }
+
+    def _evict(self):
+        """Drop the least recently seen sources until within the bound."""
+        while len(self._scores) > max(self.maxsize, 0):
+            self._scores.popitem(last=False)
+            self.evictions += 1
+
+
+def get_keys(message):
+    """Get the source keys of a message for looking up charset priors: its
+    mailing list, if any, then its sender domain.
+
+    Args:
+        message (Message): An email Message object.
+
+    Returns:
+        (list) The keys, most specific first.
+    """
+    keys = []
+    list_id = decode_string_to_unicode(message.get('List-Id', b''))
+    if list_id:
+        match = _LIST_ID_RE.search(list_id)
+        keys.append('list:' + (match.group(1) if match
+                else list_id).strip().lower())
+    sender = decode_string_to_unicode(message.get('From', b''))
+    address = parseaddr(sender)[1]
+    if '@' in address:
+        keys.append('domain:' + address.rpartition('@')[2].lower())
+    return keys
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+"""
+Static HTML archive publisher. Renders normalized messages to a page each
+plus per-thread, per-month and top-level index pages. Pages are rendered on
+a pool of worker processes and a manifest of the hash of what went into
+each page means only pages whose messages or thread changed are rendered
+again. Attachments are written once to a content addressed directory and
+linked from the message pages.
+
+Messages are read in one pass. Only a short summary of each is kept in
+memory; what their pages show is spooled to a temporary file which the
+workers read back from.
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import cgi
+import hashlib
+import json
+import mimetypes
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import urllib
+from collections import OrderedDict, deque
+from email.message import Message
+from email.utils import parsedate_tz, mktime_tz
+
+from email_cleanse.reader import iter_messages
+from email_cleanse.store import DirectoryBlobStore, BlobContent
+
+
+# Number of pages handed to a worker at a time.
+DEFAULT_CHUNK_SIZE = 64
+
+# Name of the file recording the hash of every published page and the
+# attachment files linked from them.
+MANIFEST_NAME = 'manifest.json'
+
+# Changed whenever the templates change so every page is rendered again.
+RENDER_VERSION = 2
+
+# Month pages are named after this month when the Date header is missing
+# or cannot be parsed.
+UNKNOWN_MONTH = 'unknown'
+
+# Headers shown at the top of message pages.
+DISPLAY_HEADERS = ('From', 'To', 'Cc', 'Date', 'Subject')
+
+# Matches a Message-Id in the References and In-Reply-To headers.
+_MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+# Matches characters which are not kept in published attachment names.
+_UNSAFE_FILENAME_RE = re.compile(r'[\x00-\x1f/\\:*?"<>|]+')
+
+# Matches an HTML tag, stripped from HTML bodies which are shown as text.
+_TAG_RE = re.compile(r'<[^>]*>')
+
+_PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+</head>
+<body>
+{navigation}<h1>{title}</h1>
+{content}</body>
+</html>
+'''
+
+# Positions of the fields of the summaries kept for each message.
+_PAGE, _SUBJECT, _FROM, _DATE, _TIMESTAMP, _MONTH, _THREAD, _DIGEST, \
+        _OFFSET = range(9)
+
+
+def publish(messages, output, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Publish messages as a static HTML archive in `output`.
+
+    Every message of the archive is passed on every run. Pages which
+    would come out the same as the last run are left alone, pages of
+    messages no longer in the archive are removed and the rest are
+    rendered on a pool of worker processes. Messages repeating the
+    Message-Id and content of an earlier message are published once;
+    messages only repeating the Message-Id get a page of their own.
+
+    Args:
+        messages (iterable): UnicodeMessage objects in archive order.
+        output (string): Directory the archive is written to.
+        workers (int): Number of worker processes. Defaults to the number
+            of CPUs. A value of 1 renders in the calling process.
+        chunk_size (int): Number of pages sent to a worker at a time.
+
+    Returns:
+        (dict) The number of pages published, rendered, left unchanged and
+        removed, and of attachment files published.
+    """
+    store = DirectoryBlobStore(os.path.join(output, 'attachments'))
+    manifest_path = os.path.join(output, MANIFEST_NAME)
+    previous = {'pages': {}, 'files': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as fp:
+            previous = json.load(fp)
+    for directory in ('messages', 'threads', 'months', 'files'):
+        if not os.path.isdir(os.path.join(output, directory)):
+            os.makedirs(os.path.join(output, directory))
+    manifest = {'pages': {}, 'files': {}}
+    spool = tempfile.NamedTemporaryFile('wb', dir=output, prefix='.spool',
+            delete=False)
+    try:
+        with spool:
+            summaries = _spool_messages(messages, spool, output, store,
+                    manifest['files'])
+        rendered = [0]
+        def changed_pages():
+            for path, kind, digest, context in _iter_pages(summaries,
+                    spool.name):
+                manifest['pages'][path] = digest
+                if previous['pages'].get(path) != digest \
+                        or not os.path.exists(os.path.join(output, path)):
+                    rendered[0] += 1
+                    yield output, path, kind, context
+        _render_pages(changed_pages(), workers, chunk_size)
+    finally:
+        os.remove(spool.name)
+    removed = 0
+    for path in previous['pages']:
+        if path not in manifest['pages']:
+            _remove(os.path.join(output, path))
+            removed += 1
+    for path in previous['files']:
+        if path not in manifest['files']:
+            _remove(_local_path(output, path))
+    _write_file(manifest_path, json.dumps(manifest, sort_keys=True))
+    pages = len(manifest['pages'])
+    return {
+        'pages': pages,
+        'rendered': rendered[0],
+        'unchanged': pages - rendered[0],
+        'removed': removed,
+        'attachments': len(manifest['files']),
+    }
+
+def main(argv=None):
+    """Command line entry point. Publishes an archive as static HTML.
+
+    Args:
+        argv (list): Command line arguments. Defaults to `sys.argv[1:]`.
+
+    Returns:
+        (int) The exit status.
+    """
+    parser = argparse.ArgumentParser(
+            description='Publish an mbox file or Maildir tree as HTML.')
+    parser.add_argument('archive', help='mbox file or Maildir directory')
+    parser.add_argument('output', help='directory to publish to')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+            help='number of worker processes, defaults to the CPU count')
+    parser.add_argument('-c', '--chunk-size', type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='pages sent to a worker at a time')
+    args = parser.parse_args(argv)
+    stats = publish(iter_messages(args.archive), args.output, args.workers,
+            args.chunk_size)
+    for name in sorted(stats):
+        print('{0}: {1}'.format(name, stats[name]))
+    return 0
+
+def _spool_messages(messages, spool, output, store, files):
+    """Write what the page of each message shows to `spool`, one JSON line
+    per message, storing and linking attachments.
+
+    Returns:
+        (list) A summary of each message published.
+    """
+    summaries = []
+    # Digests of the content published for each Message-Id.
+    published = dict()
+    for message in messages:
+        message_id = message.get_header('Message-Id', '').strip()
+        headers = [(name, message.get_header(name))
+                for name in DISPLAY_HEADERS
+                if message.get_header(name) is not None]
+        attachments = [_link_attachment(attachment, output, store, files)
+                for attachment in message.attachments]
+        record = json.dumps([headers, _get_body(message), attachments])
+        digest = hashlib.sha1(record).hexdigest()
+        if not message_id:
+            message_id = digest
+        digests = published.setdefault(message_id, [])
+        if digest in digests:
+            continue
+        digests.append(digest)
+        page = _page_name(message_id if len(digests) == 1
+                else '{0} {1}'.format(message_id, len(digests)))
+        date = message.get_header('Date')
+        parsed = parsedate_tz(date) if date else None
+        references = _MESSAGE_ID_RE.findall(
+                message.get_header('References', '') + ' ' +
+                message.get_header('In-Reply-To', ''))
+        summaries.append([
+            page,
+            message.get_header('Subject', ''),
+            message.get_header('From', ''),
+            date or '',
+            mktime_tz(parsed) if parsed else None,
+            '{0:04d}-{1:02d}'.format(*parsed[:2]) if parsed
+                else UNKNOWN_MONTH,
+            # The first reference is the message which started the thread.
+            _page_name(references[0] if references else message_id),
+            digest,
+            spool.tell(),
+        ])
+        spool.write(record)
+        spool.write(b'\n')
+    return summaries
+
+def _get_body(message):
+    """Get the plain text of a message, falling back to its HTML with the
+    tags stripped."""
+    for content_type, body in message.alternatives:
+        if content_type == 'text/plain':
+            return body
+    for content_type, body in message.alternatives:
+        return _TAG_RE.sub('', body) if content_type == 'text/html' \
+                else body
+    return ''
+
+def _link_attachment(attachment, output, store, files):
+    """Move attachment content into `store` and publish it under its file
+    name as a hard link to the stored blob.
+
+    Returns:
+        (tuple) The file name of the attachment and the path of the
+        published file, relative to the output directory.
+    """
+    content = attachment.content
+    if isinstance(content, BlobContent) and content.store is store:
+        digest = content.digest
+    else:
+        digest = attachment.store_content(store)
+    name = _get_filename(attachment)
+    path = '/'.join(('files', digest, name))
+    if path not in files:
+        files[path] = digest
+        target = _local_path(output, path)
+        if not os.path.exists(target):
+            blob = store.blob_path(digest)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            try:
+                os.link(blob, target)
+            except (AttributeError, OSError):
+                shutil.copyfile(blob, target)
+    return name, path
+
+def _get_filename(attachment):
+    """Get a file name safe to publish an attachment under, giving it an
+    extension from its content type if it has no name."""
+    part = Message()
+    for header in ('Content-Type', 'Content-Disposition'):
+        value = attachment.get_header(header)
+        if value is not None:
+            part[header] = value.encode('utf-8')
+    # Handles RFC 2231 encoded and continued parameters.
+    name = part.get_filename() or ''
+    if not isinstance(name, unicode):
+        name = name.decode('utf-8', 'replace')
+    name = _UNSAFE_FILENAME_RE.sub('_', name).strip(' .')
+    if not name:
+        name = 'attachment' + (mimetypes.guess_extension(
+                part.get_content_type()) or '')
+    return name
+
+def _page_name(message_id):
+    """Get a file name safe to publish for a Message-Id."""
+    return hashlib.sha1(message_id.encode('utf-8')).hexdigest()[:20] + \
+            '.html'
+
+def _iter_pages(summaries, spool_path):
+    """Work out every page of the archive.
+
+    Returns:
+        (generator) `(path, kind, digest, context)` for each page, where
+        context is what the page is rendered from and digest changes
+        whenever the page would.
+    """
+    threads = OrderedDict()
+    months = dict()
+    for summary in summaries:
+        threads.setdefault(summary[_THREAD], []).append(summary)
+        months.setdefault(summary[_MONTH], []).append(summary)
+    for thread, members in threads.items():
+        members.sort(key=_date_order)
+        listing = [_listing_entry(member) for member in members]
+        context = {'subject': members[0][_SUBJECT], 'messages': listing}
+        thread_digest = _digest('thread', context)
+        yield 'threads/' + thread, 'thread', thread_digest, context
+        for member in members:
+            context = {
+                'page': member[_PAGE],
+                'subject': member[_SUBJECT],
+                'month': member[_MONTH],
+                'thread_page': thread,
+                'thread': listing,
+                'spool': [spool_path, member[_OFFSET]],
+            }
+            yield 'messages/' + member[_PAGE], 'message', \
+                    _digest('message', [member[_DIGEST], thread_digest,
+                        member[_PAGE], member[_MONTH]]), context
+    for month, members in months.items():
+        members.sort(key=_date_order)
+        context = {
+            'month': month,
+            'messages': [_listing_entry(member) for member in members],
+        }
+        yield 'months/{0}.html'.format(month), 'month', \
+                _digest('month', context), context
+    context = {
+        'months': [(month, len(months[month]))
+                for month in sorted(months, reverse=True)],
+    }
+    yield 'index.html', 'index', _digest('index', context), context
+
+def _digest(kind, context):
+    """Get the hash of what a page is rendered from."""
+    return hashlib.sha1(json.dumps([RENDER_VERSION, kind, context],
+            sort_keys=True)).hexdigest()
+
+def _date_order(summary):
+    """Sort key putting messages without a date last."""
+    return (summary[_TIMESTAMP] is None, summary[_TIMESTAMP])
+
+def _listing_entry(summary):
+    """Get what index pages show of a message."""
+    return [summary[_PAGE], summary[_SUBJECT], summary[_FROM],
+            summary[_DATE]]
+
+def _render_pages(jobs, workers, chunk_size):
+    """Render and write pages using a pool of worker processes.
+
+    Pages are sent to the workers in chunks of `chunk_size` and at most
+    two chunks per worker are in flight at once.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        for job in jobs:
+            _render_page(job)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        chunk = []
+        for job in jobs:
+            chunk.append(job)
+            if len(chunk) >= chunk_size:
+                pending.append(pool.apply_async(_render_chunk, (chunk,)))
+                chunk = []
+            if len(pending) >= workers * 2:
+                pending.popleft().get()
+        if chunk:
+            pending.append(pool.apply_async(_render_chunk, (chunk,)))
+        while pending:
+            pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _render_chunk(jobs):
+    """Render a list of pages. Runs in the worker processes."""
+    for job in jobs:
+        _render_page(job)
+
+def _render_page(job):
+    """Render a page and write it out."""
+    output, path, kind, context = job
+    title, navigation, content = _RENDERERS[kind](context)
+    if navigation:
+        navigation = '<p>{0}</p>\n'.format(' | '.join(
+                '<a href="{0}">{1}</a>'.format(_escape(link), _escape(text))
+                for link, text in navigation))
+    page = _PAGE_TEMPLATE.format(title=_escape(title), navigation=navigation,
+            content=''.join(content))
+    _write_file(os.path.join(output, path), page.encode('utf-8'))
+
+def _render_message(context):
+    """Render a message page, reading what it shows from the spool."""
+    spool_path, offset = context['spool']
+    with open(spool_path, 'rb') as fp:
+        fp.seek(offset)
+        headers, body, attachments = json.loads(fp.readline())
+    content = ['<dl>\n']
+    for name, value in headers:
+        content.append('<dt>{0}</dt><dd>{1}</dd>\n'.format(_escape(name),
+                _escape(value)))
+    content.append('</dl>\n<pre>{0}</pre>\n'.format(_escape(body)))
+    if attachments:
+        content.append('<h2>Attachments</h2>\n<ul>\n')
+        for name, path in attachments:
+            content.append('<li><a href="../{0}">{1}</a></li>\n'.format(
+                    _escape(urllib.quote(path.encode('utf-8'))),
+                    _escape(name)))
+        content.append('</ul>\n')
+    if len(context['thread']) > 1:
+        content.append('<h2>Thread</h2>\n')
+        content.extend(_render_list(context['thread'], '',
+                context['page']))
+    return context['subject'], [
+            ('../index.html', 'Index'),
+            ('../months/{0}.html'.format(context['month']),
+                context['month']),
+            ('../threads/' + context['thread_page'], 'Thread'),
+        ], content
+
+def _render_thread(context):
+    """Render a thread page."""
+    return context['subject'], [('../index.html', 'Index')], \
+            _render_list(context['messages'], '../messages/')
+
+def _render_month(context):
+    """Render a month page."""
+    return context['month'], [('../index.html', 'Index')], \
+            _render_list(context['messages'], '../messages/')
+
+def _render_index(context):
+    """Render the top-level index page."""
+    content = ['<ul>\n']
+    for month, count in context['months']:
+        content.append('<li><a href="months/{0}.html">{1}</a> ({2})'
+                '</li>\n'.format(_escape(month), _escape(month), count))
+    content.append('</ul>\n')
+    return 'Archive', [], content
+
+def _render_list(listing, prefix, current=None):
+    """Render a list of links to messages, `current` not being linked."""
+    content = ['<ul>\n']
+    for page, subject, sender, date in listing:
+        text = '{0} &mdash; {1} &mdash; {2}'.format(_escape(subject),
+                _escape(sender), _escape(date))
+        if page == current:
+            content.append('<li>{0}</li>\n'.format(text))
+        else:
+            content.append('<li><a href="{0}{1}">{2}</a></li>\n'.format(
+                    prefix, page, text))
+    content.append('</ul>\n')
+    return content
+
+def _escape(text):
+    """Escape text for use in HTML content and attribute values."""
+    return cgi.escape(text or '', quote=True)
+
+def _write_file(path, data):
+    """Write `data` to `path` in one go, replacing it atomically."""
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path),
+            delete=False, prefix='.page') as fp:
+        fp.write(data)
+    os.rename(fp.name, path)
+
+def _local_path(output, path):
+    """Get the local path of a published file, UTF-8 encoded so that
+    non-ascii attachment names do not depend on the locale."""
+    local = os.path.join(output, *path.split('/'))
+    return local.encode('utf-8') if isinstance(local, unicode) else local
+
+def _remove(path):
+    """Remove a published file, and its directory if that is left empty."""
+    try:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+# Render functions for each kind of page.
+_RENDERERS = {
+    'message': _render_message,
+    'thread': _render_thread,
+    'month': _render_month,
+    'index': _render_index,
+}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+"""
+Email readers. Turn raw RFC-5322 messages, mbox files and Maildir trees
+into normalized UnicodeMessage objects.
+"""
+from __future__ import unicode_literals
+
+import email
+import mmap
+import os
+import re
+from email.parser import HeaderParser
+
+from email_cleanse.content import EncodedContent
+from email_cleanse.encoding import get_decoded_email_header, \
+        decode_string_to_unicode, decode_stream, get_charset
+from email_cleanse.message import UnicodeMessage, LazyUnicodeMessage, \
+        Attachment
+from email_cleanse.priors import get_keys
+
+
+# Headers copied from a MIME part onto the Attachment created for it.
+ATTACHMENT_HEADERS = (
+    'content-type',
+    'content-disposition',
+    'content-id',
+    'content-description',
+)
+
+# Matches a line which belongs to a header block: a field, a folded
+# continuation or a unix-from line. The first line which does not match
+# ends the block, as it does for the stdlib parser.
+_HEADER_LINE_RE = re.compile(br'From |[\041-\071\073-\176]+:|[\t ]')
+
+
+def normalize_message(message, header_names=None, pipeline=None,
+        priors=None):
+    """Convert a parsed email Message into a UnicodeMessage.
+
+    Headers are decoded with `get_decoded_email_header`, text parts are
+    decoded to unicode and added as alternatives and everything else is
+    split out as an Attachment. Attached messages (message/rfc822) are
+    normalized recursively and added to `message_parts`.
+
+    Args:
+        message (Message): An email Message object.
+        header_names (iterable): Names of the headers to keep. Defaults to
+            keeping all headers.
+        pipeline (AttachmentPipeline): Pipeline each attachment is
+            submitted to as soon as it is extracted. Use its `wait` to
+            wait for them to be processed.
+        priors (CharsetPriors): Charsets learned per sender domain and
+            mailing list, tried before detection when the declared
+            charset of a text part is wrong.
+
+    Returns:
+        (UnicodeMessage) The normalized message.
+    """
+    umsg = UnicodeMessage()
+    _add_headers(umsg, message, header_names)
+    _add_part(umsg, message, pipeline, priors,
+            get_keys(message) if priors is not None else None)
+    return umsg
+
+def message_from_string(text, header_names=None, pipeline=None,
+        priors=None):
+    """Parse a raw RFC-5322 message and normalize it.
+
+    Args:
+        text (string): The raw message.
+        header_names (iterable): Names of the headers to keep. Defaults to
+            keeping all headers.
+        pipeline (AttachmentPipeline): Pipeline each attachment is
+            submitted to as soon as it is extracted.
+        priors (CharsetPriors): Charsets learned per sender domain and
+            mailing list.
+
+    Returns:
+        (UnicodeMessage) The normalized message.
+    """
+    return normalize_message(email.message_from_string(text), header_names,
+            pipeline, priors)
+
+def lazy_message_from_string(text, header_names=None):
+    """Decode the headers of a raw RFC-5322 message leaving the body to be
+    parsed and decoded when it is first used.
+
+    Args:
+        text (string): The raw message.
+        header_names (iterable): Names of the headers to decode. Other
+            headers are skipped without being decoded. Defaults to all
+            headers.
+
+    Returns:
+        (LazyUnicodeMessage) The message with its headers decoded.
+    """
+    umsg = LazyUnicodeMessage(
+            lambda umsg: _add_part(umsg, email.message_from_string(text)))
+    for name, value in scan_headers(text, header_names):
+        umsg.add_header(name, value)
+    return umsg
+
+def scan_headers(raw, header_names=None, start=0, end=None):
+    """Decode headers straight from the raw bytes of a message without
+    building an email Message. Only the header block is read, folded
+    values are unfolded as the stdlib parser does and headers not in
+    `header_names` are skipped without being decoded.
+
+    Args:
+        raw (string|mmap): The raw message, or a string or mmap holding
+            it at `start`:`end`.
+        header_names (iterable): Names of the headers to decode. Defaults
+            to all headers.
+        start (int): Offset the message starts at.
+        end (int): Offset the message ends at. Defaults to the end of
+            `raw`.
+
+    Returns:
+        (list) (name, value) pairs of unicode in the order they appear.
+    """
+    if end is None:
+        end = len(raw)
+    if header_names is not None:
+        header_names = frozenset(name.lower() for name in header_names)
+    headers = []
+    name = lines = None
+    position = start
+    while position < end:
+        line_end = raw.find(b'\n', position, end)
+        line_end = end if line_end < 0 else line_end + 1
+        line = raw[position:line_end]
+        if not _HEADER_LINE_RE.match(line):
+            break
+        position = line_end
+        if line[:1] in (b' ', b'\t'):
+            # Continuations of skipped headers, or with no header to
+            # continue, are dropped.
+            if lines is not None:
+                lines.append(line)
+            continue
+        if lines is not None:
+            headers.append(_decode_scanned_header(name, lines))
+            name = lines = None
+        if line.startswith(b'From '):
+            continue
+        colon = line.index(b':')
+        if header_names is None or line[:colon].lower() in header_names:
+            name, lines = line[:colon], [line[colon + 1:].lstrip()]
+    if lines is not None:
+        headers.append(_decode_scanned_header(name, lines))
+    return headers
+
+def message_from_file(fp):
+    """Parse a raw RFC-5322 message from a file handle and normalize it.
+
+    Args:
+        fp (file): File handle positioned at the start of the message.
+
+    Returns:
+        (UnicodeMessage) The normalized message.
+    """
+    return normalize_message(email.message_from_file(fp))
+
+def iter_messages(source, lazy=False, header_names=None):
+    """Yield normalized messages from `source` one at a time.
+
+    Args:
+        source (string|file|iterable): Path to a Maildir tree or an mbox
+            file, an open mbox file handle or an iterable of raw messages.
+        lazy (bool): Yield LazyUnicodeMessage objects whose bodies are
+            only decoded when used.
+        header_names (iterable): Names of the headers to decode. Defaults
+            to all headers.
+
+    Returns:
+        (generator) UnicodeMessage objects in the order they are read.
+    """
+    if isinstance(source, basestring):
+        if os.path.isdir(source):
+            return iter_maildir(source, lazy, header_names)
+        return iter_mbox(source, lazy, header_names)
+    if hasattr(source, 'read'):
+        return iter_mbox(source, lazy, header_names)
+    return iter_raw_messages(source, lazy, header_names)
+
+def iter_raw_messages(raw_messages, lazy=False, header_names=None):
+    """Yield a normalized message for each raw message string.
+
+    Args:
+        raw_messages (iterable): Raw RFC-5322 messages.
+        lazy (bool): Yield LazyUnicodeMessage objects whose bodies are
+            only decoded when used.
+        header_names (iterable): Names of the headers to decode. Defaults
+            to all headers.
+
+    Returns:
+        (generator) UnicodeMessage objects.
+    """
+    for raw in raw_messages:
+        yield _from_string(raw, lazy, header_names)
+
+def iter_mbox(source, lazy=False, header_names=None):
+    """Yield normalized messages from an mbox file. Only one raw message
+    is held in memory at a time.
+
+    Args:
+        source (string|file): Path to the mbox file or an open file handle.
+        lazy (bool): Yield LazyUnicodeMessage objects whose bodies are
+            only decoded when used.
+        header_names (iterable): Names of the headers to decode. Defaults
+            to all headers.
+
+    Returns:
+        (generator) UnicodeMessage objects in file order.
+    """
+    for _, raw in iter_mbox_raw(source):
+        yield _from_string(raw, lazy, header_names)
+
+def iter_mbox_raw(source, offset=0):
+    """Split an mbox file into raw messages without parsing them.
+
+    Args:
+        source (string|file): Path to the mbox file or an open file handle.
+        offset (int): Byte offset of the `From ` line to start reading at.
+
+    Returns:
+        (generator) (offset, raw) pairs where offset is the byte offset of
+        the message's `From ` line and raw is the message without it.
+    """
+    for start, _, raw in iter_mbox_entries(source, offset):
+        yield start, raw
+
+def iter_mbox_entries(source, offset=0):
+    """Split an mbox file into raw messages and the byte range each one
+    occupies without parsing them.
+
+    Args:
+        source (string|file): Path to the mbox file or an open file handle.
+        offset (int): Byte offset of the `From ` line to start reading at.
+
+    Returns:
+        (generator) (start, end, raw) tuples where start is the byte offset
+        of the message's `From ` line, end is the offset of the next `From `
+        line or the end of the file and raw is the message without its
+        `From ` line.
+    """
+    if isinstance(source, basestring):
+        with open(source, 'rb') as fp:
+            for entry in _split_mbox(fp, offset):
+                yield entry
+    else:
+        for entry in _split_mbox(source, offset):
+            yield entry
+
+def iter_mbox_mapped(path):
+    """Yield normalized messages from an mbox file without decoding their
+    attachments. The file is memory mapped and each Attachment refers to
+    its still encoded byte range, which is only decoded when read. This
+    makes scanning an archive for attachment metadata cheap. The map is
+    closed when the generator finishes or is closed, so attachment
+    content must be read while iterating.
+
+    Args:
+        path (string): Path to the mbox file.
+
+    Returns:
+        (generator) UnicodeMessage objects in file order.
+    """
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for start, end in _split_mapped_mbox(mapped):
+            yield _scan_message(mapped, start, end)
+    finally:
+        mapped.close()
+
+def iter_maildir(path, lazy=False, header_names=None):
+    """Yield normalized messages from every `cur` and `new` folder found
+    under `path`, including Maildir++ sub-folders.
+
+    Args:
+        path (string): The root of the Maildir tree.
+        lazy (bool): Yield LazyUnicodeMessage objects whose bodies are
+            only decoded when used.
+        header_names (iterable): Names of the headers to decode. Defaults
+            to all headers.
+
+    Returns:
+        (generator) UnicodeMessage objects ordered by folder then filename.
+    """
+    for raw in iter_maildir_raw(path):
+        yield _from_string(raw, lazy, header_names)
+
+def iter_maildir_raw(path):
+    """Read the raw messages from a Maildir tree without parsing them.
+
+    Args:
+        path (string): The root of the Maildir tree.
+
+    Returns:
+        (generator) Raw messages ordered by folder then filename.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        if os.path.basename(dirpath) not in ('cur', 'new'):
+            continue
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            with open(os.path.join(dirpath, filename), 'rb') as fp:
+                yield fp.read()
+
+def _from_string(text, lazy, header_names):
+    """Normalize `text` eagerly or lazily."""
+    if lazy:
+        return lazy_message_from_string(text, header_names)
+    return message_from_string(text, header_names)
+
+def _split_mbox(fp, offset):
+    """Split the open mbox file `fp` on `From ` lines starting at `offset`."""
+    fp.seek(offset)
+    position = offset
+    start = None
+    lines = []
+    previous_blank = True
+    for line in fp:
+        if line.startswith(b'From ') and previous_blank:
+            if start is not None:
+                # The blank line before a `From ` line is a separator.
+                yield start, position, b''.join(lines[:-1])
+            start = position
+            lines = []
+        elif start is not None:
+            lines.append(line)
+        position += len(line)
+        previous_blank = line in (b'\n', b'\r\n')
+    if start is not None:
+        yield start, position, b''.join(lines)
+
+def _split_mapped_mbox(mapped):
+    """Yield the (start, end) range of each message in the mapped mbox,
+    excluding `From ` lines and the blank lines separating messages."""
+    if mapped[:5] == b'From ':
+        from_line, end = 0, None
+    else:
+        from_line, end = _find_mapped_from_line(mapped, 0)
+    while from_line >= 0:
+        line_end = mapped.find(b'\n', from_line)
+        if line_end < 0:
+            return
+        start = line_end + 1
+        from_line, end = _find_mapped_from_line(mapped, start)
+        yield start, end
+
+def _find_mapped_from_line(mapped, position):
+    """Find the next `From ` line which follows a blank line.
+
+    Returns:
+        (tuple) The position of the `From ` line, or -1 if there is none,
+        and the position of the blank line before it, or the end of the
+        map if there is none.
+    """
+    while True:
+        index = mapped.find(b'\nFrom ', position)
+        if index < 0:
+            return -1, len(mapped)
+        if mapped[index - 1:index] == b'\n':
+            return index + 1, index
+        if mapped[index - 2:index] == b'\n\r':
+            return index + 1, index - 1
+        position = index + 1
+
+def _scan_message(mapped, start, end):
+    """Create a UnicodeMessage from the raw message at `start`:`end` in
+    `mapped`, leaving attachments encoded in place."""
+    umsg = UnicodeMessage()
+    headers, body_start = _parse_header_block(mapped, start, end)
+    _add_headers(umsg, headers)
+    _scan_part(umsg, mapped, headers, body_start, end)
+    return umsg
+
+def _scan_part(umsg, mapped, headers, start, end):
+    """Add the MIME part with `headers` and body at `start`:`end` in
+    `mapped` to `umsg`."""
+    boundary = headers.get_boundary()
+    if headers.get_content_type() == 'message/rfc822':
+        umsg.message_parts.append(_scan_message(mapped, start, end))
+    elif headers.get_content_maintype() == 'multipart' and boundary:
+        if isinstance(boundary, unicode):
+            boundary = boundary.encode('utf-8')
+        for part_start, part_end in _split_mapped_multipart(mapped, start,
+                end, boundary):
+            part_headers, body_start = _parse_header_block(mapped,
+                    part_start, part_end)
+            _scan_part(umsg, mapped, part_headers, body_start, part_end)
+    elif _is_attachment(headers):
+        attachment = Attachment()
+        _add_attachment_headers(attachment, headers)
+        attachment.set_encoded_content(mapped, start, end - start,
+                headers.get('Content-Transfer-Encoding'))
+        umsg.enqueue_attachment(attachment)
+    else:
+        # Transcode the body straight out of the map rather than copying
+        # and decoding it whole.
+        content = EncodedContent(mapped, start, end - start,
+                headers.get('Content-Transfer-Encoding'))
+        umsg.add_alternative(decode_stream(content, get_charset(headers)),
+                headers.get_content_type())
+
+def _parse_header_block(mapped, start, end):
+    """Parse the header block starting at `start` in `mapped`, which may
+    be a string or an mmap.
+
+    Returns:
+        (tuple) The headers as a Message and the position the body starts.
+    """
+    if mapped[start:start + 1] == b'\n':
+        body_start = start + 1
+    elif mapped[start:start + 2] == b'\r\n':
+        body_start = start + 2
+    else:
+        blank = [position for position in (mapped.find(b'\n\n', start, end),
+                mapped.find(b'\n\r\n', start, end)) if position >= 0]
+        if blank:
+            position = min(blank)
+            body_start = position + (2 if mapped[position + 1] == b'\n' \
+                    else 3)
+        else:
+            body_start = end
+    headers = HeaderParser().parsestr(mapped[start:body_start],
+            headersonly=True)
+    return headers, body_start
+
+def _decode_scanned_header(name, lines):
+    """Decode a header found by `scan_headers`. The line break ending the
+    value is dropped but those between folded lines are kept."""
+    value = b''.join(lines).rstrip(b'\r\n')
+    return decode_string_to_unicode(name), get_decoded_email_header(value)
+
+def _split_mapped_multipart(mapped, start, end, boundary):
+    """Yield the (start, end) range of each part of the multipart body at
+    `start`:`end` in `mapped`."""
+    delimiter = b'--' + boundary
+    part_start = None
+    position = start
+    while position < end:
+        if mapped[position:position + len(delimiter)] != delimiter:
+            position = mapped.find(b'\n' + delimiter, position, end)
+            if position < 0:
+                break
+            position += 1
+        if part_start is not None:
+            # The line break before a delimiter belongs to the delimiter.
+            part_end = position - 1
+            if mapped[part_end - 1:part_end] == b'\r':
+                part_end -= 1
+            yield part_start, max(part_start, part_end)
+            part_start = None
+        after = position + len(delimiter)
+        if mapped[after:after + 2] == b'--':
+            return
+        line_end = mapped.find(b'\n', after, end)
+        if line_end < 0:
+            return
+        part_start = position = line_end + 1
+    if part_start is not None:
+        yield part_start, end
+
+def _add_headers(umsg, message, header_names=None):
+    """Decode the headers of `message` adding them to `umsg`. If given,
+    only headers in `header_names` are decoded and added."""
+    if header_names is not None:
+        header_names = frozenset(name.lower() for name in header_names)
+    for name, value in message.items():
+        if header_names is None or name.lower() in header_names:
+            umsg.add_header(decode_string_to_unicode(name),
+                    get_decoded_email_header(value))
+
+def _add_part(umsg, part, pipeline=None, priors=None, keys=None):
+    """Walk the MIME tree of `part` adding its leaves to `umsg`. Text is
+    decoded with `priors` for the source `keys` if given."""
+    if part.get_content_type() == 'message/rfc822':
+        for sub_message in part.get_payload():
+            umsg.message_parts.append(normalize_message(sub_message,
+                    pipeline=pipeline, priors=priors))
+    elif part.is_multipart():
+        for sub_part in part.get_payload():
+            _add_part(umsg, sub_part, pipeline, priors, keys)
+    elif _is_attachment(part):
+        attachment = _make_attachment(part)
+        umsg.enqueue_attachment(attachment)
+        if pipeline is not None:
+            pipeline.submit(umsg, attachment)
+    else:
+        payload = part.get_payload(decode=True) or b''
+        if priors is None:
+            body = decode_string_to_unicode(payload, get_charset(part))
+        else:
+            body = priors.decode(payload, get_charset(part), keys)
+        umsg.add_alternative(body, part.get_content_type())
+
+def _is_attachment(part):
+    """Return whether or not the leaf MIME `part` should be an attachment."""
+    if part.get_content_maintype() != 'text':
+        return True
+    disposition = part.get('Content-Disposition', '')
+    return disposition.strip().lower().startswith('attachment') \
+            or part.get_filename() is not None
+
+def _make_attachment(part):
+    """Create an Attachment from the leaf MIME `part`."""
+    attachment = Attachment()
+    _add_attachment_headers(attachment, part)
+    attachment.set_content(part.get_payload(decode=True) or b'')
+    return attachment
+
+def _add_attachment_headers(attachment, part):
+    """Decode the headers of `part` listed in `ATTACHMENT_HEADERS` adding
+    them to `attachment`."""
+    for name, value in part.items():
+        if name.lower() in ATTACHMENT_HEADERS:
+            attachment.add_header(decode_string_to_unicode(name),
+                    get_decoded_email_header(value))
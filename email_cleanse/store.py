@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Content addressed attachment storage. Attachment content is stored once
+per distinct SHA-256 digest and attachments refer to the stored blob
+rather than holding their own copy.
+"""
+from __future__ import unicode_literals
+
+import abc
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+from io import BytesIO
+
+
+# Size of the chunks read from attachment content while storing it.
+STORE_CHUNK_SIZE = 64 * 1024
+
+
+class BlobStore(object):
+
+    """
+    Abstract base class for content addressed blob stores. Subclasses
+    implement `_write`, `open` and `__contains__`.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        """Initialize instance of BlobStore."""
+        self.puts = 0
+        self.duplicates = 0
+        self.bytes_stored = 0
+        self.bytes_deduplicated = 0
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def __contains__(self, digest):
+        """Check whether a blob with `digest` is stored."""
+
+    def put(self, content):
+        """Store `content` unless an identical blob is already stored. The
+        content is hashed as it is copied so it is never held in memory
+        all at once.
+
+        Args:
+            content (string|file): The content or a file handle to read it
+                from, which is read from the start.
+
+        Returns:
+            (unicode) The hex SHA-256 digest identifying the blob.
+        """
+        digest, size, stored = self._write(content)
+        with self._lock:
+            self.puts += 1
+            if stored:
+                self.bytes_stored += size
+            else:
+                self.duplicates += 1
+                self.bytes_deduplicated += size
+        return digest
+
+    @abc.abstractmethod
+    def open(self, digest):
+        """Open a stored blob for reading.
+
+        Args:
+            digest (unicode): The digest returned by `put`.
+
+        Returns:
+            (file) A file handle positioned at the start of the blob.
+
+        Raises:
+            KeyError: If no blob with this digest is stored.
+        """
+
+    def reference(self, digest):
+        """Get a file-like reference to a stored blob which is only opened
+        when it is read.
+
+        Args:
+            digest (unicode): The digest returned by `put`.
+
+        Returns:
+            (BlobContent) The reference.
+        """
+        return BlobContent(self, digest)
+
+    def stats(self):
+        """Get deduplication statistics.
+
+        Returns:
+            (dict) The number of puts, how many were duplicates, the bytes
+            stored and the bytes saved by deduplication.
+        """
+        with self._lock:
+            return {
+                'puts': self.puts,
+                'duplicates': self.duplicates,
+                'bytes_stored': self.bytes_stored,
+                'bytes_deduplicated': self.bytes_deduplicated,
+            }
+
+    @abc.abstractmethod
+    def _write(self, content):
+        """Store `content`, a string or file handle.
+
+        Returns:
+            (tuple) The digest, size and whether or not it was newly stored.
+        """
+
+
+class MemoryBlobStore(BlobStore):
+
+    """
+    Blob store holding blobs in memory.
+    """
+
+    def __init__(self):
+        """Initialize instance of MemoryBlobStore."""
+        super(MemoryBlobStore, self).__init__()
+        self._blobs = dict()
+
+    def __contains__(self, digest):
+        return digest in self._blobs
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def open(self, digest):
+        return BytesIO(self._blobs[digest])
+
+    def _write(self, content):
+        if hasattr(content, 'read') and not hasattr(content, 'seek'):
+            # Content that cannot be read twice is buffered.
+            content = b''.join(_iter_chunks(content))
+        # Hash first so that content which is already stored is never
+        # buffered, then read it again only to store a new blob.
+        sha = hashlib.sha256()
+        size = 0
+        for chunk in _iter_chunks(content):
+            sha.update(chunk)
+            size += len(chunk)
+        digest = sha.hexdigest().decode('ascii')
+        with self._lock:
+            if digest in self._blobs:
+                return digest, size, False
+        blob = b''.join(_iter_chunks(content))
+        with self._lock:
+            if digest in self._blobs:
+                return digest, size, False
+            self._blobs[digest] = blob
+            return digest, size, True
+
+
+class DirectoryBlobStore(BlobStore):
+
+    """
+    Blob store holding each blob in its own file under a local directory.
+    Blobs are first written to a temporary file in the directory and then
+    renamed into place, or discarded if the blob is already stored.
+    """
+
+    def __init__(self, path):
+        """Initialize instance of DirectoryBlobStore.
+
+        Args:
+            path (string): The directory to store blobs in. Created if it
+                does not exist.
+        """
+        super(DirectoryBlobStore, self).__init__()
+        self.path = path
+        _makedirs(path)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def open(self, digest):
+        try:
+            return open(self.blob_path(digest), 'rb')
+        except IOError as error:
+            if error.errno == errno.ENOENT:
+                raise KeyError(digest)
+            raise
+
+    def blob_path(self, digest):
+        """Get the path of the file holding a blob, for serving or linking
+        to it directly.
+
+        Args:
+            digest (unicode): The digest returned by `put`.
+
+        Returns:
+            (string) The path, under the store directory.
+        """
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def _write(self, content):
+        sha = hashlib.sha256()
+        size = 0
+        fp = tempfile.NamedTemporaryFile(dir=self.path, prefix='.tmp',
+                delete=False)
+        try:
+            with fp:
+                for chunk in _iter_chunks(content):
+                    sha.update(chunk)
+                    size += len(chunk)
+                    fp.write(chunk)
+            digest = sha.hexdigest().decode('ascii')
+            blob_path = self.blob_path(digest)
+            if os.path.exists(blob_path):
+                os.remove(fp.name)
+                return digest, size, False
+            _makedirs(os.path.dirname(blob_path))
+            os.rename(fp.name, blob_path)
+        except BaseException:
+            if os.path.exists(fp.name):
+                os.remove(fp.name)
+            raise
+        return digest, size, True
+
+
+class BlobContent(object):
+
+    """
+    Read-only file-like reference to a stored blob. The blob is only
+    open while it is being read: it is opened on the first read and
+    closed again once read to the end, so that holding many references
+    does not hold many open files.
+    """
+
+    def __init__(self, store, digest):
+        """Initialize instance of BlobContent.
+
+        Args:
+            store (BlobStore): The store holding the blob.
+            digest (unicode): The digest of the blob.
+        """
+        self.store = store
+        self.digest = digest
+        self._fp = None
+        self._position = 0
+
+    def read(self, size=-1):
+        """Read up to `size` bytes, or everything if `size` is negative.
+        The blob is closed once the end is reached."""
+        fp = self._open()
+        data = fp.read(size)
+        self._position = fp.tell()
+        if size < 0 or len(data) < size:
+            self.close()
+        return data
+
+    def seek(self, position, whence=os.SEEK_SET):
+        """Move to `position` relative to `whence`."""
+        if self._fp is None and whence == os.SEEK_SET:
+            self._position = position
+        elif self._fp is None and whence == os.SEEK_CUR:
+            self._position += position
+        else:
+            fp = self._open()
+            fp.seek(position, whence)
+            self._position = fp.tell()
+
+    def tell(self):
+        """Return the current position."""
+        return self._position
+
+    def close(self):
+        """Close the blob. It is opened again, at the same position, if
+        read."""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def _open(self):
+        """Open the blob at the current position if it is not already
+        open."""
+        if self._fp is None:
+            self._fp = self.store.open(self.digest)
+            if self._position:
+                self._fp.seek(self._position)
+        return self._fp
+
+
+def store_attachments(message, store):
+    """Move the content of every attachment of `message`, and of the
+    messages attached to it, into `store`.
+
+    Args:
+        message (UnicodeMessage): The message.
+        store (BlobStore): The store to move content to.
+    """
+    for attachment in message.attachments:
+        attachment.store_content(store)
+    for message_part in message.message_parts:
+        store_attachments(message_part, store)
+
+def _iter_chunks(content):
+    """Yield `content`, a string or file handle, in chunks."""
+    if not hasattr(content, 'read'):
+        if content:
+            yield content
+        return
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    while True:
+        chunk = content.read(STORE_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+def _makedirs(path):
+    """Create the directory `path` if it does not exist."""
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Write normalized messages back out as RFC-5322 UTF-8 MIME messages.
+Headers are RFC-2047 encoded only where they hold non-ASCII text, bodies
+are written as UTF-8 and attachment content is base64 encoded as it is
+copied from its file handle.
+"""
+from __future__ import unicode_literals
+
+import base64
+import re
+import uuid
+from io import BytesIO
+
+from email_cleanse.encoding import LRUCache, HEADER_CACHE_MAX_LENGTH
+
+
+# Number of encoded header lines remembered by `header_line_cache`.
+DEFAULT_HEADER_LINE_CACHE_SIZE = 4096
+
+# Size of the chunks of attachment content copied to the output. A
+# multiple of 57 so every chunk base64 encodes to whole 76 column lines.
+WRITE_CHUNK_SIZE = 57 * 1024
+
+# Number of characters of a body encoded and written at a time.
+WRITE_TEXT_CHUNK_SIZE = 64 * 1024
+
+# Lines are folded once they would be longer than this.
+MAX_HEADER_LINE_LENGTH = 78
+
+# Maximum number of UTF-8 bytes in one encoded word, which keeps encoded
+# words within the 75 characters RFC-2047 allows.
+MAX_ENCODED_WORD_BYTES = 45
+
+# Headers describing the MIME structure of the original message. They are
+# replaced by ones describing the structure written.
+MIME_HEADERS = frozenset([
+    'content-type',
+    'content-transfer-encoding',
+    'mime-version',
+])
+
+# Encoded header lines keyed on the header name, value and line ending.
+header_line_cache = LRUCache(DEFAULT_HEADER_LINE_CACHE_SIZE)
+
+# A line break, and any white-space around it, within a header value.
+_HEADER_LINE_BREAK_RE = re.compile(r"\s*[\r\n]+\s*")
+
+_WORD_RE = re.compile(r"(\s*)(\S+)")
+
+_NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+
+
+def write_message(message, fp, linesep=b'\n'):
+    """Write `message` to `fp` as a UTF-8 MIME message.
+
+    Args:
+        message (UnicodeMessage): The message to write.
+        fp (file): The file handle to write to.
+        linesep (string): The line ending to write. Use `\\r\\n` for
+            messages to be sent over SMTP.
+    """
+    _write_headers(fp, (header for header in message.headers \
+            if header[0].lower() not in MIME_HEADERS), linesep)
+    fp.write(b'MIME-Version: 1.0' + linesep)
+    _write_entity(fp, _message_entity(message), linesep)
+
+def message_as_bytes(message, linesep=b'\n'):
+    """Get `message` as a UTF-8 MIME message.
+
+    Args:
+        message (UnicodeMessage): The message.
+        linesep (string): The line ending to use.
+
+    Returns:
+        (string) The message.
+    """
+    fp = BytesIO()
+    write_message(message, fp, linesep)
+    return fp.getvalue()
+
+def encode_header_line(name, value, linesep=b'\n'):
+    """Encode a header as a folded line, RFC-2047 encoding only the words
+    which hold non-ASCII text. Lines are remembered in
+    `header_line_cache`.
+
+    Args:
+        name (unicode): The name of the header.
+        value (unicode): The value of the header.
+        linesep (string): The line ending to use.
+
+    Returns:
+        (string) The header line, including its line ending.
+    """
+    cacheable = len(value) <= HEADER_CACHE_MAX_LENGTH
+    if cacheable:
+        key = (name, value, linesep)
+        line = header_line_cache.get(key)
+        if line is not None:
+            return line
+    line = _fold(name.encode('ascii', 'replace') + b':',
+            _iter_header_words(value), linesep)
+    if cacheable:
+        header_line_cache.put(key, line)
+    return line
+
+def _iter_header_words(value):
+    """Yield the (white-space, word) pairs of a header value. Runs of words
+    holding non-ASCII text are replaced by encoded words."""
+    value = _HEADER_LINE_BREAK_RE.sub(" ", value).strip()
+    run = None
+    for space, word in _WORD_RE.findall(value):
+        space = space or " "
+        if _needs_encoding(word):
+            if run is None:
+                run = [space, ""]
+            else:
+                run[1] += space
+            run[1] += word
+            continue
+        if run is not None:
+            for pair in _iter_encoded_words(*run):
+                yield pair
+            run = None
+        yield space, word
+    if run is not None:
+        for pair in _iter_encoded_words(*run):
+            yield pair
+
+def _needs_encoding(word):
+    """Return whether or not `word` must be RFC-2047 encoded."""
+    return bool(_NON_ASCII_RE.search(word)) or '=?' in word
+
+def _iter_encoded_words(space, text):
+    """Yield `text` as (white-space, word) pairs of base64 encoded words,
+    split on character boundaries. Decoders ignore the white-space
+    between encoded words."""
+    data = b''
+    for character in text:
+        encoded = character.encode('utf-8')
+        if data and len(data) + len(encoded) > MAX_ENCODED_WORD_BYTES:
+            yield space, "=?utf-8?b?{0}?=".format(base64.b64encode(data))
+            data, space = b'', " "
+        data += encoded
+    yield space, "=?utf-8?b?{0}?=".format(base64.b64encode(data))
+
+def _fold(line, words, linesep):
+    """Add the (white-space, word) pairs of `words` to `line`, folding
+    before the white-space of a word which would make the line too long.
+    A word is never folded onto a line of its own."""
+    lines = []
+    parts = [line]
+    length = len(line)
+    for space, word in words:
+        space, word = space.encode('ascii'), word.encode('ascii')
+        if length + len(space) + len(word) > MAX_HEADER_LINE_LENGTH \
+                and len(parts) > 1:
+            lines.append(b''.join(parts))
+            parts = []
+            length = 0
+        parts.append(space)
+        parts.append(word)
+        length += len(space) + len(word)
+    lines.append(b''.join(parts))
+    return linesep.join(lines) + linesep
+
+def _write_headers(fp, headers, linesep):
+    """Write encoded header lines for the (name, value) `headers`."""
+    for name, value in headers:
+        fp.write(encode_header_line(name, value, linesep))
+
+def _message_entity(message):
+    """Get the MIME entity to write for the body of `message`.
+
+    Entities are tuples: ('text', content type, text), ('attachment',
+    Attachment), ('message', UnicodeMessage) or ('multipart', subtype,
+    entities).
+    """
+    alternatives = [('text', content_type, text) \
+            for content_type, text in message.alternatives]
+    if len(alternatives) > 1:
+        alternatives = [('multipart', 'alternative', alternatives)]
+    entities = alternatives + \
+            [('attachment', attachment) \
+                for attachment in message.attachments] + \
+            [('message', message_part) \
+                for message_part in message.message_parts]
+    if not entities:
+        return ('text', 'text/plain', '')
+    if len(entities) == 1:
+        return entities[0]
+    return ('multipart', 'mixed', entities)
+
+def _write_entity(fp, entity, linesep):
+    """Write the headers and body of a MIME entity."""
+    kind = entity[0]
+    if kind == 'text':
+        _write_text(fp, entity[1], entity[2], linesep)
+    elif kind == 'attachment':
+        _write_attachment(fp, entity[1], linesep)
+    elif kind == 'message':
+        fp.write(b'Content-Type: message/rfc822' + linesep + linesep)
+        write_message(entity[1], fp, linesep)
+    else:
+        _write_multipart(fp, entity[1], entity[2], linesep)
+
+def _write_text(fp, content_type, text, linesep):
+    """Write a text part as UTF-8 a chunk at a time."""
+    transfer_encoding = b'8bit' if _NON_ASCII_RE.search(text) else b'7bit'
+    fp.write(b'Content-Type: ' + content_type.encode('ascii', 'replace') +
+            b'; charset="utf-8"' + linesep)
+    fp.write(b'Content-Transfer-Encoding: ' + transfer_encoding + linesep)
+    fp.write(linesep)
+    start = 0
+    while start < len(text):
+        end = start + WRITE_TEXT_CHUNK_SIZE
+        # Keep a CR LF pair in the same chunk.
+        if text[end - 1:end] == '\r':
+            end += 1
+        chunk = text[start:end].encode('utf-8')
+        chunk = chunk.replace(b'\r\n', b'\n')
+        if linesep != b'\n':
+            chunk = chunk.replace(b'\n', linesep)
+        fp.write(chunk)
+        start = end
+
+def _write_attachment(fp, attachment, linesep):
+    """Write an attachment base64 encoding its content as it is copied
+    from its file handle."""
+    headers = [header for header in attachment.headers \
+            if header[0].lower() != 'content-transfer-encoding']
+    if attachment.get_header('Content-Type') is None:
+        headers.insert(0, ('Content-Type', 'application/octet-stream'))
+    _write_headers(fp, headers, linesep)
+    fp.write(b'Content-Transfer-Encoding: base64' + linesep + linesep)
+    for chunk in attachment.iter_content(WRITE_CHUNK_SIZE):
+        encoded = base64.encodestring(chunk)
+        if linesep != b'\n':
+            encoded = encoded.replace(b'\n', linesep)
+        fp.write(encoded)
+
+def _write_multipart(fp, subtype, entities, linesep):
+    """Write a multipart entity with a new random boundary."""
+    boundary = b'=_' + uuid.uuid4().hex.encode('ascii')
+    fp.write(b'Content-Type: multipart/' + subtype.encode('ascii') +
+            b'; boundary="' + boundary + b'"' + linesep + linesep)
+    for entity in entities:
+        fp.write(b'--' + boundary + linesep)
+        _write_entity(fp, entity, linesep)
+        # The line break before a delimiter belongs to the delimiter.
+        fp.write(linesep)
+    fp.write(b'--' + boundary + b'--' + linesep)
@@ -23,6 +23,12 @@ setup(
     include_package_data = True,
     install_requires = install_requires,
     tests_require = tests_require,
+    entry_points = {
+        'console_scripts': [
+            'email-cleanse-batch = email_cleanse.batch:main',
+            'email-cleanse-publish = email_cleanse.publish:main',
+        ],
+    },
     platforms = ['any'],
     classifiers = [
         'Development Status :: 3 - Alpha',
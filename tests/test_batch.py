@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against batch normalization.
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from email_cleanse import batch
+from email_cleanse.batch import normalize_batch, normalize_archive, main, \
+        Checkpoint
+
+
+def make_raw(number):
+    return (b"From: jim@example.com\n"
+            b"Subject: =?UTF-8?Q?Message_=C5=A0_" + str(number) + b"?=\n"
+            b"\n"
+            b"Body " + str(number) + b"\n")
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.mbox = os.path.join(self.path, 'archive.mbox')
+        self.checkpoint = os.path.join(self.path, 'checkpoint.json')
+        self.append_messages(range(10))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        batch.CHECKPOINT_INTERVAL = 1000
+
+    def append_messages(self, numbers, mode='ab'):
+        with open(self.mbox, mode) as fp:
+            for number in numbers:
+                fp.write(b"From jim@example.com Wed Mar 24 12:55:34 2012\n")
+                fp.write(make_raw(number))
+                fp.write(b"\n")
+
+    def bodies(self, records):
+        return [record['alternatives'][0][1].strip() for record in records]
+
+    def test_normalize_batch_preserves_order(self):
+        raws = [make_raw(number) for number in range(25)]
+        records = list(normalize_batch(raws, workers=2, chunk_size=3))
+        self.assertEqual(['Message Š {0}'.format(number)
+                for number in range(25)],
+                [dict(record['headers'])['Subject'] for record in records])
+
+    def test_normalize_batch_in_process(self):
+        records = list(normalize_batch([make_raw(1)], workers=1))
+        self.assertEqual([('text/plain', 'Body 1\n')],
+                records[0]['alternatives'])
+
+    def test_normalize_archive(self):
+        records = list(normalize_archive(self.mbox, workers=2, chunk_size=4))
+        self.assertEqual(10, len(records))
+        self.assertEqual('Body 9\n\n', records[9]['alternatives'][0][1])
+
+    def test_main(self):
+        output = os.path.join(self.path, 'out.jsonl')
+        self.assertEqual(0, main([self.mbox, '-o', output, '-j', '2']))
+        with open(output) as fp:
+            lines = fp.readlines()
+        self.assertEqual(10, len(lines))
+        self.assertEqual('Message Š 0',
+                dict(json.loads(lines[0])['headers'])['Subject'])
+
+    def test_checkpoint_resumes_with_new_messages(self):
+        records = list(normalize_archive(self.mbox, workers=1,
+                checkpoint=self.checkpoint))
+        self.assertEqual(10, len(records))
+        self.assertEqual([], list(normalize_archive(self.mbox, workers=1,
+                checkpoint=self.checkpoint)))
+        self.append_messages(range(10, 13))
+        checkpoint = Checkpoint(self.checkpoint)
+        records = list(normalize_archive(self.mbox, workers=2,
+                checkpoint=checkpoint))
+        self.assertFalse(checkpoint.full_rescan)
+        self.assertEqual(['Body 10', 'Body 11', 'Body 12'],
+                self.bodies(records))
+        self.assertEqual(13, checkpoint.state['messages'])
+
+    def test_checkpoint_skips_incomplete_last_message(self):
+        with open(self.mbox, 'ab') as fp:
+            fp.write(b"From jim@example.com Wed Mar 24 12:55:34 2012\n")
+            fp.write(make_raw(10))
+        records = list(normalize_archive(self.mbox, workers=1,
+                checkpoint=self.checkpoint))
+        self.assertEqual(10, len(records))
+        with open(self.mbox, 'ab') as fp:
+            fp.write(b"\n")
+        records = list(normalize_archive(self.mbox, workers=1,
+                checkpoint=self.checkpoint))
+        self.assertEqual(['Body 10'], self.bodies(records))
+
+    def test_checkpoint_rescans_rewritten_mbox(self):
+        list(normalize_archive(self.mbox, workers=1,
+                checkpoint=self.checkpoint))
+        # Same size, different content.
+        self.append_messages(range(20, 30), mode='wb')
+        checkpoint = Checkpoint(self.checkpoint)
+        records = list(normalize_archive(self.mbox, workers=1,
+                checkpoint=checkpoint))
+        self.assertTrue(checkpoint.full_rescan)
+        self.assertEqual('Body 20', self.bodies(records)[0])
+        self.assertEqual(10, len(records))
+
+    def test_checkpoint_rescans_truncated_mbox(self):
+        list(normalize_archive(self.mbox, workers=1,
+                checkpoint=self.checkpoint))
+        self.append_messages(range(3), mode='wb')
+        checkpoint = Checkpoint(self.checkpoint)
+        records = list(normalize_archive(self.mbox, workers=1,
+                checkpoint=checkpoint))
+        self.assertTrue(checkpoint.full_rescan)
+        self.assertEqual(['Body 0', 'Body 1', 'Body 2'],
+                self.bodies(records))
+
+    def test_checkpoint_resumes_after_interruption(self):
+        batch.CHECKPOINT_INTERVAL = 3
+        records = normalize_archive(self.mbox, workers=1,
+                checkpoint=self.checkpoint)
+        for _ in range(4):
+            next(records)
+        # Saved after the third message.
+        self.assertEqual(3, Checkpoint(self.checkpoint).state['messages'])
+        records.close()
+        # The fourth record was not finished with, so it is yielded again.
+        records = list(normalize_archive(self.mbox, workers=1,
+                checkpoint=self.checkpoint))
+        self.assertEqual(['Body {0}'.format(number)
+                for number in range(3, 10)], self.bodies(records))
+
+    def test_checkpoint_rejects_maildir(self):
+        with self.assertRaises(ValueError):
+            normalize_archive(self.path, checkpoint=self.checkpoint)
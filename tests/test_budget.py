@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against the memory budget.
+"""
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from email_cleanse.budget import MemoryBudget, enable_budget, \
+        disable_budget, get_budget
+from email_cleanse.message import UnicodeMessage, Attachment
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = enable_budget(10000)
+
+    def tearDown(self):
+        disable_budget()
+
+    def make_attachment(self, size):
+        attachment = Attachment()
+        attachment.set_content(b'x' * size)
+        return attachment
+
+    def test_disabled(self):
+        disable_budget()
+        self.assertTrue(get_budget() is None)
+        self.make_attachment(100)
+        self.assertEqual(0, self.budget.usage)
+
+    def test_tracks_content_until_freed(self):
+        attachment = self.make_attachment(3000)
+        self.assertEqual(3000, self.budget.usage)
+        attachment.content = None
+        self.assertEqual(0, self.budget.usage)
+        self.assertEqual(3000, self.budget.stats()['peak'])
+
+    def test_spills_largest_content(self):
+        small = self.make_attachment(3000)
+        large = self.make_attachment(6000)
+        self.assertEqual(0, self.budget.spills)
+        other = self.make_attachment(4000)
+        stats = self.budget.stats()
+        self.assertEqual(1, stats['spills'])
+        self.assertEqual(6000, stats['spilled_bytes'])
+        self.assertEqual(7000, stats['usage'])
+        self.assertTrue(large.content.rolled)
+        self.assertFalse(small.content.rolled or other.content.rolled)
+        self.assertEqual(b'x' * 6000, large.as_dict()['content'])
+
+    def test_tracks_bodies_until_message_freed(self):
+        message = UnicodeMessage()
+        message.add_alternative('Grüße ' * 100)
+        message.add_alternative('<b>Grüße</b>', 'text/html')
+        self.assertTrue(self.budget.usage > 600)
+        self.assertEqual(1, self.budget.stats()['buffers'])
+        del message
+        self.assertEqual(0, self.budget.usage)
+
+    def test_wait_for_room(self):
+        budget = MemoryBudget(100)
+        message = UnicodeMessage()
+        budget.track_body(message, 'x' * 1000)
+        self.assertFalse(budget.wait_for_room(0.01))
+        waiting = threading.Thread(target=budget.wait_for_room)
+        waiting.start()
+        del message
+        waiting.join(5)
+        self.assertFalse(waiting.is_alive())
+        self.assertTrue(budget.wait_for_room())
+        self.assertTrue(budget.stats()['throttled'] >= 1)
+
+    def test_wait_for_room_outlasts_unrelated_release(self):
+        budget = MemoryBudget(100)
+        messages = [UnicodeMessage(), UnicodeMessage()]
+        for message in messages:
+            budget.track_body(message, 'x' * 1000)
+        del message
+        # Freeing one message wakes the waiter with usage still over.
+        timer = threading.Timer(0.05, messages.pop)
+        timer.start()
+        start = time.time()
+        self.assertFalse(budget.wait_for_room(0.5))
+        self.assertTrue(time.time() - start >= 0.45)
+        timer.join()
+        self.assertEqual(1, len(messages))
+        self.assertTrue(budget.usage > budget.limit)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against attachment content backends.
+"""
+from __future__ import unicode_literals
+
+import base64
+import binascii
+import mmap
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import email_cleanse.content
+from email_cleanse.content import EncodedContent, SpooledContent
+
+
+DATA = bytes(bytearray(range(256))) * 40
+
+
+class TestEncodedContent(unittest.TestCase):
+
+    def setUp(self):
+        self.read_block_size = email_cleanse.content.READ_BLOCK_SIZE
+        # Small blocks so groups and lines are split between blocks.
+        email_cleanse.content.READ_BLOCK_SIZE = 101
+
+    def tearDown(self):
+        email_cleanse.content.READ_BLOCK_SIZE = self.read_block_size
+
+    def make_content(self, encoded, transfer_encoding):
+        source = StringIO(b'HEADER' + encoded + b'TRAILER')
+        return EncodedContent(source, 6, len(encoded), transfer_encoding)
+
+    def test_read_base64(self):
+        encoded = base64.encodestring(DATA)
+        content = self.make_content(encoded, 'base64')
+        self.assertEqual(len(encoded), content.encoded_length)
+        self.assertEqual(DATA[:10], content.read(10))
+        self.assertEqual(DATA[10:], content.read())
+        self.assertEqual(b'', content.read())
+
+    def test_read_invalid_base64(self):
+        # The truncated last group is kept rather than dropped.
+        content = self.make_content(b'QUJD\nA', 'base64')
+        self.assertEqual(b'QUJDA', content.read())
+
+    def test_read_quoted_printable(self):
+        encoded = binascii.b2a_qp(DATA)
+        content = self.make_content(encoded, 'Quoted-Printable')
+        self.assertEqual(DATA, content.read())
+
+    def test_read_unencoded(self):
+        content = self.make_content(DATA, None)
+        self.assertEqual(DATA, content.read())
+
+    def test_seek(self):
+        content = self.make_content(base64.encodestring(DATA), 'base64')
+        content.seek(1000)
+        self.assertEqual(1000, content.tell())
+        self.assertEqual(DATA[1000:1010], content.read(10))
+        content.seek(0)
+        self.assertEqual(DATA[:10], content.read(10))
+
+    def test_read_mmap(self):
+        encoded = base64.encodestring(DATA)
+        with tempfile.TemporaryFile() as fp:
+            fp.write(b'HEADER' + encoded)
+            fp.flush()
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        content = EncodedContent(mapped, 6, len(encoded), 'base64')
+        self.assertEqual(DATA, content.read())
+
+
+class TestSpooledContent(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk_size = email_cleanse.content.ROLLOVER_CHUNK_SIZE
+        email_cleanse.content.ROLLOVER_CHUNK_SIZE = 7
+
+    def tearDown(self):
+        email_cleanse.content.ROLLOVER_CHUNK_SIZE = self.chunk_size
+
+    def test_rolls_over_when_large(self):
+        content = SpooledContent(16)
+        content.write(b'Small')
+        self.assertFalse(content.rolled)
+        content.write(b' grows past the limit')
+        self.assertTrue(content.rolled)
+        content.seek(0)
+        self.assertEqual(b'Small grows past the limit', content.read())
+
+    def test_rollover_keeps_position(self):
+        content = SpooledContent()
+        content.write(DATA)
+        content.seek(1000)
+        content.rollover()
+        self.assertTrue(content.rolled)
+        self.assertEqual(1000, content.tell())
+        self.assertEqual(DATA[1000:], content.read())
+        content.close()
+        self.assertTrue(content.closed)
@@ -5,6 +5,7 @@ Tests against utility encoding functions.
 from __future__ import unicode_literals
 
 import unittest
+from io import BytesIO
 
 import email_cleanse.encoding
 
@@ -61,4 +62,240 @@ class TestEncoding(unittest.TestCase):
             decoded = email_cleanse.encoding.get_decoded_email_header(encoded)
             self.assertEqual(subject, decoded)
 
+    def test_get_decoded_email_header_adjacent_encoded_words(self):
+        decoded = email_cleanse.encoding.get_decoded_email_header(
+                "=?UTF-8?Q?Igor_?==?UTF-8?Q?=C5=A0erko?=<igor@example.com>")
+        self.assertEqual("Igor Šerko<igor@example.com>", decoded)
 
+    def test_get_decoded_email_header_long_header(self):
+        # This would take minutes with a backtracking pattern.
+        text = "=?a?q?x" * 2000 + " =?UTF-8?Q?=C5=A0?=."
+        decoded = email_cleanse.encoding.get_decoded_email_header(text)
+        self.assertTrue(decoded.endswith("Š."))
+
+    def test_get_decoded_email_header_cache(self):
+        cache = email_cleanse.encoding.header_cache
+        cache.resize(10)
+        try:
+            for _ in range(2):
+                decoded = email_cleanse.encoding.get_decoded_email_header(
+                        "=?ISO-8859-2?Q?=E9rdekes?=")
+                self.assertEqual("érdekes", decoded)
+            self.assertEqual(1, cache.stats()['hits'])
+        finally:
+            cache.resize(0)
+            cache.clear()
+
+    def test_decode_headers_batch(self):
+        texts = [
+            b"Re: [list] =?UTF-8?Q?Igor_=C5=A0erko?=",
+            b"=?koi8-r?B?4tnT1NLP19nQz8zOyc3PIMkgzcHMz9rB1NLB1M7P?=",
+            b"=?x-unknown?Q?=E9rdekes?=",
+            b"plain",
+            b"Re: [list] =?UTF-8?Q?Igor_=C5=A0erko?=",
+            b"=?UTF-8?Q?Igor_?==?UTF-8?Q?=C5=A0erko?=<igor@example.com>",
+        ]
+        expected = [email_cleanse.encoding.get_decoded_email_header(text)
+                for text in texts]
+        self.assertEqual(expected,
+                email_cleanse.encoding.decode_headers_batch(texts))
+        self.assertEqual("Быстровыполнимо и малозатратно", expected[1])
+
+    def test_decode_headers_batch_decodes_duplicates_once(self):
+        stats = email_cleanse.encoding.enable_stats()
+        try:
+            decoded = email_cleanse.encoding.decode_headers_batch(
+                    [b"=?x-unknown?Q?=E9rdekes?="] * 5)
+        finally:
+            email_cleanse.encoding.disable_stats()
+        self.assertEqual(5, len(decoded))
+        self.assertEqual(1, len(set(decoded)))
+        self.assertEqual(1, stats.calls['decode_string_to_unicode'])
+        self.assertEqual(1, stats.calls['decode_headers_batch'])
+
+    def test_iter_decoded_headers(self):
+        texts = (b"=?UTF-8?Q?Message_=C5=A0_" + str(number) + b"?="
+                for number in range(25))
+        self.assertEqual(["Message Š {0}".format(number)
+                for number in range(25)],
+                list(email_cleanse.encoding.iter_decoded_headers(texts,
+                    batch_size=4)))
+
+    def test_decode_string_to_unicode_caches_detection(self):
+        cache = email_cleanse.encoding.charset_cache
+        cache.clear()
+        text = b"\xe2\xd9\xd3\xd4\xd2\xcf\xd7\xd9\xd0\xcf\xcc\xce\xc9" + \
+                b"\xcd\xcf \xc9 \xcd\xc1\xcc\xcf\xda\xc1" + \
+                b"\xd4\xd2\xc1\xd4\xce\xcf"
+        for _ in range(3):
+            decoded = email_cleanse.encoding.decode_string_to_unicode(text)
+            self.assertEqual("Быстровыполнимо и малозатратно", decoded)
+        self.assertEqual(1, cache.stats()['misses'])
+        self.assertEqual(2, cache.stats()['hits'])
+
+    def test_detect_charset_fast_paths(self):
+        cache = email_cleanse.encoding.charset_cache
+        cache.clear()
+        detect_charset = email_cleanse.encoding.detect_charset
+        self.assertEqual('utf-8-sig', detect_charset(b"\xef\xbb\xbfabc"))
+        self.assertEqual('utf-16', detect_charset(b"\xff\xfea\x00"))
+        self.assertEqual('utf-32', detect_charset(b"\xff\xfe\x00\x00"))
+        self.assertEqual('ascii', detect_charset(b"plain"))
+        self.assertEqual('utf-8', detect_charset(b"p\xc3\xb6stal"))
+        # None of these needed chardet.
+        self.assertEqual(0, cache.stats()['misses'])
+
+    def test_detect_charset_legacy_charsets(self):
+        legacy_charsets = email_cleanse.encoding.LEGACY_CHARSETS
+        email_cleanse.encoding.LEGACY_CHARSETS = ['foobar', 'cp1252']
+        try:
+            self.assertEqual('cp1252',
+                    email_cleanse.encoding.detect_charset(b"degree \x97 on"))
+        finally:
+            email_cleanse.encoding.LEGACY_CHARSETS = legacy_charsets
+
+    def test_detect_charset_byte_budget(self):
+        budget = email_cleanse.encoding.DETECTION_BYTE_BUDGET
+        email_cleanse.encoding.DETECTION_BYTE_BUDGET = 29
+        try:
+            # Only the KOI8-R prefix is examined.
+            text = b"\xe2\xd9\xd3\xd4\xd2\xcf\xd7\xd9\xd0\xcf\xcc\xce" + \
+                    b"\xc9\xcd\xcf \xc9 \xcd\xc1\xcc\xcf\xda\xc1\xd4\xd2" + \
+                    b"\xc1\xd4\xce\xcf" + b"\x00\xff" * 1000
+            self.assertEqual('KOI8-R',
+                    email_cleanse.encoding.detect_charset(text))
+        finally:
+            email_cleanse.encoding.DETECTION_BYTE_BUDGET = budget
+
+
+class TestStreamingDecoding(unittest.TestCase):
+
+    TEXT = "Hello, 本日は晴天なり、桃太郎さん。" * 200
+
+    def test_decode_stream_matches_whole_decode(self):
+        for charset in ('utf-8', 'shift_jis', 'iso-2022-jp', 'utf-16'):
+            data = self.TEXT.encode(charset)
+            # Small chunks split multibyte characters and escapes.
+            self.assertEqual(self.TEXT, email_cleanse.encoding.decode_stream(
+                    BytesIO(data), charset, chunk_size=7))
+
+    def test_decode_stream_switches_charset(self):
+        data = b"plain " * 2000 + "Grüße aus Köln".encode('utf-8')
+        stats = email_cleanse.encoding.enable_stats()
+        try:
+            decoded = email_cleanse.encoding.decode_stream(BytesIO(data),
+                    'us-ascii', chunk_size=1024)
+        finally:
+            email_cleanse.encoding.disable_stats()
+        self.assertEqual(data.decode('utf-8'), decoded)
+        self.assertEqual({'us-ascii -> utf-8': 1},
+                stats.as_dict()['detections'])
+
+    def test_decode_stream_unknown_charset(self):
+        data = "Grüße aus Köln ".encode('utf-8') * 100
+        self.assertEqual(data.decode('utf-8'),
+                email_cleanse.encoding.decode_stream(BytesIO(data),
+                    'x-unknown'))
+
+    def test_decode_stream_mislabelled_utf16(self):
+        # Without a byte order mark the utf-16 decoder fails without
+        # saying where.
+        data = b"abcd1234 " * 100
+        self.assertEqual(data.decode('ascii'),
+                email_cleanse.encoding.decode_stream(BytesIO(data),
+                    'utf-16', chunk_size=7))
+
+    def test_decode_stream_replaces_invalid_input(self):
+        data = "Grüße ".encode('utf-8') + b"\x80" + \
+                "aus Köln ".encode('utf-8') * 100
+        decoded = email_cleanse.encoding.decode_stream(BytesIO(data),
+                'utf-8', chunk_size=3)
+        self.assertEqual("Grüße \ufffd" + "aus Köln " * 100, decoded)
+
+    def test_transcode_to_utf8(self):
+        output = BytesIO()
+        size = email_cleanse.encoding.transcode_to_utf8(
+                BytesIO(self.TEXT.encode('iso-2022-jp')), output,
+                'iso-2022-jp', chunk_size=5)
+        self.assertEqual(self.TEXT.encode('utf-8'), output.getvalue())
+        self.assertEqual(len(output.getvalue()), size)
+
+
+class TestDecodingStats(unittest.TestCase):
+
+    def setUp(self):
+        email_cleanse.encoding.charset_cache.clear()
+        self.events = []
+        email_cleanse.encoding.enable_stats(
+                lambda metric, value, tags: self.events.append(
+                    (metric, tags)))
+
+    def tearDown(self):
+        email_cleanse.encoding.disable_stats()
+
+    def test_disabled(self):
+        email_cleanse.encoding.disable_stats()
+        email_cleanse.encoding.get_decoded_email_header("=?foobar?q?p=F6stal?=")
+        self.assertEqual(None, email_cleanse.encoding.get_stats())
+        self.assertEqual([], self.events)
+
+    def test_disabled_while_decoding(self):
+        def callback(metric, value, tags):
+            if metric == 'detections':
+                email_cleanse.encoding.disable_stats()
+        stats = email_cleanse.encoding.enable_stats(callback)
+        self.assertEqual('pöstal',
+                email_cleanse.encoding.get_decoded_email_header(
+                    "=?foobar?q?p=C3=B6stal?="))
+        self.assertEqual(1, stats.calls['get_decoded_email_header'])
+
+    def test_counters(self):
+        email_cleanse.encoding.get_decoded_email_header("=?foobar?q?p=F6stal?=")
+        email_cleanse.encoding.decode_string_to_unicode(b"p\xc3\xb6stal")
+        stats = email_cleanse.encoding.get_stats()
+        self.assertEqual({
+                'get_decoded_email_header': 1,
+                'decode_string_to_unicode': 2,
+            }, stats['calls'])
+        self.assertEqual(len("=?foobar?q?p=F6stal?="),
+                stats['bytes']['get_decoded_email_header'])
+        self.assertEqual(len(b"p\xf6stal") + len(b"p\xc3\xb6stal"),
+                stats['bytes']['decode_string_to_unicode'])
+        self.assertEqual({'foobar': 1, 'ascii': 1}, stats['strict_failures'])
+        self.assertEqual(1, stats['detections']['ascii -> utf-8'])
+        # Only the mislabelled iso-8859 text needed chardet.
+        self.assertEqual(1, stats['chardet_calls'])
+        self.assertIn(('chardet_calls', {}), self.events)
+        self.assertIn(('strict_failures', {'declared': 'foobar'}),
+                self.events)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = email_cleanse.encoding.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # Using `a` makes `b` the least recently used entry.
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual({
+                'hits': 2,
+                'misses': 1,
+                'evictions': 1,
+                'size': 2,
+                'maxsize': 2,
+            }, cache.stats())
+
+    def test_resize(self):
+        cache = email_cleanse.encoding.LRUCache(3)
+        for key in 'abc':
+            cache.put(key, key)
+        cache.resize(1)
+        self.assertEqual(1, len(cache))
+        self.assertEqual('c', cache.get('c'))
+        cache.resize(0)
+        cache.put('d', 'd')
+        self.assertEqual(0, len(cache))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against message export.
+"""
+from __future__ import unicode_literals
+
+import unittest
+from StringIO import StringIO
+
+import email_cleanse.export
+from email_cleanse.export import write_jsonl, iter_jsonl, write_binary, \
+        iter_binary
+from email_cleanse.message import UnicodeMessage, Attachment
+
+
+def make_messages():
+    msg_a = UnicodeMessage()
+    msg_a.add_header('Subject', 'Быстровыполнимо и малозатратно')
+    msg_a.add_header('From', 'jim@example.com')
+    msg_a.add_alternative('Grüße')
+    msg_a.add_alternative('<b>Grüße</b>', 'text/html')
+    attachment = Attachment()
+    attachment.add_header('Content-Type', 'application/octet-stream')
+    attachment.set_content(bytes(bytearray(range(256))) * 3)
+    msg_a.enqueue_attachment(attachment)
+    msg_a.enqueue_attachment(Attachment())
+    msg_b = UnicodeMessage()
+    msg_b.add_header('Subject', 'Empty')
+    return [msg_a, msg_b]
+
+
+def read_contents(records):
+    records = list(records)
+    for record in records:
+        for attachment in record['attachments']:
+            attachment['content'] = attachment['content'].read()
+    return records
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk_size = email_cleanse.export.EXPORT_CHUNK_SIZE
+        email_cleanse.export.EXPORT_CHUNK_SIZE = 30
+
+    def tearDown(self):
+        email_cleanse.export.EXPORT_CHUNK_SIZE = self.chunk_size
+
+    def test_jsonl_round_trip(self):
+        messages = make_messages()
+        output = StringIO()
+        self.assertEqual(2, write_jsonl(messages, output))
+        self.assertEqual(2, output.getvalue().count(b'\n'))
+        records = read_contents(iter_jsonl(StringIO(output.getvalue())))
+        self.assertEqual([msg.as_dict() for msg in messages], records)
+
+    def test_binary_round_trip(self):
+        messages = make_messages()
+        output = StringIO()
+        self.assertEqual(2, write_binary(messages, output))
+        records = read_contents(iter_binary(StringIO(output.getvalue())))
+        self.assertEqual([msg.as_dict() for msg in messages], records)
+
+    def test_jsonl_uneven_chunks(self):
+        content = bytes(bytearray(range(256)))
+        attachment = Attachment()
+        attachment.set_content(content)
+        # Reads which return less than asked for leave partial groups.
+        read = attachment.content.read
+        attachment.content.read = lambda size: read(min(size, 7))
+        message = UnicodeMessage()
+        message.enqueue_attachment(attachment)
+        output = StringIO()
+        write_jsonl([message], output)
+        record, = read_contents(iter_jsonl(StringIO(output.getvalue())))
+        self.assertEqual(content, record['attachments'][0]['content'])
+
+    def test_spools_large_content(self):
+        spool_max_size = email_cleanse.message.SPOOL_MAX_SIZE
+        email_cleanse.message.SPOOL_MAX_SIZE = 100
+        try:
+            messages = make_messages()
+            for write, read in ((write_jsonl, iter_jsonl),
+                    (write_binary, iter_binary)):
+                output = StringIO()
+                write(messages, output)
+                record = next(read(StringIO(output.getvalue())))
+                content = record['attachments'][0]['content']
+                self.assertTrue(content.rolled)
+                self.assertEqual(messages[0].as_dict()['attachments'][0][
+                        'content'], content.read())
+        finally:
+            email_cleanse.message.SPOOL_MAX_SIZE = spool_max_size
+
+    def test_binary_errors(self):
+        self.assertRaises(ValueError, list, iter_binary(StringIO(b'junk')))
+        output = StringIO()
+        write_binary(make_messages(), output)
+        self.assertRaises(ValueError, list,
+                iter_binary(StringIO(output.getvalue()[:-3])))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against the full-text search index.
+"""
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import email_cleanse.index
+from email_cleanse.index import SearchIndex, _encode_postings, \
+        _decode_postings
+from email_cleanse.message import UnicodeMessage
+
+
+MESSAGES = (
+    ('Annual report draft', 'Bob <bob@example.com>',
+        'The annual report is attached for review.'),
+    ('Re: Annual report draft', 'Alice <alice@example.com>',
+        'Looks good. The report annual figures need checking.'),
+    ('Grüße aus Köln', 'Jürgen <juergen@example.de>',
+        'Schöne Grüße aus der Straße.'),
+    ('Lunch', 'Bob <bob@example.com>', 'Lunch at noon, annual party later.'),
+)
+
+
+def make_message(subject, sender, body, content_type='text/plain'):
+    message = UnicodeMessage()
+    message.add_header('Subject', subject)
+    message.add_header('From', sender)
+    message.add_header('Message-Id', '<{0}@example.com>'.format(
+            len(subject)))
+    message.add_alternative(body, content_type)
+    return message
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = SearchIndex(os.path.join(self.path, 'index'),
+                flush_size=2)
+        for message in MESSAGES:
+            self.index.add(make_message(*message))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.path)
+
+    def test_postings_round_trip(self):
+        entries = [(3, [0, 5, 200]), (130, [1]), (100000, [7, 70000])]
+        data = _encode_postings(entries)
+        self.assertEqual(entries, _decode_postings(data))
+        self.assertEqual([(3, None), (130, None), (100000, None)],
+                _decode_postings(data, False))
+
+    def test_boolean_queries(self):
+        search = self.index.search
+        self.assertEqual([0, 1, 3], search('annual'))
+        self.assertEqual([0, 3], search('annual from:bob'))
+        self.assertEqual([0, 3], search('annual AND from:bob'))
+        self.assertEqual([2, 3], search('köln OR subject:lunch'))
+        self.assertEqual([0, 1], search('annual -lunch'))
+        self.assertEqual([1, 2], search('NOT from:bob'))
+        self.assertEqual([1], search('(from:bob OR from:alice) re'))
+        self.assertEqual([], search('body:draft'))
+
+    def test_phrase_queries(self):
+        search = self.index.search
+        self.assertEqual([0, 1], search('subject:"annual report"'))
+        self.assertEqual([0], search('body:"annual report"'))
+        self.assertEqual([1], search('"report annual"'))
+        self.assertEqual([2], search('"grüße aus"'))
+        self.assertEqual([0, 1], search('"annual report" -lunch',
+                limit=5))
+        self.assertEqual([0], search('"annual report"', limit=1))
+
+    def test_malformed_queries(self):
+        for query in ('', '(annual', 'annual)', 'annual OR'):
+            self.assertRaises(ValueError, self.index.search, query)
+
+    def test_document(self):
+        self.assertEqual({'key': '<5@example.com>', 'subject': 'Lunch',
+                'from': 'Bob <bob@example.com>'}, self.index.document(3))
+        self.assertRaises(KeyError, self.index.document, 4)
+
+    def test_html_bodies_stripped(self):
+        self.index.add(make_message('HTML', 'html@example.com',
+                '<p class="annual">Quarterly <b>numbers</b></p>',
+                'text/html'))
+        self.index.flush()
+        self.assertEqual([4], self.index.search('"quarterly numbers"'))
+        self.assertEqual([0, 1, 3], self.index.search('annual'))
+
+    def test_incremental_appends_and_reopen(self):
+        self.index.add(make_message('Late', 'carol@example.com',
+                'annual review'))
+        # Not searchable until flushed.
+        self.assertEqual([0, 1, 3], self.index.search('annual'))
+        self.assertEqual(5, len(self.index))
+        self.index.close()
+        self.index = SearchIndex(os.path.join(self.path, 'index'))
+        self.assertEqual([0, 1, 3, 4], self.index.search('annual'))
+        self.assertEqual(5, self.index.add(make_message('Later',
+                'dave@example.com', 'annual')))
+
+    def test_merge(self):
+        self.index.add(make_message('Late', 'carol@example.com',
+                'annual review'))
+        self.index.flush()
+        self.assertEqual(3, len(self.index._segments))
+        self.index.merge()
+        self.assertEqual(1, len(self.index._segments))
+        self.assertEqual([0, 1, 3, 4], self.index.search('annual'))
+        self.assertEqual([0, 1], self.index.search('"annual report"'))
+        self.assertEqual('Late', self.index.document(4)['subject'])
+        self.assertEqual(['index'], os.listdir(self.path))
+        self.assertEqual(4, len(os.listdir(os.path.join(self.path,
+                'index'))))
+
+    def test_merges_when_segments_accumulate(self):
+        max_segments = email_cleanse.index.MAX_SEGMENTS
+        email_cleanse.index.MAX_SEGMENTS = 3
+        try:
+            for message in MESSAGES * 2:
+                self.index.add(make_message(*message))
+        finally:
+            email_cleanse.index.MAX_SEGMENTS = max_segments
+        self.assertTrue(len(self.index._segments) <= 3)
+        self.assertEqual([0, 1, 3, 4, 5, 7, 8, 9, 11],
+                self.index.search('annual'))
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against the ingest API and LMTP front end.
+"""
+from __future__ import unicode_literals
+
+import smtplib
+import threading
+import unittest
+
+from email_cleanse.budget import enable_budget, disable_budget
+from email_cleanse.ingest import Normalizer, LMTPServer, IntakeThrottled
+from email_cleanse.message import UnicodeMessage
+
+
+RAW = (b"From: jim@example.com\r\n"
+       b"Subject: =?UTF-8?Q?Igor_=C5=A0erko?=\r\n"
+       b"\r\n"
+       b".Dot stuffed line\r\n"
+       b"Body\r\n")
+
+
+class TestNormalizer(unittest.TestCase):
+
+    def setUp(self):
+        self.normalizer = Normalizer(workers=2)
+
+    def tearDown(self):
+        self.normalizer.close()
+
+    def test_submit(self):
+        done = threading.Event()
+        results = []
+        def callback(message):
+            results.append(message)
+            done.set()
+        self.normalizer.submit(RAW, callback)
+        done.wait(10)
+        self.assertEqual('Igor Šerko', results[0].get_header('Subject'))
+
+    def test_normalize(self):
+        message = self.normalizer.normalize(RAW, 10)
+        self.assertTrue(isinstance(message, UnicodeMessage))
+
+    def test_refused_while_over_budget(self):
+        normalizer = Normalizer(self.normalizer.pool, intake_timeout=0.01)
+        budget = enable_budget(100)
+        try:
+            message = UnicodeMessage()
+            budget.track_body(message, 'x' * 1000)
+            self.assertRaises(IntakeThrottled, normalizer.submit, RAW)
+            del message
+            self.assertTrue(isinstance(normalizer.normalize(RAW, 10),
+                    UnicodeMessage))
+        finally:
+            disable_budget()
+
+
+class TestLMTPServer(unittest.TestCase):
+
+    def setUp(self):
+        self.delivered = []
+        self.server = LMTPServer(('127.0.0.1', 0), self.deliver,
+                max_connections=2, max_pending=1, max_message_size=1024,
+                hostname='lmtp.example.com')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = smtplib.LMTP(*self.server.server_address)
+
+    def tearDown(self):
+        self.client.quit()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def deliver(self, message, mail_from, recipients):
+        if 'fail@example.com' in recipients:
+            raise ValueError('rejected')
+        if 'bytes@example.com' in recipients:
+            raise ValueError(b'r\xe9jected')
+        self.delivered.append((message, mail_from, recipients))
+
+    def test_deliver(self):
+        refused = self.client.sendmail('jim@example.com',
+                ['bob@example.com', 'ann@example.com'], RAW)
+        self.assertEqual({}, refused)
+        message, mail_from, recipients = self.delivered[0]
+        self.assertEqual('jim@example.com', mail_from)
+        self.assertEqual(['bob@example.com', 'ann@example.com'], recipients)
+        self.assertEqual('Igor Šerko', message.get_header('subject'))
+        self.assertEqual([('text/plain', '.Dot stuffed line\r\nBody\r\n')],
+                message.alternatives)
+
+    def test_delivery_failure(self):
+        self.assertRaises(smtplib.SMTPDataError, self.client.sendmail,
+                'jim@example.com', ['fail@example.com'], RAW)
+        self.assertEqual([], self.delivered)
+
+    def test_delivery_failure_with_bytes_message(self):
+        self.assertRaises(smtplib.SMTPDataError, self.client.sendmail,
+                'jim@example.com', ['bytes@example.com'], RAW)
+        # The session can carry on.
+        self.client.sendmail('jim@example.com', ['bob@example.com'], RAW)
+        self.assertEqual(1, len(self.delivered))
+
+    def test_too_many_connections(self):
+        other = smtplib.LMTP(*self.server.server_address)
+        try:
+            self.assertRaises(smtplib.SMTPConnectError, smtplib.LMTP,
+                    *self.server.server_address)
+        finally:
+            other.quit()
+
+    def test_message_too_large(self):
+        self.assertRaises(smtplib.SMTPDataError, self.client.sendmail,
+                'jim@example.com', ['bob@example.com'], RAW + b"x" * 2048)
+        # The session can carry on.
+        self.client.sendmail('jim@example.com', ['bob@example.com'], RAW)
+        self.assertEqual(1, len(self.delivered))
@@ -7,7 +7,42 @@ from __future__ import unicode_literals
 import unittest
 from collections import deque
 
-from email_cleanse.message import MessagePart, UnicodeMessage, Attachment
+import email_cleanse.message
+from email_cleanse.message import HeaderList, MessagePart, UnicodeMessage, \
+        LazyUnicodeMessage, Attachment
+
+
+class TestHeaderList(unittest.TestCase):
+
+    def test_lookup(self):
+        headers = HeaderList([
+                ('Received', 'from a'),
+                ('Subject', 'This is a test'),
+                ('received', 'from b'),
+            ])
+        self.assertEqual('from a', headers.get('RECEIVED'))
+        self.assertEqual(['from a', 'from b'], headers.get_all('Received'))
+        self.assertEqual([], headers.get_all('To'))
+        self.assertEqual('none', headers.get('To', 'none'))
+
+    def test_delete_and_compact(self):
+        headers = HeaderList(
+                [('Received', str(number)) for number in range(10)])
+        headers.append(('Subject', 'This is a test'))
+        headers.append(('To', 'bob@example.com'))
+        headers.delete('received')
+        self.assertEqual(2, len(headers))
+        self.assertEqual([
+                ('Subject', 'This is a test'),
+                ('To', 'bob@example.com'),
+            ], headers)
+        self.assertEqual(('To', 'bob@example.com'), headers[1])
+        headers.replace('subject', 'Replaced')
+        self.assertEqual([
+                ('To', 'bob@example.com'),
+                ('subject', 'Replaced'),
+            ], headers)
+        self.assertEqual('Replaced', headers.get('Subject'))
 
 
 class TestMessagePart(unittest.TestCase):
@@ -28,6 +63,14 @@ class TestMessagePart(unittest.TestCase):
                 ('To', 'bob@example.com'),
             ], msg.headers)
 
+    def test_headers_setter(self):
+        msg = MessagePart()
+        msg.headers = [('Subject', 'This is a test')]
+        self.assertTrue(isinstance(msg.headers, HeaderList))
+        self.assertEqual('This is a test', msg.get_header('subject'))
+        msg.headers = None
+        self.assertEqual([], msg.headers)
+
     def test_get_headers_as_string(self):
         msg = MessagePart()
         msg.add_header('Date', 'Wed, 24 Mar 2012 12:55:34 +0000')
@@ -82,6 +125,24 @@ class TestMessagePart(unittest.TestCase):
                 ('To', '"Bob Smith" <bob@example.com>'),
             ], msg.headers)
 
+    def test_delete_header_case_insensitive(self):
+        msg = MessagePart()
+        msg.add_header('Message-Id', '<201203241234dA120Pp@foo.bar>')
+        msg.add_header('To', '"Bob Smith" <bob@example.com>')
+        msg.delete_header('message-id')
+        self.assertEqual([
+                ('To', '"Bob Smith" <bob@example.com>'),
+            ], msg.headers)
+
+    def test_get_header(self):
+        msg = MessagePart()
+        msg.add_header('Received', 'from a')
+        msg.add_header('RECEIVED', 'from b')
+        self.assertEqual('from a', msg.get_header('received'))
+        self.assertEqual(None, msg.get_header('To'))
+        self.assertEqual(['from a', 'from b'],
+                msg.get_header_values('Received'))
+
     def test_delete_header_when_none(self):
         msg = MessagePart()
         msg.delete_header('Message-Id')
@@ -132,6 +193,45 @@ class TestAttachment(unittest.TestCase):
         att.set_content('This is my attachment')
         self.assertEqual('This is my attachment', att.content.read())
 
+    def test_set_content_spools_to_disk(self):
+        spool_max_size = email_cleanse.message.SPOOL_MAX_SIZE
+        email_cleanse.message.SPOOL_MAX_SIZE = 16
+        try:
+            small = Attachment()
+            small.set_content('Small')
+            large = Attachment()
+            large.set_content('This is my larger attachment')
+        finally:
+            email_cleanse.message.SPOOL_MAX_SIZE = spool_max_size
+        self.assertFalse(small.content.rolled)
+        self.assertTrue(large.content.rolled)
+        self.assertEqual('This is my larger attachment', large.content.read())
+
+    def test_set_content_in_chunks(self):
+        content = bytes(bytearray(range(256))) * 1000
+        att = Attachment()
+        att.set_content(content)
+        self.assertEqual(content, att.content.read())
+
+    def test_iter_content(self):
+        att = Attachment()
+        att.set_content('This is my attachment')
+        self.assertEqual(['This is ', 'my attac', 'hment'],
+                list(att.iter_content(8)))
+        # Content is read from the start each time.
+        self.assertEqual(['This is my attachment'], list(att.iter_content()))
+        self.assertEqual([], list(Attachment().iter_content()))
+
+    def test_as_streaming_dict(self):
+        att = Attachment()
+        att.add_header('Content-Disposition', 'foo')
+        att.set_content('This is my attachment')
+        streaming = att.as_streaming_dict(10)
+        self.assertEqual([('Content-Disposition', 'foo')],
+                streaming['headers'])
+        self.assertEqual(['This is my', ' attachmen', 't'],
+                list(streaming['content']))
+
     def test_as_dict(self):
         att = Attachment()
         att.add_header('Content-Disposition', 'foo')
@@ -198,6 +298,26 @@ class TestUnicodeMessage(unittest.TestCase):
         msg.enqueue_attachment(att_a)
         self.assertTrue(msg.is_multipart())
 
+    def test_compact_layout(self):
+        msg = UnicodeMessage()
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertEqual({
+                'headers': [],
+                'alternatives': [],
+                'attachments': [],
+            }, msg.as_dict())
+        self.assertFalse(msg.is_multipart())
+        # Nothing has been allocated for the empty containers.
+        self.assertEqual((None, None, None, None), (msg._headers,
+                msg._alternatives, msg._attachments, msg._message_parts))
+
+    def test_header_names_interned(self):
+        msg_a = UnicodeMessage()
+        msg_b = UnicodeMessage()
+        msg_a.add_header(b'Received'.decode('ascii'), 'from a')
+        msg_b.add_header(b'Received'.decode('ascii'), 'from b')
+        self.assertIs(msg_a.headers[0][0], msg_b.headers[0][0])
+
     def test_as_dict(self):
         msg = UnicodeMessage()
         msg.add_header('To', '"Bob Smith" <bob@example.com>')
@@ -215,3 +335,47 @@ class TestUnicodeMessage(unittest.TestCase):
                     {'content': '', 'headers': []}]
             }, msg.as_dict())
 
+
+class TestLazyUnicodeMessage(unittest.TestCase):
+
+    def load(self, msg):
+        self.loads += 1
+        msg.add_alternative('This is the text part')
+        msg.enqueue_attachment(Attachment())
+
+    def setUp(self):
+        self.loads = 0
+
+    def test_headers_do_not_load(self):
+        msg = LazyUnicodeMessage(self.load)
+        msg.add_header('Subject', 'This is a test')
+        self.assertEqual('This is a test', msg.get_header('subject'))
+        self.assertFalse(msg.is_loaded)
+        self.assertEqual(0, self.loads)
+
+    def test_load_once(self):
+        msg = LazyUnicodeMessage(self.load)
+        self.assertEqual([('text/plain', 'This is the text part')],
+                msg.alternatives)
+        self.assertEqual(1, len(msg.attachments))
+        self.assertTrue(msg.is_multipart())
+        self.assertEqual(1, self.loads)
+
+    def test_as_dict_loads(self):
+        msg = LazyUnicodeMessage(self.load)
+        self.assertEqual([('text/plain', 'This is the text part')],
+                msg.as_dict()['alternatives'])
+        self.assertTrue(msg.is_loaded)
+
+    def test_failed_load_retried(self):
+        def load(msg):
+            self.load(msg)
+            if self.loads == 1:
+                raise IOError('source unavailable')
+        msg = LazyUnicodeMessage(load)
+        self.assertRaises(IOError, getattr, msg, 'alternatives')
+        self.assertFalse(msg.is_loaded)
+        self.assertEqual([('text/plain', 'This is the text part')],
+                msg.alternatives)
+        self.assertEqual(1, len(msg.attachments))
+        self.assertEqual(2, self.loads)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against the attachment pipeline.
+"""
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+import weakref
+
+from email_cleanse.message import UnicodeMessage, Attachment
+from email_cleanse.pipeline import AttachmentPipeline, AttachmentError
+from email_cleanse.reader import message_from_string
+
+
+MESSAGE = (
+    b"From: jim@example.com\n"
+    b"Subject: Attachments\n"
+    b"MIME-Version: 1.0\n"
+    b"Content-Type: multipart/mixed; boundary=\"outer\"\n"
+    b"\n"
+    b"--outer\n"
+    b"Content-Type: text/plain\n"
+    b"\n"
+    b"Body\n"
+    b"--outer\n"
+    b"Content-Type: application/octet-stream\n"
+    b"Content-Transfer-Encoding: base64\n"
+    b"\n"
+    b"AAECAw==\n"
+    b"--outer\n"
+    b"Content-Type: message/rfc822\n"
+    b"\n"
+    b"Subject: Forwarded\n"
+    b"Content-Type: application/x-virus\n"
+    b"\n"
+    b"EICAR\n"
+    b"--outer--\n"
+)
+
+
+class TestAttachmentPipeline(unittest.TestCase):
+
+    def test_processes_attachments_in_parallel(self):
+        lock = threading.Lock()
+        running = [0, 0, 0]
+        def process(message, attachment):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[:2])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+                running[2] += 1
+        message = UnicodeMessage()
+        with AttachmentPipeline(process, workers=4,
+                max_pending=2) as pipeline:
+            for _ in range(6):
+                attachment = Attachment()
+                message.enqueue_attachment(attachment)
+                pipeline.submit(message, attachment)
+            pipeline.wait(message)
+        self.assertEqual(0, running[0])
+        self.assertEqual(6, running[2])
+        # Attachments are processed in parallel, but backpressure keeps no
+        # more than max_pending in flight.
+        self.assertEqual(2, running[1])
+
+    def test_errors_raised_for_owning_message(self):
+        def process(message, attachment):
+            if attachment.content.read().startswith(b'EICAR'):
+                raise ValueError('infected')
+        with AttachmentPipeline(process) as pipeline:
+            clean = message_from_string(MESSAGE.replace(b'EICAR', b'clean'),
+                    pipeline=pipeline)
+            infected = message_from_string(MESSAGE, pipeline=pipeline)
+            pipeline.wait(clean)
+            with self.assertRaises(AttachmentError) as context:
+                pipeline.wait(infected)
+        error = context.exception
+        self.assertTrue(error.message is infected)
+        self.assertEqual(1, len(error.errors))
+        attachment, cause = error.errors[0]
+        self.assertTrue(attachment is
+                infected.message_parts[0].attachments[0])
+        self.assertEqual('infected', unicode(cause))
+
+    def test_state_released_without_wait(self):
+        def process(message, attachment):
+            if attachment.content.read().startswith(b'EICAR'):
+                raise ValueError('infected')
+        with AttachmentPipeline(process) as pipeline:
+            clean = message_from_string(MESSAGE.replace(b'EICAR', b'clean'),
+                    pipeline=pipeline)
+            infected = message_from_string(MESSAGE, pipeline=pipeline)
+        # Only the failed message keeps its state, without holding it.
+        self.assertEqual([id(infected.message_parts[0])],
+                list(pipeline._messages))
+        reference = weakref.ref(infected)
+        del clean, infected
+        self.assertTrue(reference() is None)
+        self.assertEqual({}, pipeline._messages)
+
+    def test_wait_without_attachments(self):
+        with AttachmentPipeline(lambda message, attachment: None) \
+                as pipeline:
+            pipeline.wait(UnicodeMessage())
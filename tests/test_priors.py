@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against the charset priors.
+"""
+from __future__ import unicode_literals
+
+import email
+import os
+import shutil
+import tempfile
+import unittest
+
+import email_cleanse.encoding
+from email_cleanse.encoding import charset_cache
+from email_cleanse.priors import CharsetPriors, get_keys
+from email_cleanse.reader import message_from_string
+
+
+BODY = 'Быстровыполнимо и малозатратно'
+
+MESSAGE = (
+    b"From: Igor <igor@Example.RU>\n"
+    b"List-Id: Russian users <users.lists.example.org>\n"
+    b"Content-Type: text/plain; charset=utf-8\n"
+    b"\n"
+) + BODY.encode('koi8-r')
+
+
+class TestCharsetPriors(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'priors.json')
+        self.stats = email_cleanse.encoding.enable_stats()
+        charset_cache.clear()
+
+    def tearDown(self):
+        email_cleanse.encoding.disable_stats()
+        shutil.rmtree(self.directory)
+
+    def test_get_keys(self):
+        self.assertEqual(['list:users.lists.example.org', 'domain:example.ru'],
+                get_keys(email.message_from_string(MESSAGE)))
+        self.assertEqual([], get_keys(email.message_from_string(b"\n")))
+
+    def test_prior_skips_detection(self):
+        priors = CharsetPriors()
+        priors.record(['domain:example.ru'], 'KOI8-R')
+        message = message_from_string(MESSAGE, priors=priors)
+        self.assertEqual([('text/plain', BODY)], message.alternatives)
+        self.assertEqual(0, self.stats.chardet_calls)
+        self.assertEqual(1, priors.stats()['hits'])
+        # The list is learned from the message.
+        self.assertEqual('koi8-r',
+                priors.get(['list:users.lists.example.org']))
+
+    def test_failed_prior_falls_back_to_detection(self):
+        priors = CharsetPriors()
+        priors.record(['domain:example.ru'], 'ascii')
+        priors.decode(b'Gr\xfc\xdfe aus K\xf6ln', 'utf-8',
+                ['domain:example.ru'])
+        self.assertEqual(1, self.stats.chardet_calls)
+        self.assertEqual(1, priors.stats()['misses'])
+
+    def test_ascii_bodies_not_recorded(self):
+        priors = CharsetPriors()
+        self.assertEqual('plain', priors.decode(b'plain', 'utf-8',
+                ['domain:example.com']))
+        self.assertEqual(0, len(priors))
+
+    def test_scores_decay(self):
+        priors = CharsetPriors()
+        keys = ['domain:example.com']
+        for _ in range(3):
+            priors.record(keys, 'koi8-r')
+        priors.record(keys, 'utf-8')
+        self.assertEqual('koi8-r', priors.get(keys))
+        priors.record(keys, 'utf-8')
+        self.assertEqual('utf-8', priors.get(keys))
+        for _ in range(20):
+            priors.record(keys, 'utf-8')
+        self.assertEqual(['utf-8'], list(priors._scores[keys[0]]))
+
+    def test_evicts_least_recently_seen(self):
+        priors = CharsetPriors(maxsize=2)
+        priors.record(['domain:a.com'], 'utf-8')
+        priors.record(['domain:b.com'], 'utf-8')
+        priors.get(['domain:a.com'])
+        priors.record(['domain:a.com'], 'utf-8')
+        priors.record(['domain:c.com'], 'utf-8')
+        self.assertEqual(None, priors.get(['domain:b.com']))
+        self.assertEqual('utf-8', priors.get(['domain:a.com']))
+        self.assertEqual(1, priors.stats()['evictions'])
+
+    def test_save_and_load(self):
+        priors = CharsetPriors(self.path)
+        priors.record(['domain:a.com'], 'utf-8')
+        priors.record(['domain:b.com'], 'koi8-r')
+        priors.save()
+        loaded = CharsetPriors(self.path, maxsize=1)
+        self.assertEqual(1, len(loaded))
+        self.assertEqual('koi8-r', loaded.get(['domain:b.com']))
+        self.assertEqual(['priors.json'], os.listdir(self.directory))
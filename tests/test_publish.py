@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against the static HTML publisher.
+"""
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from email_cleanse.publish import publish, _page_name
+from email_cleanse.reader import message_from_string
+
+
+FIRST = (
+    b"From: Jim <jim@example.com>\n"
+    b"Subject: =?utf-8?q?Gr=C3=BC=C3=9Fe?=\n"
+    b"Date: Thu, 1 Jan 2015 10:00:00 +0000\n"
+    b"Message-Id: <1@example.com>\n"
+    b"MIME-Version: 1.0\n"
+    b"Content-Type: multipart/mixed; boundary=\"outer\"\n"
+    b"\n"
+    b"--outer\n"
+    b"Content-Type: text/plain; charset=utf-8\n"
+    b"\n"
+    b"Hello <world> & everyone\n"
+    b"--outer\n"
+    b"Content-Type: application/pdf; name=\"report.pdf\"\n"
+    b"Content-Disposition: attachment; filename=\"report.pdf\"\n"
+    b"Content-Transfer-Encoding: base64\n"
+    b"\n"
+    b"JVBERi0xLjQ=\n"
+    b"--outer--\n"
+)
+
+REPLY = (
+    b"From: Bob <bob@example.com>\n"
+    b"Subject: Re: Gruesse\n"
+    b"Date: Mon, 2 Feb 2015 10:00:00 +0000\n"
+    b"Message-Id: <2@example.com>\n"
+    b"In-Reply-To: <1@example.com>\n"
+    b"References: <1@example.com>\n"
+    b"\n"
+    b"Reply\n"
+)
+
+OTHER = (
+    b"From: Alice <alice@example.com>\n"
+    b"Subject: Other\n"
+    b"Date: Tue, 3 Feb 2015 10:00:00 +0000\n"
+    b"Message-Id: <3@example.com>\n"
+    b"\n"
+    b"Another thread\n"
+)
+
+
+def read(path):
+    with io.open(path, encoding='utf-8') as fp:
+        return fp.read()
+
+
+class TestPublish(unittest.TestCase):
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def publish(self, raw_messages, workers=1, chunk_size=64):
+        return publish([message_from_string(raw) for raw in raw_messages],
+                self.output, workers, chunk_size)
+
+    def page(self, *parts):
+        return os.path.join(self.output, *parts)
+
+    def test_pages(self):
+        stats = self.publish([FIRST, REPLY, OTHER])
+        self.assertEqual({'pages': 8, 'rendered': 8, 'unchanged': 0,
+                'removed': 0, 'attachments': 1}, stats)
+        first = read(self.page('messages', _page_name('<1@example.com>')))
+        self.assertTrue('<title>Grüße</title>' in first)
+        self.assertTrue('Hello &lt;world&gt; &amp; everyone' in first)
+        self.assertTrue('>report.pdf</a>' in first)
+        self.assertTrue('href="../messages/' not in first)
+        self.assertTrue('href="{0}"'.format(_page_name('<2@example.com>'))
+                in first)
+        link = first.split('href="../files/')[1].split('"')[0]
+        self.assertTrue(link.endswith('/report.pdf'))
+        with open(self.page('files', *link.split('/')), 'rb') as fp:
+            self.assertEqual(b'%PDF-1.4', fp.read())
+        thread = read(self.page('threads', _page_name('<1@example.com>')))
+        self.assertEqual(2, thread.count('<li>'))
+        self.assertEqual(1, read(self.page('months',
+                '2015-01.html')).count('<li>'))
+        self.assertEqual(2, read(self.page('months',
+                '2015-02.html')).count('<li>'))
+        index = read(self.page('index.html'))
+        self.assertTrue(index.index('2015-02') < index.index('2015-01'))
+
+    def test_incremental(self):
+        self.publish([FIRST, OTHER])
+        other = self.page('messages', _page_name('<3@example.com>'))
+        os.utime(other, (1000000000, 1000000000))
+        # The reply changes the thread and month pages it belongs to, the
+        # first message's page, which lists the thread, and the index.
+        stats = self.publish([FIRST, REPLY, OTHER])
+        self.assertEqual({'pages': 8, 'rendered': 5, 'unchanged': 3,
+                'removed': 0, 'attachments': 1}, stats)
+        self.assertEqual(1000000000, os.path.getmtime(other))
+        stats = self.publish([FIRST, REPLY, OTHER])
+        self.assertEqual(0, stats['rendered'])
+
+    def test_removes_pages_of_removed_messages(self):
+        self.publish([FIRST, REPLY, OTHER])
+        stats = self.publish([FIRST, REPLY])
+        self.assertEqual(2, stats['removed'])
+        self.assertFalse(os.path.exists(self.page('messages',
+                _page_name('<3@example.com>'))))
+
+    def test_rerenders_missing_pages(self):
+        self.publish([OTHER])
+        os.remove(self.page('index.html'))
+        self.assertEqual(1, self.publish([OTHER])['rendered'])
+
+    def test_duplicate_message_ids(self):
+        resent = OTHER.replace(b'Another thread', b'Resent with changes')
+        raw_messages = [FIRST, OTHER, OTHER, resent]
+        stats = self.publish(raw_messages)
+        # The exact copy is dropped, the changed one gets its own page.
+        self.assertEqual({'pages': 8, 'rendered': 8, 'unchanged': 0,
+                'removed': 0, 'attachments': 1}, stats)
+        self.assertEqual(2, read(self.page('threads',
+                _page_name('<3@example.com>'))).count('<li>'))
+        for _ in range(2):
+            self.assertEqual(0, self.publish(raw_messages)['rendered'])
+
+    def test_attachment_file_names(self):
+        raw = FIRST.replace(b'Content-Disposition: attachment; '
+                b'filename="report.pdf"',
+                b"Content-Disposition: attachment;\n"
+                b" filename*=utf-8''Gr%C3%BC%C3%9Fe%20%2F%20report.pdf")
+        raw = raw.replace(b'; name="report.pdf"', b'')
+        unnamed = OTHER.replace(b'\n\nAnother thread\n',
+                b'\nContent-Type: application/pdf\n'
+                b'Content-Transfer-Encoding: base64\n\nJVBERi0xLjQ=\n')
+        self.publish([raw, unnamed])
+        first = read(self.page('messages', _page_name('<1@example.com>')))
+        self.assertTrue('>Grüße _ report.pdf</a>' in first)
+        self.assertTrue('/Gr%C3%BC%C3%9Fe%20_%20report.pdf"' in first)
+        other = read(self.page('messages', _page_name('<3@example.com>')))
+        link = other.split('href="../files/')[1].split('"')[0]
+        self.assertTrue(link.endswith('/attachment.pdf'))
+        # Both link to the one stored blob.
+        self.assertEqual(1, len(os.listdir(self.page('attachments'))))
+        self.publish([FIRST])
+        self.assertFalse(os.path.exists(self.page('files',
+                *link.split('/'))))
+
+    def test_worker_processes(self):
+        stats = self.publish([FIRST, REPLY, OTHER], workers=2, chunk_size=1)
+        self.assertEqual(8, stats['rendered'])
+        self.assertTrue(os.path.exists(self.page('threads',
+                _page_name('<3@example.com>'))))
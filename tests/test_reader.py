@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against email readers.
+"""
+from __future__ import unicode_literals
+
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from email_cleanse.content import EncodedContent
+from email_cleanse.message import LazyUnicodeMessage
+from email_cleanse.reader import message_from_string, iter_mbox, \
+        iter_mbox_raw, iter_mbox_mapped, iter_maildir, iter_messages, \
+        lazy_message_from_string, scan_headers
+
+
+SIMPLE_MESSAGE = (
+    b"From: \"=?UTF-8?Q?Igor_=C5=A0erko?=\"\n"
+    b"To: bob@example.com\n"
+    b"Subject: =?koi8-r?B?4tnT1NLP19nQz8zOyc3PIMkgzcHMz9rB1NLB1M7P?=\n"
+    b"Content-Type: text/plain; charset=iso-8859-2\n"
+    b"\n"
+    b"\xe9rdekes\n"
+)
+
+MULTIPART_MESSAGE = (
+    b"From: jim@example.com\n"
+    b"Subject: Multipart\n"
+    b"MIME-Version: 1.0\n"
+    b"Content-Type: multipart/mixed; boundary=\"outer\"\n"
+    b"\n"
+    b"--outer\n"
+    b"Content-Type: multipart/alternative; boundary=\"inner\"\n"
+    b"\n"
+    b"--inner\n"
+    b"Content-Type: text/plain; charset=utf-8\n"
+    b"\n"
+    b"Plain p\xc3\xb6stal\n"
+    b"--inner\n"
+    b"Content-Type: text/html; charset=utf-8\n"
+    b"\n"
+    b"<b>HTML</b>\n"
+    b"--inner--\n"
+    b"--outer\n"
+    b"Content-Type: application/octet-stream\n"
+    b"Content-Disposition: attachment; filename=\"data.bin\"\n"
+    b"Content-Transfer-Encoding: base64\n"
+    b"X-Ignored: yes\n"
+    b"\n"
+    b"AAECAw==\n"
+    b"--outer\n"
+    b"Content-Type: message/rfc822\n"
+    b"\n"
+    b"From: bob@example.com\n"
+    b"Subject: Forwarded\n"
+    b"\n"
+    b"Inner body\n"
+    b"--outer--\n"
+)
+
+MBOX = (
+    b"From jim@example.com Wed Mar 24 12:55:34 2012\n" + SIMPLE_MESSAGE +
+    b"\n"
+    b"From bob@example.com Wed Mar 24 12:56:34 2012\n" + MULTIPART_MESSAGE
+)
+
+
+class TestReader(unittest.TestCase):
+
+    def test_message_from_string(self):
+        msg = message_from_string(SIMPLE_MESSAGE)
+        self.assertEqual([
+                ('From', '"Igor Šerko"'),
+                ('To', 'bob@example.com'),
+                ('Subject', 'Быстровыполнимо и малозатратно'),
+                ('Content-Type', 'text/plain; charset=iso-8859-2'),
+            ], msg.headers)
+        self.assertEqual([('text/plain', 'érdekes\n')], msg.alternatives)
+        self.assertFalse(msg.attachments)
+
+    def test_message_from_string_multipart(self):
+        msg = message_from_string(MULTIPART_MESSAGE)
+        self.assertEqual([
+                ('text/plain', 'Plain pöstal'),
+                ('text/html', '<b>HTML</b>'),
+            ], msg.alternatives)
+        self.assertEqual([{
+                'headers': [
+                    ('Content-Type', 'application/octet-stream'),
+                    ('Content-Disposition',
+                        'attachment; filename="data.bin"'),
+                ],
+                'content': b'\x00\x01\x02\x03',
+            }], [att.as_dict() for att in msg.attachments])
+        self.assertEqual(1, len(msg.message_parts))
+        self.assertEqual([('text/plain', 'Inner body')],
+                msg.message_parts[0].alternatives)
+
+    def test_lazy_message_from_string(self):
+        msg = lazy_message_from_string(MULTIPART_MESSAGE,
+                header_names=['subject', 'FROM'])
+        self.assertTrue(isinstance(msg, LazyUnicodeMessage))
+        self.assertEqual([
+                ('From', 'jim@example.com'),
+                ('Subject', 'Multipart'),
+            ], msg.headers)
+        self.assertFalse(msg.is_loaded)
+        self.assertEqual(message_from_string(MULTIPART_MESSAGE).alternatives,
+                msg.alternatives)
+        self.assertTrue(msg.is_loaded)
+        self.assertEqual(1, len(msg.attachments))
+        self.assertEqual(1, len(msg.message_parts))
+
+    def test_iter_mbox_lazy(self):
+        messages = list(iter_mbox(StringIO(MBOX), lazy=True,
+                header_names=['Subject']))
+        self.assertEqual([[('Subject', 'Быстровыполнимо и малозатратно')],
+                [('Subject', 'Multipart')]],
+                [list(msg.headers) for msg in messages])
+        self.assertEqual([('text/plain', 'érdekes\n')],
+                messages[0].as_dict()['alternatives'])
+
+    def test_iter_mbox_raw_offsets(self):
+        entries = list(iter_mbox_raw(StringIO(MBOX)))
+        self.assertEqual(2, len(entries))
+        self.assertEqual(0, entries[0][0])
+        self.assertEqual(MBOX.index(b"From bob@"), entries[1][0])
+        self.assertEqual(SIMPLE_MESSAGE, entries[0][1])
+        # Start part way through the file.
+        self.assertEqual([entries[1]],
+                list(iter_mbox_raw(StringIO(MBOX), entries[1][0])))
+
+    def test_iter_mbox(self):
+        subjects = [msg.headers[2][1] for msg in iter_mbox(StringIO(MBOX))]
+        self.assertEqual('Быстровыполнимо и малозатратно', subjects[0])
+        self.assertEqual(2, len(subjects))
+
+
+class TestHeaderScanner(unittest.TestCase):
+
+    def test_scan_headers_matches_parser(self):
+        for raw in (SIMPLE_MESSAGE, MULTIPART_MESSAGE,
+                MULTIPART_MESSAGE.replace(b"\n", b"\r\n")):
+            self.assertEqual(list(message_from_string(raw).headers),
+                    scan_headers(raw))
+
+    def test_scan_headers_selected_names(self):
+        self.assertEqual([('Subject', 'Быстровыполнимо и малозатратно')],
+                scan_headers(SIMPLE_MESSAGE, ['SUBJECT']))
+
+    def test_scan_headers_folding(self):
+        raw = (b" orphan continuation\r\n"
+               b"Subject: =?UTF-8?Q?Igor_?=\r\n"
+               b"\t=?UTF-8?Q?=C5=A0erko?= and\r\n"
+               b"  more\r\n"
+               b"Not a header line\r\n"
+               b"To: bob@example.com\r\n")
+        headers = scan_headers(raw)
+        self.assertEqual(['Subject'], [name for name, _ in headers])
+        self.assertTrue(headers[0][1].startswith('Igor Šerko'))
+        self.assertEqual(list(message_from_string(raw).headers), headers)
+
+    def test_scan_headers_range_of_mmap(self):
+        with tempfile.TemporaryFile() as fp:
+            fp.write(MBOX)
+            fp.flush()
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = MBOX.index(b"From bob@")
+                self.assertEqual([('Subject', 'Multipart')],
+                        scan_headers(mapped, ['subject'], start, len(MBOX)))
+            finally:
+                mapped.close()
+
+
+class TestMappedMboxReader(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.path = tempfile.mkstemp()
+        with open(self.path, 'wb') as fp:
+            fp.write(MBOX)
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.path)
+
+    def test_iter_mbox_mapped(self):
+        parsed = list(iter_mbox(self.path))
+        mapped = []
+        for mapped_msg in iter_mbox_mapped(self.path):
+            parsed_msg = parsed[len(mapped)]
+            mapped.append(mapped_msg)
+            self.assertEqual(parsed_msg.as_dict(), mapped_msg.as_dict())
+        self.assertEqual(2, len(mapped))
+        self.assertEqual([('text/plain', 'Inner body')],
+                mapped[1].message_parts[0].alternatives)
+        attachment = mapped[1].attachments[0]
+        self.assertTrue(isinstance(attachment.content, EncodedContent))
+        self.assertEqual(len(b"AAECAw=="),
+                attachment.content.encoded_length)
+
+    def test_iter_mbox_mapped_mislabelled_utf16(self):
+        with open(self.path, 'wb') as fp:
+            fp.write(MBOX.replace(b'charset=iso-8859-2', b'charset=utf-16')
+                    .replace(b'\xe9rdekes', b'Hello there'))
+        messages = list(iter_mbox_mapped(self.path))
+        self.assertEqual(2, len(messages))
+        self.assertEqual([('text/plain', 'Hello there\n')],
+                messages[0].alternatives)
+
+    def test_iter_mbox_mapped_closes_map(self):
+        messages = iter_mbox_mapped(self.path)
+        next(messages)
+        attachment = next(messages).attachments[0]
+        self.assertEqual(b'\x00\x01\x02\x03', attachment.content.read())
+        self.assertRaises(StopIteration, next, messages)
+        attachment.content.seek(0)
+        self.assertRaises(ValueError, attachment.content.read)
+
+    def test_iter_mbox_mapped_crlf(self):
+        with open(self.path, 'wb') as fp:
+            fp.write(MBOX.replace(b"\n", b"\r\n"))
+        messages = iter_mbox_mapped(self.path)
+        next(messages)
+        message = next(messages)
+        self.assertEqual([
+                ('text/plain', 'Plain pöstal'),
+                ('text/html', '<b>HTML</b>'),
+            ], message.alternatives)
+        self.assertEqual(b'\x00\x01\x02\x03',
+                message.attachments[0].content.read())
+        self.assertEqual([], list(messages))
+
+
+class TestMaildirReader(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for folder in ('cur', 'new', 'tmp', '.Sub/cur'):
+            os.makedirs(os.path.join(self.path, folder))
+        with open(os.path.join(self.path, 'cur', '1.host'), 'wb') as fp:
+            fp.write(SIMPLE_MESSAGE)
+        with open(os.path.join(self.path, 'tmp', '2.host'), 'wb') as fp:
+            fp.write(SIMPLE_MESSAGE)
+        with open(os.path.join(self.path, '.Sub/cur', '3.host'), 'wb') as fp:
+            fp.write(MULTIPART_MESSAGE)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_iter_maildir(self):
+        messages = list(iter_maildir(self.path))
+        self.assertEqual(2, len(messages))
+        self.assertEqual('Multipart', dict(messages[0].headers)['Subject'])
+
+    def test_iter_messages_dispatch(self):
+        self.assertEqual(2, len(list(iter_messages(self.path))))
+        self.assertEqual(1, len(list(iter_messages([SIMPLE_MESSAGE]))))
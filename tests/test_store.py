@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against content addressed attachment storage.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import email_cleanse.store
+from email_cleanse.message import UnicodeMessage, Attachment
+from email_cleanse.store import BlobStore, MemoryBlobStore, \
+        DirectoryBlobStore, BlobContent, store_attachments
+
+
+LOGO = b'\x89PNG' + b'\x00' * 100
+LOGO_DIGEST = hashlib.sha256(LOGO).hexdigest()
+
+
+class BlobStoreTests(object):
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.chunk_size = email_cleanse.store.STORE_CHUNK_SIZE
+        email_cleanse.store.STORE_CHUNK_SIZE = 7
+        self.store = self.make_store()
+
+    def tearDown(self):
+        email_cleanse.store.STORE_CHUNK_SIZE = self.chunk_size
+
+    def test_put_deduplicates(self):
+        first = Attachment()
+        first.set_content(LOGO)
+        self.assertEqual(LOGO_DIGEST, self.store.put(first.content))
+        self.assertEqual(LOGO_DIGEST, self.store.put(LOGO))
+        self.assertTrue(LOGO_DIGEST in self.store)
+        self.assertEqual(LOGO, self.store.open(LOGO_DIGEST).read())
+        self.assertEqual({
+                'puts': 2,
+                'duplicates': 1,
+                'bytes_stored': len(LOGO),
+                'bytes_deduplicated': len(LOGO),
+            }, self.store.stats())
+
+    def test_open_missing(self):
+        self.assertRaises(KeyError, self.store.open, LOGO_DIGEST)
+
+    def test_store_attachments(self):
+        message = UnicodeMessage()
+        inner = UnicodeMessage()
+        message.message_parts.append(inner)
+        for msg in (message, message, inner):
+            attachment = Attachment()
+            attachment.set_content(LOGO)
+            msg.enqueue_attachment(attachment)
+        store_attachments(message, self.store)
+        attachments = list(message.attachments) + list(inner.attachments)
+        for attachment in attachments:
+            self.assertTrue(isinstance(attachment.content, BlobContent))
+            self.assertEqual(LOGO_DIGEST, attachment.content.digest)
+            self.assertEqual(LOGO, attachment.as_dict()['content'])
+        self.assertEqual(2, self.store.stats()['duplicates'])
+
+    def test_reference_closed_once_read(self):
+        digest = self.store.put(LOGO)
+        content = self.store.reference(digest)
+        self.assertEqual(LOGO[:10], content.read(10))
+        self.assertTrue(content._fp is not None)
+        self.assertEqual(LOGO[10:], content.read())
+        self.assertTrue(content._fp is None)
+        self.assertEqual(len(LOGO), content.tell())
+        content.seek(4)
+        self.assertTrue(content._fp is None)
+        self.assertEqual(LOGO[4:], content.read(1000))
+        self.assertTrue(content._fp is None)
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, BlobStore)
+
+
+class TestMemoryBlobStore(BlobStoreTests, unittest.TestCase):
+
+    def make_store(self):
+        return MemoryBlobStore()
+
+    def test_duplicate_read_once(self):
+        self.store.put(LOGO)
+        content = io.BytesIO(LOGO)
+        reads = []
+        read = content.read
+        content.read = lambda size: reads.append(size) or read(size)
+        self.assertEqual(LOGO_DIGEST, self.store.put(content))
+        # Hashed in one pass and never read again to be stored.
+        self.assertEqual(len(LOGO) // 7 + 2, len(reads))
+
+
+class TestDirectoryBlobStore(BlobStoreTests, unittest.TestCase):
+
+    def make_store(self):
+        self.path = tempfile.mkdtemp()
+        return DirectoryBlobStore(os.path.join(self.path, 'blobs'))
+
+    def tearDown(self):
+        super(TestDirectoryBlobStore, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def test_layout(self):
+        self.store.put(LOGO)
+        self.store.put(LOGO)
+        self.assertEqual([LOGO_DIGEST[:2]],
+                os.listdir(os.path.join(self.path, 'blobs')))
+        self.assertEqual([LOGO_DIGEST[2:]], os.listdir(os.path.join(
+                self.path, 'blobs', LOGO_DIGEST[:2])))
+
+    def test_failed_put_removes_temporary_file(self):
+        class Failing(object):
+            def read(self, size):
+                raise IOError('disconnected')
+        self.assertRaises(IOError, self.store.put, Failing())
+        self.assertEqual([], os.listdir(os.path.join(self.path, 'blobs')))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against writing messages as MIME.
+"""
+from __future__ import unicode_literals
+
+import unittest
+from StringIO import StringIO
+
+import email_cleanse.writer
+from email_cleanse.message import UnicodeMessage, Attachment
+from email_cleanse.reader import message_from_string
+from email_cleanse.writer import encode_header_line, message_as_bytes, \
+        header_line_cache
+
+
+def make_message():
+    msg = UnicodeMessage()
+    msg.add_header('From', 'jim@example.com')
+    msg.add_header('Subject', 'Быстровыполнимо и малозатратно')
+    msg.add_header('Content-Type', 'text/plain; charset=koi8-r')
+    msg.add_alternative('Grüße\r\naus Köln\n')
+    msg.add_alternative('<b>Grüße</b>', 'text/html')
+    attachment = Attachment()
+    attachment.add_header('Content-Type', 'application/octet-stream')
+    attachment.add_header('Content-Transfer-Encoding', 'quoted-printable')
+    attachment.set_content(bytes(bytearray(range(256))) * 3)
+    msg.enqueue_attachment(attachment)
+    forwarded = UnicodeMessage()
+    forwarded.add_header('Subject', 'Forwarded')
+    forwarded.add_alternative('Inner body')
+    msg.message_parts.append(forwarded)
+    return msg
+
+
+class TestWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk_size = email_cleanse.writer.WRITE_CHUNK_SIZE
+        email_cleanse.writer.WRITE_CHUNK_SIZE = 57
+
+    def tearDown(self):
+        email_cleanse.writer.WRITE_CHUNK_SIZE = self.chunk_size
+
+    def test_encode_header_line_ascii(self):
+        self.assertEqual(b"To: \"Bob\" <bob@example.com>\n",
+                encode_header_line('To', '"Bob" <bob@example.com>'))
+
+    def test_encode_header_line_encodes_only_non_ascii(self):
+        self.assertEqual(
+                b"From: Igor =?utf-8?b?xaBlcmtv?= <igor@example.com>\r\n",
+                encode_header_line('From', 'Igor Šerko <igor@example.com>',
+                    b"\r\n"))
+
+    def test_encode_header_line_folds(self):
+        line = encode_header_line('Subject', 'Grüße aus Köln ' * 10 +
+                'plain words ' * 10)
+        lines = line.split(b"\n")
+        self.assertEqual(b"", lines[-1])
+        for folded in lines[1:-1]:
+            self.assertTrue(folded.startswith(b" "))
+        self.assertTrue(max(len(folded) for folded in lines) <= 78)
+
+    def test_encode_header_line_cache(self):
+        header_line_cache.clear()
+        for _ in range(3):
+            encode_header_line('Subject', 'Grüße')
+        self.assertEqual(2, header_line_cache.stats()['hits'])
+
+    def test_round_trip(self):
+        msg = make_message()
+        raw = message_as_bytes(msg)
+        self.assertTrue(raw.startswith(b"From: jim@example.com\n"
+                b"Subject: =?utf-8?b?"))
+        # The original MIME headers are replaced.
+        self.assertFalse(b"koi8-r" in raw)
+        self.assertFalse(b"quoted-printable" in raw)
+        parsed = message_from_string(raw)
+        self.assertEqual('Быстровыполнимо и малозатратно',
+                parsed.get_header('Subject'))
+        self.assertEqual([
+                ('text/plain', 'Grüße\naus Köln\n'),
+                ('text/html', '<b>Grüße</b>'),
+            ], parsed.alternatives)
+        self.assertEqual(msg.attachments[0].as_dict()['content'],
+                parsed.attachments[0].as_dict()['content'])
+        self.assertEqual([('text/plain', 'Inner body')],
+                parsed.message_parts[0].alternatives)
+
+    def test_write_crlf(self):
+        output = StringIO()
+        make_message().write(output, b"\r\n")
+        raw = output.getvalue()
+        self.assertEqual(raw.count(b"\n"), raw.count(b"\r\n"))
+        parsed = message_from_string(raw)
+        self.assertEqual(1, len(parsed.attachments))
+        self.assertEqual(2, len(parsed.alternatives))
+
+    def test_write_single_part(self):
+        msg = UnicodeMessage()
+        msg.add_header('Subject', 'Plain')
+        msg.add_alternative('Hello')
+        self.assertEqual(b"Subject: Plain\n"
+                b"MIME-Version: 1.0\n"
+                b"Content-Type: text/plain; charset=\"utf-8\"\n"
+                b"Content-Transfer-Encoding: 7bit\n"
+                b"\n"
+                b"Hello", message_as_bytes(msg))